@@ -0,0 +1,98 @@
+# Ansible loads callback plugins from the callback_plugins directory next to the playbook being run
+from __future__ import absolute_import, division, print_function
+
+__metaclass__ = type
+
+DOCUMENTATION = """
+    name: ndjson_events
+    type: notification
+    short_description: Writes one JSON object per line for every playbook, task and result event
+    description:
+      - Used by Leidos Storm to follow the progress of a CloudSurf without scraping ansible.log.
+      - Only writes events when the LEIDOSCLOUD_EVENT_LOG environment variable is set to the file to append to.
+"""
+
+import json
+import os
+import time
+
+from ansible.plugins.callback import CallbackBase
+
+
+class CallbackModule(CallbackBase):
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = "notification"
+    CALLBACK_NAME = "ndjson_events"
+    CALLBACK_NEEDS_WHITELIST = False
+
+    def __init__(self):
+        super(CallbackModule, self).__init__()
+        self.path = os.environ.get("LEIDOSCLOUD_EVENT_LOG")
+
+    def _emit(self, event, **fields):
+        if not self.path:
+            return
+        fields["event"] = event
+        fields["time"] = time.time()
+        # Each event is written and flushed in one go so a reader never sees half a line
+        with open(self.path, "a") as f:
+            f.write(json.dumps(fields, default=str) + "\n")
+
+    def _count_tasks(self, blocks):
+        count = 0
+        for block in blocks:
+            for item in getattr(block, "block", []):
+                if hasattr(item, "block"):
+                    count += self._count_tasks([item])
+                elif item.action != "meta":
+                    count += 1
+        return count
+
+    def v2_playbook_on_start(self, playbook):
+        # Tasks added by include_tasks aren't known until they run, so the total is an estimate
+        total = 0
+        for play in playbook.get_plays():
+            try:
+                total += self._count_tasks(play.compile())
+            except Exception:
+                pass
+        self._emit(
+            "playbook_start",
+            playbook=os.path.basename(playbook._file_name),
+            tasks=total,
+        )
+
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        self._emit("task_start", uuid=task._uuid, task=task.get_name())
+
+    def v2_playbook_on_handler_task_start(self, task):
+        self._emit("task_start", uuid=task._uuid, task=task.get_name())
+
+    def _result(self, result, status):
+        fields = {
+            "uuid": result._task._uuid,
+            "host": result._host.get_name(),
+            "status": status,
+        }
+        if status in ("failed", "unreachable"):
+            fields["msg"] = result._result.get("msg", "")
+        self._emit("task_end", **fields)
+
+    def v2_runner_on_ok(self, result):
+        self._result(result, "changed" if result._result.get("changed") else "ok")
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        self._result(result, "ignored" if ignore_errors else "failed")
+
+    def v2_runner_on_skipped(self, result):
+        self._result(result, "skipped")
+
+    def v2_runner_on_unreachable(self, result):
+        self._result(result, "unreachable")
+
+    def v2_playbook_on_stats(self, stats):
+        failed = any(
+            stats.summarize(host)["failures"] or stats.summarize(host)["unreachable"]
+            for host in stats.processed
+        )
+        self._emit("playbook_end", failed=failed)
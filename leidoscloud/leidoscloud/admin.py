@@ -3,7 +3,22 @@ from leidoscloud.models import *
 
 
 class TransitionAdmin(admin.ModelAdmin):
-    list_display = [field.name for field in Transition._meta.get_fields()]
+    list_display = [field.name for field in Transition._meta.concrete_fields]
+
+
+class PlaybookRunAdmin(admin.ModelAdmin):
+    list_display = [
+        "id",
+        "transition",
+        "kind",
+        "status",
+        "pid",
+        "exit_code",
+        "queued_time",
+        "start_time",
+        "duration",
+    ]
+    list_filter = ["kind", "status"]
 
 
 admin.site.register(Transition, TransitionAdmin)
@@ -11,3 +26,9 @@ admin.site.register(Key)
 admin.site.register(API)
 admin.site.register(StockData)
 admin.site.register(Prediction)
+admin.site.register(PlaybookRun, PlaybookRunAdmin)
+admin.site.register(PlaybookTask)
+admin.site.register(QuoteCache)
+admin.site.register(RateLimitBucket)
+admin.site.register(StrategyState)
+admin.site.register(MigrationLease)
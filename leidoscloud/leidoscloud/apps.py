@@ -1,6 +1,7 @@
 from django.apps import AppConfig
 
 from .utils_delete import delete_host
+from .utils_host import get_management_command
 
 
 class LeidosCloudAppConfig(AppConfig):
@@ -10,6 +11,9 @@ class LeidosCloudAppConfig(AppConfig):
 
     # Our custom method to run the death playbook on Django startup
     def ready(self):
+        # Connect the receivers which keep the cached lookups up to date
+        from . import signals
+
         # Run the population script if it does not already exist
         # Check for an expected entry
         API = self.get_model("API")
@@ -23,6 +27,11 @@ class LeidosCloudAppConfig(AppConfig):
         except:
             print("Failed to populate database. You likely haven't migrated yet.")
 
+        # Only the server finishes a migration. Commands run on the new host before it starts, such as collectstatic
+        # in cloud.yml, must leave the transition to it, as they couldn't start the deletion of the old host
+        if get_management_command() not in (None, "runserver"):
+            return
+
         # Only attempt to update transition if transition table exists
         from django.db import connection
 
@@ -43,8 +52,16 @@ class LeidosCloudAppConfig(AppConfig):
                         latest_transition.succeeded = True
                         latest_transition.end_time = timezone.now()
                         latest_transition.save()
+                        # The lease was copied over with the database by the playbook which has now finished
+                        from .utils_lease import break_lease
+
+                        break_lease()
+                        # Keep the timings of the migration, which are only in the event log the playbook copied here
+                        from .utils_events import adopt_runs
+
+                        adopt_runs(latest_transition)
                         # The transition succeeded! Let's delete the previous instance
-                        delete_host(latest_transition.start_provider)
+                        delete_host(latest_transition.start_provider, latest_transition)
 
             except transition.DoesNotExist:
                 print("Could not find a previous transition to update the end_time on!")
@@ -3,10 +3,13 @@ import os
 from django_cron import CronJobBase, Schedule
 from django.utils import timezone
 from . import utils_host
+from . import utils_jobs
+from . import utils_lease
 from . import utils_playbook
 from . import utils_stock_api
 from .models import *
 from .utils_stock_api import save_stock_data, save_best_prediction
+from .utils_strategies import run_strategies
 import datetime
 
 
@@ -16,16 +19,22 @@ class CheckHangingScripts(CronJobBase):
     code = "leidoscloud.hanging_script_check"  # checks if script is hanging
 
     def do(self):
-        transition = Transition.objects.latest("start_time")
-        # If there is an open transition which has not finished within an hour
-        if (timezone.now() - transition.start_time) > datetime.timedelta(
-            minutes=60
-        ) and transition.end_time is None:
+        transition = utils_host.get_moving_transition()
+        # If the latest transition is open and has not finished within an hour
+        if transition is not None and (
+            timezone.now() - transition.start_time
+        ) > datetime.timedelta(minutes=60):
             target = transition.end_provider
-            # Stop all current attempts
-            os.system("killall ansible-playbook")
-            # Delete the transition so move_self doesn't raise an AlreadyInProgressException
-            transition.delete()
+            # Stop the attempt. Playbooks started before runs were supervised can only be found by name
+            if not utils_jobs.cancel_runs(transition, PlaybookRun.DEPLOY):
+                os.system("killall ansible-playbook")
+            # Nothing is running the playbook any more, so its lease can be taken straight away
+            utils_lease.break_lease()
+            # End the transition as failed so move_self doesn't raise an AlreadyInProgressException. It is kept, along
+            # with its cancelled runs and the timings of their tasks, so the hung attempt can still be looked into
+            transition.end_time = timezone.now()
+            transition.succeeded = False
+            transition.save()
             try:
                 utils_playbook.move_self(target)
                 return (
@@ -60,10 +69,18 @@ class CloudSurfCron(CronJobBase):
             # This returns any exceptions we've handled in get_provider_api
             return provider_objects
         key = utils_stock_api.get_api_key(alpha)
-        stock_dict, symbols = utils_stock_api.get_cloud_target(provider_objects, key)
+        try:
+            stock_dict, symbols = utils_stock_api.get_cloud_target(
+                provider_objects, key
+            )
+        except utils_stock_api.RateLimitedError as e:
+            # The quotes which did arrive are cached, so a later run only fetches the rest. Leaving them until then
+            # spreads the calls out rather than failing the run
+            return "Deferred until {}: {}".format(e.retry_at, e)
         # save the stock market data for the predictions table to DB
         save_stock_data(stock_dict)
         save_best_prediction()
+        run_strategies()
 
         if isinstance(stock_dict, str):
             # This returns any exceptions we've handled in get_cloud_target
@@ -0,0 +1,92 @@
+import datetime
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+
+from leidoscloud import utils_backtest
+
+
+class Command(BaseCommand):
+    help = (
+        "Replays stock market readings through CloudSurf policies and reports the CloudSurfs each would have made. "
+        "Uses the readings saved in the database unless a CSV file or synthetic readings are asked for."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--policy",
+            action="append",
+            choices=sorted(utils_backtest.POLICIES),
+            help="Policy to backtest. Can be given more than once. Defaults to every policy",
+        )
+        source = parser.add_mutually_exclusive_group()
+        source.add_argument(
+            "--csv", help="CSV file of readings with time, provider and change columns"
+        )
+        source.add_argument(
+            "--synthetic",
+            type=int,
+            metavar="DAYS",
+            help="Generate this many days of random readings instead",
+        )
+        parser.add_argument("--start", help="Only use readings after this date")
+        parser.add_argument("--end", help="Only use readings up to this date")
+        parser.add_argument(
+            "--transit-minutes",
+            type=float,
+            default=utils_backtest.TRANSIT_MINUTES,
+            help="How long each CloudSurf takes",
+        )
+
+    def handle(self, *args, **options):
+        if options["csv"]:
+            try:
+                providers, times, changes = utils_backtest.csv_readings(options["csv"])
+            except (OSError, KeyError, ValueError) as e:
+                raise CommandError("Could not read " + options["csv"] + ": " + str(e))
+        elif options["synthetic"]:
+            providers, times, changes = utils_backtest.synthetic_readings(
+                options["synthetic"]
+            )
+        else:
+            providers, times, changes = utils_backtest.stored_readings(
+                self._date(options, "start"), self._date(options, "end")
+            )
+            providers = [provider.name for provider in providers]
+        if not len(times):
+            raise CommandError("There are no stock market readings to backtest")
+
+        started = time.monotonic()
+        results = utils_backtest.backtest(
+            times,
+            changes,
+            options["policy"],
+            datetime.timedelta(minutes=options["transit_minutes"]),
+        )
+        elapsed = time.monotonic() - started
+
+        self.stdout.write(
+            "{} readings of {} providers over {:.1f} days".format(
+                len(times), len(providers), (times[-1] - times[0]) / 86400
+            )
+        )
+        columns = ["policy", "migrations", "transit h"] + [p + " h" for p in providers]
+        self.stdout.write("  ".join("{:>12}".format(c) for c in columns))
+        for name, result in results.items():
+            row = [
+                name,
+                result["migrations"],
+                "{:.1f}".format(result["transit"] / 3600),
+            ]
+            row += ["{:.1f}".format(seconds / 3600) for seconds in result["hosted"]]
+            self.stdout.write("  ".join("{:>12}".format(c) for c in row))
+        self.stdout.write("Backtested in {:.2f} seconds".format(elapsed))
+
+    def _date(self, options, name):
+        if not options[name]:
+            return None
+        date = parse_datetime(options[name])
+        if date is None:
+            raise CommandError(name + " is not a valid date")
+        return date
@@ -0,0 +1,64 @@
+import os
+import tempfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from leidoscloud import utils_dbbench
+from leidoscloud.populate_db import populate
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmarks the database profile chosen by LEIDOSCLOUD_DB_PROFILE with status polls, cron writes and "
+        "transition updates running at once. Runs against a throwaway database, never the real one."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--seconds", type=float, default=10, help="How long to run for"
+        )
+        for name, default in (("status", 8), ("cron", 1), ("transition", 2)):
+            parser.add_argument(
+                "--" + name,
+                type=int,
+                default=default,
+                help="Number of {} clients".format(name),
+            )
+
+    def handle(self, *args, **options):
+        clients = {name: options[name] for name in utils_dbbench.WORKLOADS}
+        with tempfile.TemporaryDirectory() as directory:
+            if connection.vendor == "sqlite":
+                # Django would make an in-memory database, which doesn't lock like the real file does
+                connection.settings_dict["TEST"]["NAME"] = os.path.join(
+                    directory, "bench.sqlite3"
+                )
+            old_name = connection.creation.create_test_db(
+                verbosity=0, autoclobber=True, serialize=False
+            )
+            try:
+                populate()
+                results = utils_dbbench.run_benchmark(clients, options["seconds"])
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        self.stdout.write(
+            "Profile {} with {}".format(
+                settings.DATABASE_PROFILE,
+                ", ".join(
+                    "{} {} clients".format(count, name)
+                    for name, count in clients.items()
+                ),
+            )
+        )
+        columns = ["workload", "ops", "errors", "ops/s", "p50 ms", "p95 ms", "p99 ms"]
+        self.stdout.write("  ".join("{:>10}".format(c) for c in columns))
+        for name, result in results.items():
+            row = [name, result["operations"], result["errors"]]
+            row += [
+                "{:.1f}".format(result[key])
+                for key in ("throughput", "p50", "p95", "p99")
+            ]
+            self.stdout.write("  ".join("{:>10}".format(c) for c in row))
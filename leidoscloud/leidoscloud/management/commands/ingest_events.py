@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from leidoscloud.models import Transition
+from leidoscloud.utils_events import adopt_runs, finish_runs
+
+
+class Command(BaseCommand):
+    help = (
+        "Reads the event log the migration playbook copied to this host into the runs of the latest transition, and "
+        "ends them. Run by the last task of ansible-scripts/cloud.yml, after Django has started on the new host."
+    )
+
+    def handle(self, *args, **options):
+        transition = Transition.objects.order_by("-start_time").first()
+        if transition is None:
+            raise CommandError("There is no transition to read the events of")
+        read = adopt_runs(transition)
+        finished = finish_runs(transition)
+        self.stdout.write("Read {} events and ended {} runs".format(read, finished))
@@ -0,0 +1,221 @@
+import importlib.util
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+
+from leidoscloud import utils_loadtest
+from leidoscloud.populate_db import populate
+
+# How long gunicorn may take to start answering requests
+SERVER_START_SECONDS = 60
+
+
+class Command(BaseCommand):
+    help = (
+        "Load tests the pages against a local gunicorn serving a seeded throwaway database and log, never the real "
+        "ones. Reports the latency percentiles, throughput and queries of each page. Fails when a page has regressed "
+        "by more than the threshold since the --baseline run."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dataset",
+            choices=sorted(utils_loadtest.DATASETS),
+            default="small",
+            help="Size of the seeded database and log",
+        )
+        parser.add_argument(
+            "--seed", type=int, default=0, help="Seed of the random seeded data"
+        )
+        parser.add_argument(
+            "--clients", type=int, default=8, help="Number of concurrent clients"
+        )
+        parser.add_argument(
+            "--seconds", type=float, default=30, help="How long to run for"
+        )
+        parser.add_argument(
+            "--warmup",
+            type=float,
+            default=3,
+            help="Seconds of requests before measuring, which aren't counted",
+        )
+        parser.add_argument(
+            "--workers", type=int, default=1, help="Number of gunicorn workers"
+        )
+        parser.add_argument(
+            "--threads",
+            type=int,
+            default=16,
+            help="Number of threads of each gunicorn worker, as in ansible-scripts/cloud.yml",
+        )
+        parser.add_argument(
+            "--baseline", metavar="PATH", help="Results of an earlier run to compare to"
+        )
+        parser.add_argument(
+            "--threshold",
+            type=float,
+            default=0.2,
+            help="Fraction of the baseline a metric may grow by before the run fails",
+        )
+        parser.add_argument(
+            "--save", metavar="PATH", help="Write the results to this file as JSON"
+        )
+
+    def handle(self, *args, **options):
+        if importlib.util.find_spec("gunicorn") is None:
+            raise CommandError("gunicorn is not installed")
+        baseline = None
+        if options["baseline"]:
+            try:
+                with open(options["baseline"]) as f:
+                    baseline = json.load(f)
+            except (OSError, ValueError) as e:
+                raise CommandError("Could not read the baseline: " + str(e))
+            if baseline.get("dataset") != options["dataset"]:
+                raise CommandError(
+                    "The baseline was measured with the {} dataset".format(
+                        baseline.get("dataset")
+                    )
+                )
+
+        with tempfile.TemporaryDirectory() as directory:
+            if connection.vendor == "sqlite":
+                # gunicorn can't see Django's in-memory test database
+                connection.settings_dict["TEST"]["NAME"] = os.path.join(
+                    directory, "loadtest.sqlite3"
+                )
+            old_name = connection.creation.create_test_db(
+                verbosity=0, autoclobber=True, serialize=False
+            )
+            try:
+                results = self._measure(directory, options)
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        self.stdout.write(
+            "Dataset {} with {} clients for {:g} seconds".format(
+                options["dataset"], options["clients"], options["seconds"]
+            )
+        )
+        columns = ["page", "requests", "errors", "req/s", "p50 ms", "p95 ms"]
+        columns += ["p99 ms", "queries", "cached"]
+        self.stdout.write("  ".join("{:>12}".format(c) for c in columns))
+        for name, result in results.items():
+            row = [name, result["requests"], result["errors"]]
+            row += [
+                "{:.1f}".format(result[key])
+                for key in ("throughput", "p50", "p95", "p99")
+            ]
+            row += [result["cold_queries"], result["warm_queries"]]
+            self.stdout.write("  ".join("{:>12}".format(c) for c in row))
+
+        if options["save"]:
+            with open(options["save"], "w") as f:
+                json.dump(
+                    {
+                        "dataset": options["dataset"],
+                        "clients": options["clients"],
+                        "results": results,
+                    },
+                    f,
+                    indent=2,
+                )
+        if baseline is not None:
+            regressions = utils_loadtest.compare(
+                results, baseline["results"], options["threshold"]
+            )
+            if regressions:
+                raise CommandError(
+                    "Regressed by more than {:.0%}:\n".format(options["threshold"])
+                    + "\n".join(regressions)
+                )
+
+    def _measure(self, directory, options):
+        log_path = os.path.join(directory, "ansible.log")
+        populate()
+        utils_loadtest.seed(
+            log_path=log_path,
+            seed=options["seed"],
+            **utils_loadtest.DATASETS[options["dataset"]]
+        )
+        user = User.objects.create_user("loadtest", password=uuid.uuid4().hex)
+        # The host the requests to gunicorn are sent to, which is in ALLOWED_HOSTS unlike the test client's own
+        client = Client(HTTP_HOST="127.0.0.1")
+        client.force_login(user)
+        paths = utils_loadtest.endpoints()
+        try:
+            counts = utils_loadtest.count_queries(client, paths)
+        except ValueError as e:
+            raise CommandError("Could not count the queries: " + str(e))
+
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        env = dict(
+            os.environ,
+            LEIDOSCLOUD_DB_NAME=connection.settings_dict["NAME"],
+            LEIDOSCLOUD_MAIN_LOG=log_path,
+            LEIDOSCLOUD_CACHE_DIR=os.path.join(directory, "cache"),
+        )
+        server_log = os.path.join(directory, "gunicorn.log")
+        with open(server_log, "wb") as f:
+            server = subprocess.Popen(
+                # The pinned gunicorn can't be run with python -m, and its script may belong to another interpreter
+                [sys.executable, "-c", "from gunicorn.app.wsgiapp import run; run()"]
+                + ["leidoscloud.wsgi"]
+                + ["-b", "127.0.0.1:{}".format(port)]
+                + ["--workers", str(options["workers"])]
+                + ["--threads", str(options["threads"])],
+                cwd=settings.BASE_DIR,
+                env=env,
+                stdout=subprocess.DEVNULL,
+                stderr=f,
+            )
+        try:
+            self._wait_for(server, port, server_log)
+            url = "http://127.0.0.1:{}".format(port)
+            headers = {
+                "Cookie": "{}={}".format(
+                    settings.SESSION_COOKIE_NAME,
+                    client.cookies[settings.SESSION_COOKIE_NAME].value,
+                )
+            }
+            if options["warmup"] > 0:
+                utils_loadtest.run_load(
+                    url, paths, options["clients"], options["warmup"], headers
+                )
+            results = utils_loadtest.run_load(
+                url, paths, options["clients"], options["seconds"], headers
+            )
+        finally:
+            server.terminate()
+            server.wait(SERVER_START_SECONDS)
+        for name, result in results.items():
+            result.update(counts[name])
+        return results
+
+    def _wait_for(self, server, port, server_log):
+        deadline = time.monotonic() + SERVER_START_SECONDS
+        while time.monotonic() < deadline:
+            if server.poll() is not None:
+                with open(server_log, errors="replace") as f:
+                    raise CommandError("gunicorn exited: " + f.read())
+            try:
+                with socket.create_connection(("127.0.0.1", port), timeout=1):
+                    return
+            except OSError:
+                time.sleep(0.2)
+        raise CommandError(
+            "gunicorn didn't start within {} seconds".format(SERVER_START_SECONDS)
+        )
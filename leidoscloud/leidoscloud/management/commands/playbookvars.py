@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from leidoscloud import utils_vars
+
+
+class Command(BaseCommand):
+    help = (
+        "Writes every variable the playbooks read from the database to a JSON file, for running them by hand with "
+        "ansible-playbook -e @<file>. Prints the path of the file."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "path",
+            nargs="?",
+            help="Where to write the file. Defaults to a temporary file",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            path = utils_vars.write_playbook_vars(options["path"])
+        except OSError as e:
+            raise CommandError("Could not write the playbook variables: " + str(e))
+        self.stdout.write(path)
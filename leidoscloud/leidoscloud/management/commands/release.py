@@ -0,0 +1,72 @@
+import json
+import sqlite3
+import subprocess
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from leidoscloud import utils_release
+
+
+class Command(BaseCommand):
+    help = (
+        "Builds the compressed release bundle copied to a new host, named after the hash of the files in it. A bundle "
+        "which has already been built for the same files is reused. The bundle includes a wheelhouse of every pinned "
+        "requirement. Prints the bundle's path and hash as JSON, or writes them to --output."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--output-dir", help="Where to keep bundles. Defaults to RELEASE_DIR"
+        )
+        parser.add_argument(
+            "--no-wheelhouse",
+            action="store_true",
+            help="Ship the wheelhouse as it is rather than building it",
+        )
+        parser.add_argument(
+            "--snapshot",
+            metavar="PATH",
+            help="Also write a consistent copy of the SQLite database to this path",
+        )
+        parser.add_argument(
+            "--output",
+            metavar="PATH",
+            help="Write the JSON to this file instead of printing it, as starting Django may print to stdout",
+        )
+
+    def handle(self, *args, **options):
+        wheelhouse = None
+        if not options["no_wheelhouse"]:
+            try:
+                path, wheelhouse, built = utils_release.build_wheelhouse()
+            except (OSError, subprocess.CalledProcessError) as e:
+                # Not fatal, the new host installs its requirements from the package index instead
+                self.stderr.write("Could not build the wheelhouse: " + str(e))
+        try:
+            path, digest, built = utils_release.build_release(options["output_dir"])
+        except OSError as e:
+            raise CommandError("Could not build the release bundle: " + str(e))
+        result = {
+            "bundle": path,
+            "hash": digest,
+            "built": built,
+            "wheelhouse": wheelhouse,
+            "database": None,
+        }
+        # A PostgreSQL database stays where it is, see settings.DATABASE_PROFILE
+        if options["snapshot"] and connection.vendor == "sqlite":
+            try:
+                result["database"] = utils_release.snapshot_database(
+                    options["snapshot"]
+                )
+            except (OSError, sqlite3.Error) as e:
+                raise CommandError("Could not copy the database: " + str(e))
+        if not options["output"]:
+            self.stdout.write(json.dumps(result))
+            return
+        try:
+            with open(options["output"], "w") as f:
+                json.dump(result, f)
+        except OSError as e:
+            raise CommandError("Could not write the release details: " + str(e))
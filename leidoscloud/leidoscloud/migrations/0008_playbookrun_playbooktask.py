@@ -0,0 +1,88 @@
+# Generated by Django 2.2.6 on 2026-10-18 12:07
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("leidoscloud", "0007_auto_20200224_1119"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PlaybookRun",
+            fields=[
+                ("id", models.AutoField(primary_key=True, serialize=False)),
+                (
+                    "kind",
+                    models.CharField(
+                        choices=[("deploy", "Deploy"), ("delete", "Delete")],
+                        max_length=10,
+                    ),
+                ),
+                ("event_log", models.CharField(max_length=255)),
+                ("offset", models.IntegerField(default=0)),
+                ("tasks_total", models.IntegerField(default=0)),
+                ("start_time", models.DateTimeField(default=django.utils.timezone.now)),
+                ("end_time", models.DateTimeField(null=True)),
+                ("failed", models.BooleanField(default=False)),
+                (
+                    "transition",
+                    models.ForeignKey(
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="runs",
+                        to="leidoscloud.Transition",
+                    ),
+                ),
+            ],
+        ),
+        migrations.CreateModel(
+            name="PlaybookTask",
+            fields=[
+                ("id", models.AutoField(primary_key=True, serialize=False)),
+                ("position", models.IntegerField()),
+                ("uuid", models.CharField(max_length=64)),
+                ("name", models.CharField(max_length=255)),
+                ("status", models.CharField(default="running", max_length=12)),
+                ("message", models.TextField(blank=True, default="")),
+                ("start_time", models.DateTimeField()),
+                ("end_time", models.DateTimeField(null=True)),
+                (
+                    "run",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="tasks",
+                        to="leidoscloud.PlaybookRun",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="playbooktask",
+            index=models.Index(
+                fields=["run", "position"], name="leidoscloud_run_id_dc85e3_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="playbooktask",
+            index=models.Index(
+                fields=["run", "uuid"], name="leidoscloud_run_id_a58702_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="playbooktask",
+            index=models.Index(
+                fields=["run", "status"], name="leidoscloud_run_id_814224_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="playbookrun",
+            index=models.Index(
+                fields=["transition", "kind"], name="leidoscloud_transit_213396_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 2.2.6 on 2026-10-18 12:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("leidoscloud", "0008_playbookrun_playbooktask"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="QuoteCache",
+            fields=[
+                ("id", models.AutoField(primary_key=True, serialize=False)),
+                ("symbol", models.CharField(max_length=10, unique=True)),
+                ("change", models.FloatField()),
+                ("fetched_at", models.DateTimeField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name="RateLimitBucket",
+            fields=[
+                ("id", models.AutoField(primary_key=True, serialize=False)),
+                ("name", models.CharField(max_length=30, unique=True)),
+                ("tokens", models.FloatField()),
+                ("updated_at", models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 2.2.6 on 2026-10-18 12:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("leidoscloud", "0009_quotecache_ratelimitbucket"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="stockdata",
+            name="provider",
+            field=models.ForeignKey(
+                limit_choices_to={"is_provider": True},
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="stock_data",
+                to="leidoscloud.API",
+            ),
+        ),
+        migrations.AddField(
+            model_name="stockdata", name="change", field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name="stockdata", name="google", field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name="stockdata", name="azure", field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name="stockdata", name="aws", field=models.FloatField(null=True),
+        ),
+    ]
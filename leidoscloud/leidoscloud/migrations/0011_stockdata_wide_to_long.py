@@ -0,0 +1,55 @@
+from django.db import migrations
+
+# The provider columns of the old wide StockData table
+PROVIDER_COLUMNS = ["google", "azure", "aws"]
+
+
+def wide_to_long(apps, schema_editor):
+    API = apps.get_model("leidoscloud", "API")
+    StockData = apps.get_model("leidoscloud", "StockData")
+    providers = {api.name: api for api in API.objects.filter(name__in=PROVIDER_COLUMNS)}
+
+    rows = []
+    for old in StockData.objects.filter(provider__isnull=True).iterator():
+        for name in PROVIDER_COLUMNS:
+            if name in providers and getattr(old, name) is not None:
+                rows.append(
+                    StockData(
+                        time=old.time,
+                        provider=providers[name],
+                        change=getattr(old, name),
+                    )
+                )
+    # Django picks batches small enough for the database. A larger batch_size would be used as it is, and breaks SQLite
+    StockData.objects.bulk_create(rows)
+    # Every old row at once, as a list of their ids could be longer than SQLite allows in one query
+    StockData.objects.filter(provider__isnull=True).delete()
+
+
+def long_to_wide(apps, schema_editor):
+    StockData = apps.get_model("leidoscloud", "StockData")
+
+    readings = {}
+    for row in StockData.objects.select_related("provider").iterator():
+        if row.provider.name in PROVIDER_COLUMNS:
+            readings.setdefault(row.time, {})[row.provider.name] = row.change
+    StockData.objects.all().delete()
+    StockData.objects.bulk_create(
+        [
+            StockData(
+                time=time, **{name: changes.get(name, 0.0) for name in PROVIDER_COLUMNS}
+            )
+            for time, changes in readings.items()
+        ]
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("leidoscloud", "0010_stockdata_provider_change"),
+    ]
+
+    operations = [
+        migrations.RunPython(wide_to_long, long_to_wide),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 2.2.6 on 2026-10-18 12:13
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("leidoscloud", "0011_stockdata_wide_to_long"),
+    ]
+
+    operations = [
+        migrations.RemoveField(model_name="stockdata", name="google"),
+        migrations.RemoveField(model_name="stockdata", name="azure"),
+        migrations.RemoveField(model_name="stockdata", name="aws"),
+        migrations.AlterField(
+            model_name="stockdata",
+            name="provider",
+            field=models.ForeignKey(
+                limit_choices_to={"is_provider": True},
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="stock_data",
+                to="leidoscloud.API",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="stockdata", name="change", field=models.FloatField(),
+        ),
+        migrations.AddIndex(
+            model_name="stockdata",
+            index=models.Index(
+                fields=["provider", "time"], name="leidoscloud_provide_a303dc_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 2.2.6 on 2026-10-18 12:14
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("leidoscloud", "0012_remove_stockdata_provider_columns"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="prediction",
+            name="time",
+            field=models.DateTimeField(db_index=True),
+        ),
+        migrations.AlterField(
+            model_name="stockdata",
+            name="time",
+            field=models.DateTimeField(
+                db_index=True, default=django.utils.timezone.now
+            ),
+        ),
+        migrations.AlterField(
+            model_name="transition",
+            name="start_time",
+            field=models.DateTimeField(
+                db_index=True, default=django.utils.timezone.now
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="transition",
+            index=models.Index(
+                condition=models.Q(end_time__isnull=True),
+                fields=["start_time"],
+                name="transition_open_idx",
+            ),
+        ),
+    ]
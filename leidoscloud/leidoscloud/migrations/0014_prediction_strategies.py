@@ -0,0 +1,31 @@
+# Generated by Django 2.2.6 on 2026-10-18 12:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("leidoscloud", "0013_hot_path_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="StrategyState",
+            fields=[
+                ("id", models.AutoField(primary_key=True, serialize=False)),
+                ("strategy", models.CharField(max_length=20, unique=True)),
+                ("time", models.DateTimeField()),
+                ("providers", models.CharField(max_length=200)),
+                ("state", models.TextField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name="prediction", name="score", field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name="prediction",
+            name="strategy",
+            field=models.CharField(default="average", max_length=20),
+        ),
+    ]
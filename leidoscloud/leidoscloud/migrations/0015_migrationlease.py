@@ -0,0 +1,34 @@
+# Generated by Django 2.2.6 on 2026-10-18 12:24
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("leidoscloud", "0014_prediction_strategies"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MigrationLease",
+            fields=[
+                ("id", models.AutoField(primary_key=True, serialize=False)),
+                ("name", models.CharField(max_length=30, unique=True)),
+                ("owner", models.CharField(blank=True, default="", max_length=100)),
+                ("acquired_at", models.DateTimeField(null=True)),
+                ("heartbeat_at", models.DateTimeField(null=True)),
+                ("expires_at", models.DateTimeField(null=True)),
+                (
+                    "transition",
+                    models.ForeignKey(
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="+",
+                        to="leidoscloud.Transition",
+                    ),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,67 @@
+# Generated by Django 2.2.6 on 2026-10-18 12:26
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def status_from_events(apps, schema_editor):
+    # Runs from before jobs were supervised only know what their event log said. Unfinished ones can't be followed
+    PlaybookRun = apps.get_model("leidoscloud", "PlaybookRun")
+    PlaybookRun.objects.update(queued_time=models.F("start_time"))
+    PlaybookRun.objects.filter(end_time__isnull=True).update(status="cancelled")
+    PlaybookRun.objects.filter(end_time__isnull=False, failed=True).update(
+        status="failed"
+    )
+    PlaybookRun.objects.filter(end_time__isnull=False, failed=False).update(
+        status="succeeded"
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("leidoscloud", "0015_migrationlease"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="playbookrun",
+            name="command",
+            field=models.TextField(blank=True, default=""),
+        ),
+        migrations.AddField(
+            model_name="playbookrun",
+            name="exit_code",
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name="playbookrun", name="pid", field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name="playbookrun",
+            name="queued_time",
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name="playbookrun",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("queued", "Queued"),
+                    ("running", "Running"),
+                    ("succeeded", "Succeeded"),
+                    ("failed", "Failed"),
+                    ("cancelled", "Cancelled"),
+                ],
+                default="queued",
+                max_length=10,
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="playbookrun",
+            index=models.Index(
+                fields=["kind", "status"], name="leidoscloud_kind_8fd867_idx"
+            ),
+        ),
+        migrations.RunPython(status_from_events, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 2.2.6 on 2026-10-18 12:28
+
+from django.db import migrations, models
+
+
+def fill_durations(apps, schema_editor):
+    PlaybookTask = apps.get_model("leidoscloud", "PlaybookTask")
+    for task in PlaybookTask.objects.filter(end_time__isnull=False).iterator():
+        task.duration = (task.end_time - task.start_time).total_seconds()
+        task.save(update_fields=["duration"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("leidoscloud", "0016_playbook_jobs"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="playbooktask",
+            name="duration",
+            field=models.FloatField(null=True),
+        ),
+        migrations.RunPython(fill_durations, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.6 on 2026-10-18 13:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("leidoscloud", "0017_playbooktask_duration"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="ratelimitbucket",
+            name="version",
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
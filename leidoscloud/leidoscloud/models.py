@@ -97,11 +97,21 @@ class Transition(models.Model):
         on_delete=models.SET_NULL,
         limit_choices_to={"is_provider": True},
     )
-    start_time = models.DateTimeField(default=timezone.now)
+    start_time = models.DateTimeField(default=timezone.now, db_index=True)
     end_time = models.DateTimeField(null=True)
     succeeded = models.BooleanField(default=False)
     deleted = models.BooleanField(default=False)
 
+    class Meta:
+        # Only transitions which are still in progress, so finding the open one stays cheap however long the history is
+        indexes = [
+            models.Index(
+                fields=["start_time"],
+                condition=models.Q(end_time__isnull=True),
+                name="transition_open_idx",
+            )
+        ]
+
     def __str__(self):
         return (
             self.start_provider.long_name
@@ -147,8 +157,8 @@ class Key(models.Model):
 
 class StockData(models.Model):
     """
-    Django Model that contains records representing the stock market readings
-    of each of the 3 cloud providers at different times of day
+    Django Model that contains records representing the stock market readings of the cloud providers at different
+    times of day. There is one record per provider per reading, so providers can be added without changing the schema.
 
     Fields
     ------
@@ -156,35 +166,34 @@ class StockData(models.Model):
         A unique automatically generated integer value which is the primary key of the model
     time : DateTimeField
         DateTime entry which represents the time of the stock market reading
-    google : FloatField
-        A decimal value which represents percentage share price change so far in the day of trading for Google
-    azure : FloatField
-        A decimal value which represents percentage share price change so far in the day of trading for Microsoft
-    aws : FloatField
-        A decimal value which represents percentage share price change so far in the day of trading for Amazon
+    provider : API Model instance
+        The API model instance representing the provider the reading is for
+        This is a foreign key of the model
+    change : FloatField
+        A decimal value which represents percentage share price change so far in the day of trading for the provider
 
     Methods
     -------
     __str__(self)
-        a toString method that represents StockData entries as a message listing the names of each of the companies
-        and their respective field values
+        a toString method that represents StockData entries as a message showing the name of the provider and its
+        change
     """
 
     id = models.AutoField(primary_key=True)
-    time = models.DateTimeField(default=timezone.now)
-    google = models.FloatField()
-    azure = models.FloatField()
-    aws = models.FloatField()
+    time = models.DateTimeField(default=timezone.now, db_index=True)
+    provider = models.ForeignKey(
+        API,
+        related_name="stock_data",
+        on_delete=models.CASCADE,
+        limit_choices_to={"is_provider": True},
+    )
+    change = models.FloatField()
+
+    class Meta:
+        indexes = [models.Index(fields=["provider", "time"])]
 
     def __str__(self):
-        return (
-            "google = "
-            + str(self.google)
-            + " azure = "
-            + str(self.azure)
-            + " aws = "
-            + str(self.aws)
-        )
+        return self.provider.name + " = " + str(self.change)
 
 
 class Prediction(models.Model):
@@ -201,6 +210,10 @@ class Prediction(models.Model):
     provider : API Model instance
         The API model instance representing the provider that has been predicted to be the best to move to next
         This is a foreign key of the model
+    strategy : CharField
+        The name of the strategy that made the prediction. "average" for the window average of save_best_prediction
+    score : FloatField
+        The score the strategy gave the provider, lower is better. Null for the window average
     Methods
     -------
     __str__(self)
@@ -209,7 +222,7 @@ class Prediction(models.Model):
     """
 
     id = models.AutoField(primary_key=True)
-    time = models.DateTimeField()
+    time = models.DateTimeField(db_index=True)
     provider = models.ForeignKey(
         API,
         related_name="provider",
@@ -217,6 +230,306 @@ class Prediction(models.Model):
         on_delete=models.SET_NULL,
         limit_choices_to={"is_provider": True},
     )
+    strategy = models.CharField(max_length=20, default="average")
+    score = models.FloatField(null=True)
 
     def __str__(self):
         return "The prediction is " + self.provider.name
+
+
+class PlaybookRun(models.Model):
+    """
+    Django Model that represents one run of an ansible playbook and the NDJSON event log written by it. Runs are
+    started as jobs by utils_jobs, which records the process and how it exited.
+
+    Fields
+    ------
+    id : AutoField
+        A unique automatically generated integer value which is the primary key of the model
+    transition : Transition Model instance
+        The transition that the playbook was run for
+        This is a foreign key of the model
+    kind : CharField
+        DEPLOY for the migration playbook, DELETE for the playbook deleting the old host
+    status : CharField
+        QUEUED until a worker starts the playbook, then RUNNING until it exits with SUCCEEDED, FAILED or CANCELLED
+    command : TextField
+        JSON list of the command line of the playbook
+    pid : IntegerField
+        Process id of ansible-playbook, which also leads its own process group. Null until it is started
+    exit_code : IntegerField
+        The exit code of ansible-playbook. Null until it exits
+    queued_time : DateTimeField
+        The date and time that the run was submitted
+    event_log : CharField
+        Location of the NDJSON file the ansible callback writes events to
+    offset : IntegerField
+        Number of bytes of the event log which have already been read into the database
+    tasks_total : IntegerField
+        Number of tasks the playbook is expected to run. Tasks added by include_tasks make this an estimate
+    start_time : DateTimeField
+        The date and time that the playbook was started at
+    end_time : DateTimeField
+        The date and time that the playbook finished at. Null while it is still running
+    failed : BooleanField
+        True if the playbook finished with a failed or unreachable host
+
+    Methods
+    -------
+    __str__(self)
+        a toString method that represents runs by their kind and the transition they belong to
+    """
+
+    DEPLOY = "deploy"
+    DELETE = "delete"
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+    STATUSES = [
+        (QUEUED, "Queued"),
+        (RUNNING, "Running"),
+        (SUCCEEDED, "Succeeded"),
+        (FAILED, "Failed"),
+        (CANCELLED, "Cancelled"),
+    ]
+
+    id = models.AutoField(primary_key=True)
+    transition = models.ForeignKey(
+        Transition, null=True, related_name="runs", on_delete=models.CASCADE
+    )
+    kind = models.CharField(
+        max_length=10, choices=[(DEPLOY, "Deploy"), (DELETE, "Delete")]
+    )
+    status = models.CharField(max_length=10, choices=STATUSES, default=QUEUED)
+    command = models.TextField(blank=True, default="")
+    pid = models.IntegerField(null=True)
+    exit_code = models.IntegerField(null=True)
+    queued_time = models.DateTimeField(default=timezone.now)
+    event_log = models.CharField(max_length=255)
+    offset = models.IntegerField(default=0)
+    tasks_total = models.IntegerField(default=0)
+    start_time = models.DateTimeField(default=timezone.now)
+    end_time = models.DateTimeField(null=True)
+    failed = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["transition", "kind"]),
+            models.Index(fields=["kind", "status"]),
+        ]
+
+    def __str__(self):
+        return self.kind + " run for transition " + str(self.transition_id)
+
+    @property
+    def duration(self):
+        # Seconds from the playbook starting until it exited, or until now while it is running
+        if self.status == self.QUEUED:
+            return None
+        return ((self.end_time or timezone.now()) - self.start_time).total_seconds()
+
+
+class PlaybookTask(models.Model):
+    """
+    Django Model that contains the result of each task of a playbook run, read from its NDJSON event log
+
+    Fields
+    ------
+    id : AutoField
+        A unique automatically generated integer value which is the primary key of the model
+    run : PlaybookRun Model instance
+        The playbook run the task was part of
+        This is a foreign key of the model
+    position : IntegerField
+        The order in which the task was started within the run, starting from 1
+    uuid : CharField
+        The identifier ansible gave to the task
+    name : CharField
+        The name of the task
+    status : CharField
+        running until a result arrives, then the worst result of any host: ok, changed, skipped, ignored, failed or
+        unreachable
+    message : TextField
+        The error message of a failed or unreachable task
+    start_time : DateTimeField
+        The date and time that the task was started at
+    end_time : DateTimeField
+        The date and time that the last host finished the task. Null while it is running
+    duration : FloatField
+        Seconds from the task starting until the last host finished it. Null while it is running
+
+    Methods
+    -------
+    __str__(self)
+        a toString method that represents tasks by their name and status
+    """
+
+    RUNNING = "running"
+    FAILED_STATUSES = ("failed", "unreachable")
+
+    id = models.AutoField(primary_key=True)
+    run = models.ForeignKey(PlaybookRun, related_name="tasks", on_delete=models.CASCADE)
+    position = models.IntegerField()
+    uuid = models.CharField(max_length=64)
+    name = models.CharField(max_length=255)
+    status = models.CharField(max_length=12, default=RUNNING)
+    message = models.TextField(blank=True, default="")
+    start_time = models.DateTimeField()
+    end_time = models.DateTimeField(null=True)
+    duration = models.FloatField(null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["run", "position"]),
+            models.Index(fields=["run", "uuid"]),
+            models.Index(fields=["run", "status"]),
+        ]
+
+    def __str__(self):
+        return self.name + " (" + self.status + ")"
+
+
+class QuoteCache(models.Model):
+    """
+    Django Model that caches the latest share price change of each ticker symbol retrieved from Alpha Vantage.
+    It is shared by every process, so quotes survive the restarts of manage.py runcrons.
+
+    Fields
+    ------
+    id : AutoField
+        A unique automatically generated integer value which is the primary key of the model
+    symbol : CharField
+        The stock ticker symbol the quote is for
+    change : FloatField
+        The percentage share price change so far in the day of trading
+    fetched_at : DateTimeField
+        The date and time the quote was retrieved from Alpha Vantage
+
+    Methods
+    -------
+    __str__(self)
+        a toString method that represents quotes by their symbol and change
+    """
+
+    id = models.AutoField(primary_key=True)
+    symbol = models.CharField(max_length=10, unique=True)
+    change = models.FloatField()
+    fetched_at = models.DateTimeField()
+
+    def __str__(self):
+        return self.symbol + " = " + str(self.change)
+
+
+class RateLimitBucket(models.Model):
+    """
+    Django Model that stores the state of a token bucket limiting the calls made to an external API.
+    Tokens are added back continuously up to a capacity, and each call takes one.
+
+    Fields
+    ------
+    id : AutoField
+        A unique automatically generated integer value which is the primary key of the model
+    name : CharField
+        The name of the API the bucket limits
+    tokens : FloatField
+        The number of tokens that were left at updated_at
+    updated_at : DateTimeField
+        The date and time the bucket was last updated
+    version : PositiveIntegerField
+        Incremented by every update, so a process only takes tokens if nothing changed the bucket since it read it
+
+    Methods
+    -------
+    __str__(self)
+        a toString method that represents buckets by their name and tokens left
+    """
+
+    id = models.AutoField(primary_key=True)
+    name = models.CharField(max_length=30, unique=True)
+    tokens = models.FloatField()
+    updated_at = models.DateTimeField()
+    version = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return self.name + " has " + str(self.tokens) + " tokens"
+
+
+class StrategyState(models.Model):
+    """
+    Django Model that stores what a prediction strategy remembers between cron runs, so only the stock market readings
+    saved since the last run have to be read.
+
+    Fields
+    ------
+    id : AutoField
+        A unique automatically generated integer value which is the primary key of the model
+    strategy : CharField
+        The name of the strategy, see utils_strategies.STRATEGIES
+    time : DateTimeField
+        The time of the newest stock market reading the state includes
+    providers : CharField
+        Comma separated ids of the providers, in the order of the columns of the state
+    state : TextField
+        JSON object of the arrays the strategy keeps
+
+    Methods
+    -------
+    __str__(self)
+        a toString method that represents states by their strategy and time
+    """
+
+    id = models.AutoField(primary_key=True)
+    strategy = models.CharField(max_length=20, unique=True)
+    time = models.DateTimeField()
+    providers = models.CharField(max_length=200)
+    state = models.TextField()
+
+    def __str__(self):
+        return self.strategy + " at " + str(self.time)
+
+
+class MigrationLease(models.Model):
+    """
+    Django Model for a lease which must be held to start a CloudSurf, so that only one ansible-playbook migration can
+    be launched at a time by any process sharing the database. The lease is taken and renewed with a single conditional
+    UPDATE and lapses if its owner stops renewing it, for example because the process holding it died.
+
+    Fields
+    ------
+    id : AutoField
+        A unique automatically generated integer value which is the primary key of the model
+    name : CharField
+        The name of the lease
+    owner : CharField
+        Host name, process id and a random token of the holder, or empty when the lease is free
+    transition : Transition Model instance
+        The transition being run by the holder, if it has got as far as creating one
+        This is a foreign key of the model
+    acquired_at : DateTimeField
+        The date and time the lease was taken
+    heartbeat_at : DateTimeField
+        The date and time the holder last renewed the lease
+    expires_at : DateTimeField
+        The lease is free after this date and time unless it is renewed
+
+    Methods
+    -------
+    __str__(self)
+        a toString method that represents leases by their name and owner
+    """
+
+    id = models.AutoField(primary_key=True)
+    name = models.CharField(max_length=30, unique=True)
+    owner = models.CharField(max_length=100, blank=True, default="")
+    transition = models.ForeignKey(
+        Transition, related_name="+", null=True, on_delete=models.SET_NULL
+    )
+    acquired_at = models.DateTimeField(null=True)
+    heartbeat_at = models.DateTimeField(null=True)
+    expires_at = models.DateTimeField(null=True)
+
+    def __str__(self):
+        return self.name + " held by " + (self.owner or "nobody")
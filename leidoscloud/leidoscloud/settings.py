@@ -10,11 +10,22 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/2.2/ref/settings/
 """
 
+import importlib.util
 import os
+import sys
+import tempfile
+
+from django.core.exceptions import ImproperlyConfigured
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 STATIC_DIR = os.path.join(BASE_DIR, "static")
+# The tests write the ansible log they read and their cache to a directory of their own rather than next to the code
+# and the server's cache, see utils_host.MAIN_LOG_TXT and CACHE_DIR below
+if sys.argv[1:2] == ["test"]:
+    TEST_DIR = tempfile.mkdtemp(prefix="leidoscloud-test-")
+    os.environ.setdefault("LEIDOSCLOUD_MAIN_LOG", os.path.join(TEST_DIR, "ansible.log"))
+    os.environ.setdefault("LEIDOSCLOUD_CACHE_DIR", os.path.join(TEST_DIR, "cache"))
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/2.2/howto/deployment/checklist/
 
@@ -78,12 +89,93 @@ WSGI_APPLICATION = "leidoscloud.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/2.2/ref/settings/#databases
 
-DATABASES = {
-    "default": {
-        "ENGINE": "django.db.backends.sqlite3",
-        "NAME": os.path.join(BASE_DIR, "db.sqlite3"),
+# LEIDOSCLOUD_DB_PROFILE picks the database:
+# sqlite-wal: db.sqlite3 in write-ahead log mode, so status polls can read while the cron and playbooks write
+# sqlite: db.sqlite3 with SQLite's default rollback journal
+# Either SQLite profile uses the file at LEIDOSCLOUD_DB_NAME instead of db.sqlite3 when it is set
+# postgres: PostgreSQL configured by the LEIDOSCLOUD_DB_* variables below. Install requirements-postgres.txt for the
+# pinned psycopg2, which the SQLite profiles don't need. The Postgres_tests CI job runs TestPostgresProfile against a
+# PostgreSQL container with this profile
+# Connections are pooled by keeping them open, see DATABASE_CONN_MAX_AGE, so each process holds at most one per thread.
+# That is 16 per gunicorn worker with --threads 16 in cloud.yml, plus JOB_WORKERS and one for the cron, which must stay
+# below PostgreSQL's max_connections (100 by default). Point LEIDOSCLOUD_DB_HOST and PORT at pgbouncer to share fewer
+# server connections between more processes
+DATABASE_PROFILE = os.environ.get("LEIDOSCLOUD_DB_PROFILE", "sqlite-wal")
+# Each thread keeps its connection open for this many seconds rather than connecting for every request
+DATABASE_CONN_MAX_AGE = int(os.environ.get("LEIDOSCLOUD_DB_CONN_MAX_AGE", 60))
+
+if DATABASE_PROFILE == "postgres":
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.postgresql",
+            "NAME": os.environ.get("LEIDOSCLOUD_DB_NAME", "leidoscloud"),
+            "USER": os.environ.get("LEIDOSCLOUD_DB_USER", "leidoscloud"),
+            "PASSWORD": os.environ.get("LEIDOSCLOUD_DB_PASSWORD", ""),
+            "HOST": os.environ.get("LEIDOSCLOUD_DB_HOST", "localhost"),
+            "PORT": os.environ.get("LEIDOSCLOUD_DB_PORT", "5432"),
+            "CONN_MAX_AGE": DATABASE_CONN_MAX_AGE,
+        }
+    }
+elif DATABASE_PROFILE in ("sqlite", "sqlite-wal"):
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": os.environ.get(
+                "LEIDOSCLOUD_DB_NAME", os.path.join(BASE_DIR, "db.sqlite3")
+            ),
+            "CONN_MAX_AGE": DATABASE_CONN_MAX_AGE,
+        }
+    }
+else:
+    raise ImproperlyConfigured("Unknown LEIDOSCLOUD_DB_PROFILE " + DATABASE_PROFILE)
+
+# Set on every new SQLite connection by signals.configure_sqlite. A writer waits up to busy_timeout milliseconds for
+# another to finish rather than failing with "database is locked". NORMAL only syncs at checkpoints, which is safe in
+# WAL mode, so a commit doesn't wait for the disk.
+SQLITE_PRAGMAS = {"busy_timeout": 5000}
+if DATABASE_PROFILE == "sqlite-wal":
+    SQLITE_PRAGMAS.update({"journal_mode": "WAL", "synchronous": "NORMAL"})
+
+# LEIDOSCLOUD_CACHE picks where the pages, table fragments and provider lists built from the database are cached:
+# file: CACHE_DIR, shared by gunicorn, the cron, the job runner and manage.py so every change is seen straight away
+# locmem: the memory of each process. Changes made by another process, such as the cron, are only seen after
+# CACHE_SECONDS, so this is only for running a single process
+# redis: the Redis server at LEIDOSCLOUD_CACHE_URL, through django-redis. That isn't in requirements.txt, so the file
+# cache stands in for it where it isn't installed
+# Cached data is built again as soon as a change to its rows is seen, see utils_cache
+CACHE_PROFILE = os.environ.get("LEIDOSCLOUD_CACHE", "file")
+CACHE_DIR = os.environ.get(
+    "LEIDOSCLOUD_CACHE_DIR", os.path.join(tempfile.gettempdir(), "leidoscloud-cache")
+)
+
+if CACHE_PROFILE == "redis" and importlib.util.find_spec("django_redis") is not None:
+    CACHES = {
+        "default": {
+            "BACKEND": "django_redis.cache.RedisCache",
+            "LOCATION": os.environ.get(
+                "LEIDOSCLOUD_CACHE_URL", "redis://127.0.0.1:6379/1"
+            ),
+        }
+    }
+elif CACHE_PROFILE in ("file", "redis"):
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+            "LOCATION": CACHE_DIR,
+        }
+    }
+elif CACHE_PROFILE == "locmem":
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "LOCATION": "leidoscloud",
+        }
     }
-}
+else:
+    raise ImproperlyConfigured("Unknown LEIDOSCLOUD_CACHE " + CACHE_PROFILE)
+
+# Shared caches see every change, so entries are only kept for longer than a minute when there is one
+CACHE_SECONDS = 60 if CACHE_PROFILE == "locmem" else 24 * 60 * 60
 
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
@@ -119,6 +211,65 @@ STATICFILES_DIRS = [
 ]
 # This hardcoded directory is perhaps not ideal
 STATIC_ROOT = "/usr/share/caddy/static"
+# Collected files are named after a hash of their contents and compressed ahead of time, so caddy can serve them with
+# far-future cache headers
+STATICFILES_STORAGE = "leidoscloud.storage.PrecompressedManifestStorage"
+
+# Alpha Vantage quotes are cached in the database and shared by every process.
+# Quotes younger than QUOTE_TTL_SECONDS are used without calling Alpha Vantage. Quotes up to QUOTE_STALE_SECONDS
+# older than that are used when a new one can't be retrieved or the rate limit has been reached.
+QUOTE_TTL_SECONDS = 15 * 60
+QUOTE_STALE_SECONDS = 60 * 60
+# The free tier of Alpha Vantage allows 5 calls a minute, so one call comes back every 12 seconds
+QUOTE_RATE_CAPACITY = 5
+QUOTE_RATE_REFILL_SECONDS = 12
+
+# Predictions average the stock market readings over this many hours before the latest reading
+PREDICTION_WINDOW_HOURS = 24
+# Strategies from utils_strategies.STRATEGIES which also make a prediction every time stock market data is saved.
+# A strategy running for the first time starts from the last PREDICTION_HISTORY readings.
+PREDICTION_STRATEGIES = ["sma", "ewma", "momentum", "volatility"]
+PREDICTION_HISTORY = 72
+
+# Only one process may launch a CloudSurf. The lease allowing it is renewed every LEASE_HEARTBEAT_SECONDS while the
+# playbook runs, and is free again LEASE_SECONDS after the last renewal if its holder dies.
+LEASE_SECONDS = 120
+LEASE_HEARTBEAT_SECONDS = 30
+
+# Each open status stream holds one of gunicorn's threads for up to utils_log.STREAM_MAX_SECONDS. Each process serves at
+# most STREAM_MAX_CONNECTIONS streams at once, and refuses any more with 503 so those browsers poll status.json instead.
+# Keep it well below the --threads gunicorn is started with in ansible-scripts/cloud.yml, currently 16, so the polls
+# and every other request always find a free thread.
+STREAM_MAX_CONNECTIONS = 4
+
+# Playbooks are run by a pool of JOB_WORKERS threads in each process, with at most JOB_LIMITS of each kind at once
+JOB_WORKERS = 4
+JOB_LIMITS = {"deploy": 1, "delete": 2}
+# The events a running playbook writes are stored every JOB_INGEST_SECONDS by the thread supervising it
+JOB_INGEST_SECONDS = 1
+# Python waits for the playbooks a process started to end before it exits, as their supervisors run in that process.
+# Only the web server and the manage.py commands here, which are meant to stay until their playbooks end, may start one:
+# runcrons moving the server, and the tests. Any other command is refused, see utils_jobs.submit
+JOB_COMMANDS = ["runserver", "runcrons", "test"]
+
+# The transition and prediction tables show this many rows per page. A rendered page is cached until a row changes
+TABLE_PAGE_SIZE = 25
+
+# The stock market chart shows SERIES_DAYS of readings unless asked for another range, downsampled to at most
+# SERIES_POINTS points per provider. Browsers may reuse a response for SERIES_CACHE_SECONDS. Every reading of a range
+# is loaded before it is downsampled, so ranges longer than SERIES_MAX_DAYS are refused.
+SERIES_DAYS = 7
+SERIES_MAX_DAYS = 366
+SERIES_POINTS = 500
+SERIES_MAX_POINTS = 5000
+SERIES_CACHE_SECONDS = 5 * 60
+
+# Release bundles built for new hosts by "manage.py release" are kept here, outside of what they pack. The newest
+# RELEASE_KEEP are kept so a bundle is only rebuilt when the code changes.
+RELEASE_DIR = os.path.join(os.path.dirname(BASE_DIR), "releases")
+RELEASE_KEEP = 3
+# Wheels of every pinned requirement are built here and shipped in the release bundle, so new hosts don't download them
+WHEELHOUSE_DIR = os.path.join(os.path.dirname(BASE_DIR), "wheelhouse")
 
 LOGIN_REDIRECT_URL = "/"
 LOGOUT_REDIRECT_URL = "/accounts/login"
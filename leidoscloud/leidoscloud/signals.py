@@ -0,0 +1,57 @@
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import utils_cache
+from .models import API, Key, PlaybookRun, PlaybookTask, Prediction, Transition
+
+
+# The current cloud host is matched against the API table, and the required keys are found by the name of the API they
+# belong to, so both are found again along with the provider lists
+@receiver(post_save, sender=API)
+@receiver(post_delete, sender=API)
+@receiver(post_save, sender=Key)
+@receiver(post_delete, sender=Key)
+def provider_changed(sender, **kwargs):
+    utils_cache.invalidate(utils_cache.PROVIDERS)
+
+
+# The index heading and transition table are built from the transitions, and the predictions table from predictions
+@receiver(post_save, sender=Transition)
+@receiver(post_delete, sender=Transition)
+def transition_changed(sender, **kwargs):
+    utils_cache.invalidate(utils_cache.TRANSITIONS)
+
+
+@receiver(post_save, sender=Prediction)
+@receiver(post_delete, sender=Prediction)
+def prediction_changed(sender, **kwargs):
+    utils_cache.invalidate(utils_cache.PREDICTIONS)
+
+
+# The progress shown while moving is built from the runs and their tasks, and the migration timings from the durations
+# of finished tasks. Queryset updates of runs invalidate RUNS themselves
+@receiver(post_save, sender=PlaybookRun)
+@receiver(post_delete, sender=PlaybookRun)
+def run_changed(sender, **kwargs):
+    utils_cache.invalidate(utils_cache.RUNS)
+
+
+@receiver(post_save, sender=PlaybookTask)
+@receiver(post_delete, sender=PlaybookTask)
+def task_changed(sender, instance, **kwargs):
+    groups = [utils_cache.RUNS]
+    if instance.duration is not None:
+        groups.append(utils_cache.TIMINGS)
+    utils_cache.invalidate(*groups)
+
+
+# SQLite's pragmas only last as long as the connection, so each new one is set up as the database profile asks
+@receiver(connection_created)
+def configure_sqlite(sender, connection, **kwargs):
+    if connection.vendor != "sqlite":
+        return
+    with connection.cursor() as cursor:
+        for name, value in settings.SQLITE_PRAGMAS.items():
+            cursor.execute("PRAGMA {} = {}".format(name, value))
@@ -0,0 +1,138 @@
+import gzip
+import io
+import os
+import struct
+import zlib
+
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+
+try:
+    import brotli
+except ImportError:
+    # Only gzip copies are written without it
+    brotli = None
+
+# Collected files worth compressing. Images and fonts are compressed already
+COMPRESS_EXTENSIONS = (".css", ".js", ".svg", ".json", ".map", ".txt", ".html", ".ico")
+# Smaller files don't get any smaller
+COMPRESS_MIN_BYTES = 256
+# Ancillary PNG chunks which change how an image looks. Every other ancillary chunk, such as text and timestamps, is
+# left out of optimised images
+PNG_KEEP_CHUNKS = {b"PLTE", b"tRNS", b"gAMA", b"cHRM", b"sRGB", b"iCCP", b"sBIT"}
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def _png_chunk(kind, data):
+    return (
+        struct.pack(">I", len(data))
+        + kind
+        + data
+        + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+    )
+
+
+def optimize_png(data):
+    """
+    Losslessly shrinks a PNG by compressing its pixels again at the highest zlib level and leaving out metadata
+    :param data: bytes of the PNG
+    :return: bytes of the optimised PNG, or data itself if it couldn't be made smaller or isn't a PNG
+    """
+    if not data.startswith(PNG_SIGNATURE):
+        return data
+    chunks = []
+    pixels = []
+    position = len(PNG_SIGNATURE)
+    try:
+        while position < len(data):
+            (length,) = struct.unpack(">I", data[position : position + 4])
+            kind = data[position + 4 : position + 8]
+            chunks.append((kind, data[position + 8 : position + 8 + length]))
+            position += 12 + length
+        for kind, chunk in chunks:
+            if kind == b"IDAT":
+                pixels.append(chunk)
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 15, 9)
+        compressed = (
+            compressor.compress(zlib.decompress(b"".join(pixels))) + compressor.flush()
+        )
+    except (struct.error, zlib.error):
+        return data
+
+    optimized = [PNG_SIGNATURE]
+    for kind, chunk in chunks:
+        if kind == b"IDAT":
+            # All of the pixels go in the first IDAT chunk
+            if compressed is not None:
+                optimized.append(_png_chunk(b"IDAT", compressed))
+                compressed = None
+        elif kind in (b"IHDR", b"IEND") or kind in PNG_KEEP_CHUNKS:
+            optimized.append(_png_chunk(kind, chunk))
+    optimized = b"".join(optimized)
+    return optimized if len(optimized) < len(data) else data
+
+
+class PrecompressedManifestStorage(ManifestStaticFilesStorage):
+    """
+    Static files storage which names collected files after a hash of their contents, like ManifestStaticFilesStorage.
+    Once they are collected, PNGs are optimised and gzip and brotli copies of text files are written next to them for
+    caddy to serve to browsers which accept them. Only the hashed copies are kept, so the contents of a URL under
+    STATIC_URL never change and caddy can tell browsers to keep them forever, see templates/cloud.conf.j2.
+
+    Pages rendered before collectstatic has been run, such as in development and the tests, link the files by their
+    own names.
+    """
+
+    def post_process(self, paths, dry_run=False, **options):
+        hashed = {}
+        for name, hashed_name, processed in super().post_process(
+            paths, dry_run, **options
+        ):
+            if hashed_name is not None and not isinstance(processed, Exception):
+                hashed[name] = hashed_name
+            yield name, hashed_name, processed
+        if dry_run:
+            return
+
+        for name, hashed_name in hashed.items():
+            path = self.path(hashed_name)
+            if hashed_name.lower().endswith(".png"):
+                self._optimize_png(path)
+            elif hashed_name.lower().endswith(COMPRESS_EXTENSIONS):
+                self._compress(path)
+            # Nothing links to the file by its own name any more
+            if hashed_name != name and self.exists(name):
+                self.delete(name)
+
+    def _optimize_png(self, path):
+        with open(path, "rb") as f:
+            data = f.read()
+        optimized = optimize_png(data)
+        if optimized is not data:
+            with open(path, "wb") as f:
+                f.write(optimized)
+
+    def _compress(self, path):
+        with open(path, "rb") as f:
+            data = f.read()
+        if len(data) < COMPRESS_MIN_BYTES:
+            return
+        # gzip.compress only takes an mtime from Python 3.8
+        buffer = io.BytesIO()
+        with gzip.GzipFile(filename="", fileobj=buffer, mode="wb", mtime=0) as f:
+            f.write(data)
+        copies = {".gz": buffer.getvalue()}
+        if brotli is not None:
+            copies[".br"] = brotli.compress(data, quality=11)
+        for extension, compressed in copies.items():
+            if len(compressed) < len(data):
+                with open(path + extension, "wb") as f:
+                    f.write(compressed)
+            elif os.path.exists(path + extension):
+                os.remove(path + extension)
+
+    def stored_name(self, name):
+        try:
+            return super().stored_name(name)
+        except ValueError:
+            # collectstatic hasn't been run, so the file only exists under its own name
+            return name
@@ -1,5 +1,9 @@
 from django import template
+from django.conf import settings
+from django.template.loader import render_to_string
+from leidoscloud import utils_cache
 from leidoscloud.models import *
+from leidoscloud.utils_pagination import cursor_parameter, keyset_page
 
 register = template.Library()
 
@@ -31,33 +35,78 @@ def nav_link(name, long_name):
     return {"name": name, "long_name": long_name}
 
 
-@register.inclusion_tag("tags/transition_table.html")
-def transition_table():
-    # get the fields from the table
-    fields = Transition._meta.get_fields()
-    names = []
-    # for each field, store it's string name in the list which will be passed
-    # into the context dictionary for the HTML template
-    for f in fields:
-        names.append(str(f.name))
+def _headings(model):
+    # The names of the columns stored for the model. Reverse relations such as Transition.runs aren't columns
+    return [str(f.name) for f in model._meta.concrete_fields]
 
-    return {
-        "headings": names,
-        "data": Transition.objects.order_by("-start_time"),
-    }
 
+def _render_table(template_name, groups, page, before, after):
+    # Renders a page of a table, or reuses the copy rendered for the same page while none of its rows have changed
+    return utils_cache.cached(
+        groups,
+        "{}:{}:{}".format(template_name, before, after),
+        lambda: render_to_string(template_name, page()),
+    )
 
-@register.inclusion_tag("tags/predictions_table.html")
-def predictions_table():
-    # get the fields from the table
-    fields = Prediction._meta.get_fields()
-    names = []
-    # for each field, store it's string name in the list which will be passed
-    # into the context dictionary for the HTML template
-    for f in fields:
-        names.append(str(f.name))
 
-    return {
-        "headings": names,
-        "data": Prediction.objects.order_by("-time"),
-    }
+@register.simple_tag(takes_context=True)
+def transition_table(context):
+    request = context.get("request")
+    before = cursor_parameter(request, "before")
+    after = cursor_parameter(request, "after")
+
+    def page():
+        # Only the columns shown are loaded, and the user and providers come in the same query
+        data = Transition.objects.select_related(
+            "user", "start_provider", "end_provider"
+        ).only(
+            "id",
+            "start_time",
+            "end_time",
+            "succeeded",
+            "deleted",
+            "user__username",
+            "start_provider__long_name",
+            "end_provider__long_name",
+        )
+        page = keyset_page(
+            data, "start_time", settings.TABLE_PAGE_SIZE, before=before, after=after
+        )
+        page["headings"] = _headings(Transition)
+        page["paged"] = before is not None or after is not None
+        return page
+
+    # The providers' names are shown too
+    return _render_table(
+        "tags/transition_table.html",
+        [utils_cache.TRANSITIONS, utils_cache.PROVIDERS],
+        page,
+        before,
+        after,
+    )
+
+
+@register.simple_tag(takes_context=True)
+def predictions_table(context):
+    request = context.get("request")
+    before = cursor_parameter(request, "before")
+    after = cursor_parameter(request, "after")
+
+    def page():
+        data = Prediction.objects.select_related("provider").only(
+            "id", "time", "strategy", "score", "provider__long_name"
+        )
+        page = keyset_page(
+            data, "time", settings.TABLE_PAGE_SIZE, before=before, after=after
+        )
+        page["headings"] = _headings(Prediction)
+        page["paged"] = before is not None or after is not None
+        return page
+
+    return _render_table(
+        "tags/predictions_table.html",
+        [utils_cache.PREDICTIONS, utils_cache.PROVIDERS],
+        page,
+        before,
+        after,
+    )
@@ -1,20 +1,87 @@
+import concurrent.futures
+import gzip
+import json
 import os
 import random
+import sqlite3
 import string
-from datetime import datetime
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
 from pathlib import Path
+from unittest import mock, skipUnless
+from urllib.parse import parse_qs, urlparse
 
+import numpy as np
+from django.apps import apps
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
 from django.template import Context, Template
-from django.test import TestCase
+from django.test import (
+    LiveServerTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
 from django.urls import reverse
 from django.utils import timezone
 from leidoscloud.models import *
 
-from . import utils_stock_api
+from . import (
+    signals,
+    storage,
+    utils_backtest,
+    utils_cache,
+    utils_dbbench,
+    utils_events,
+    utils_host,
+    utils_jobs,
+    utils_lease,
+    utils_loadtest,
+    utils_playbook,
+    utils_release,
+    utils_stock_api,
+    utils_strategies,
+    utils_vars,
+)
 from leidoscloud.utils_stock_api import save_stock_data, save_best_prediction
+from .django_cron import CheckHangingScripts, CloudSurfCron
 from .populate_db import populate
-from .utils_host import DELETE_LOG_TXT, MAIN_LOG_TXT
+from .utils_host import (
+    DELETE_LOG_TXT,
+    MAIN_LOG_TXT,
+    are_population_script_keys_present,
+    get_missing_keys,
+)
+from .utils_events import adopt_runs, ingest, phase_timings, progress
+from .utils_lease import (
+    acquire_lease,
+    break_lease,
+    hold_lease,
+    release_lease,
+    renew_lease,
+)
+from .utils_log import LogTailCache, status_events, status_from_line
+from .utils_series import lttb
+from .utils_strategies import (
+    ExponentialAverage,
+    MovingAverage,
+    STRATEGIES,
+    Strategy,
+    readings_matrix,
+    run_strategies,
+)
+from .utils_delete import _mark_deleted
 from .utils_playbook import (
     move_self,
     CloudSurfAlreadyInProgressException,
@@ -24,6 +91,17 @@ from .utils_playbook import (
 # Create your tests here.
 
 
+class ClearCacheMixin:
+    """
+    Clears the cache before each test. Pages and fragments cached by an earlier test were built from rows which have
+    been rolled back without sending any signals, so they would still be served
+    """
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+
 class TestRunnerTestTestCase(TestCase):
     def test_unit_tests_are_understood_and_can_pass(self):
         """Unit tests run and are able to pass"""
@@ -32,12 +110,13 @@ class TestRunnerTestTestCase(TestCase):
         self.assertEqual(test_value, 5)
 
 
-class TestIndexPage(TestCase):
+class TestIndexPage(ClearCacheMixin, TestCase):
     @classmethod
     def setUpClass(cls):
         super().setUpClass()
 
     def setUp(self):
+        super().setUp()
         user = User.objects.create(username="newtestuser")
         user.set_password("12345")
         user.save()
@@ -106,12 +185,13 @@ class TestIndexPage(TestCase):
         )
 
 
-class TestCloudsurfPage(TestCase):
+class TestCloudsurfPage(ClearCacheMixin, TestCase):
     @classmethod
     def setUpClass(cls):
         super().setUpClass()
 
     def setUp(self):
+        super().setUp()
         user = User.objects.create(username="newtestuser")
         user.set_password("12345")
         user.save()
@@ -151,7 +231,7 @@ class TestCloudsurfPage(TestCase):
         )
 
 
-class TestUtils(TestCase):
+class TestUtils(ClearCacheMixin, TestCase):
     def test_get_current_host_fails_when_population_script_not_run(self):
         from .utils_host import get_current_cloud_host
         from django.core.exceptions import ImproperlyConfigured
@@ -159,6 +239,17 @@ class TestUtils(TestCase):
         with self.assertRaises(ImproperlyConfigured):
             get_current_cloud_host()
 
+    def test_current_host_is_remembered_until_api_changes(self):
+        from .utils_host import get_current_cloud_host
+
+        populate()
+        host = get_current_cloud_host()
+        with self.assertNumQueries(0):
+            self.assertEqual(get_current_cloud_host(), host)
+        host.long_name = "Somewhere Else"
+        host.save()
+        self.assertEqual(get_current_cloud_host().long_name, "Somewhere Else")
+
 
 class TestModelsFundamentals(TestCase):
     # test that the api model allows instances to be created as expected
@@ -263,12 +354,13 @@ class TestModelsFundamentals(TestCase):
         self.assertIn(azure.long_name + " to " + start.long_name, str(t))
 
 
-class PlaybookUtilsTest(TestCase):
+class PlaybookUtilsTest(ClearCacheMixin, TestCase):
     @classmethod
     def setUpClass(cls):
         super().setUpClass()
 
     def setUp(self):
+        super().setUp()
         user = User.objects.create(username="newtestuser")
         user.set_password("12345")
         user.save()
@@ -300,6 +392,130 @@ class PlaybookUtilsTest(TestCase):
         move_self(target=end)
         self.assertRaises(CloudSurfAlreadyInProgressException, move_self, target=end)
 
+    def test_only_the_latest_transition_can_be_in_progress(self):
+        aws = API.objects.get(name="aws")
+        azure = API.objects.get(name="azure")
+        long_ago = timezone.now() - timedelta(days=2)
+        # A move which failed long ago left its transition open, and a later one finished
+        stale = Transition.objects.create(
+            start_provider=aws, end_provider=azure, start_time=long_ago
+        )
+        Transition.objects.create(
+            start_provider=azure,
+            end_provider=aws,
+            start_time=long_ago + timedelta(hours=1),
+            end_time=long_ago + timedelta(hours=2),
+        )
+        self.assertIsNone(utils_host.get_moving_transition())
+        self.assertEqual(
+            CheckHangingScripts().do(),
+            "Successfully checked for hanging scripts. None found.",
+        )
+        self.assertTrue(Transition.objects.filter(pk=stale.pk).exists())
+        move_self(target=API.objects.get(name="google"))
+        moving = Transition.objects.latest("start_time")
+        self.assertEqual(utils_host.get_moving_transition(), moving)
+        self.assertEqual(Transition.objects.filter(end_time__isnull=True).count(), 2)
+        with self.assertRaises(CloudSurfAlreadyInProgressException):
+            move_self(target=azure)
+
+    def start_hung_cloudsurf(self):
+        azure = API.objects.get(name="azure")
+        transition = Transition.objects.create(
+            start_provider=API.objects.get(name="aws"),
+            end_provider=azure,
+            start_time=timezone.now() - timedelta(minutes=90),
+        )
+        process = subprocess.Popen(
+            [sys.executable, "-c", "import time; time.sleep(30)"],
+            preexec_fn=os.setpgrp,
+        )
+        self.addCleanup(process.wait, 10)
+        run = PlaybookRun.objects.create(
+            transition=transition,
+            kind=PlaybookRun.DEPLOY,
+            status=PlaybookRun.RUNNING,
+            pid=process.pid,
+        )
+        return transition, run, process
+
+    def test_hung_cloudsurf_keeps_its_cancelled_run(self):
+        transition, run, process = self.start_hung_cloudsurf()
+        self.assertEqual(
+            CheckHangingScripts().do(),
+            "Attempt a move to azure because previous attempt failed!",
+        )
+        self.assertEqual(process.wait(10), -15)
+        run.refresh_from_db()
+        self.assertEqual(run.status, PlaybookRun.CANCELLED)
+        self.assertEqual(run.pid, process.pid)
+        # The hung transition is ended as failed rather than deleted, and the new attempt is the one moving
+        transition.refresh_from_db()
+        self.assertIsNotNone(transition.end_time)
+        self.assertFalse(transition.succeeded)
+        moving = utils_host.get_moving_transition()
+        self.assertNotEqual(moving, transition)
+        self.assertEqual(moving.end_provider.name, "azure")
+
+    def test_lease_is_exclusive(self):
+        lease = acquire_lease()
+        self.assertIsNotNone(lease)
+        self.assertIsNone(acquire_lease())
+        self.assertTrue(renew_lease(lease))
+        release_lease(lease)
+        # A lease that hasn't been renewed in time can be taken over, and the old owner can't renew it
+        lease = acquire_lease()
+        MigrationLease.objects.filter(pk=lease.pk).update(
+            expires_at=timezone.now() - timedelta(seconds=1)
+        )
+        second = acquire_lease()
+        self.assertNotEqual(second.owner, lease.owner)
+        self.assertFalse(renew_lease(lease))
+        release_lease(lease)
+        self.assertIsNone(acquire_lease())
+        break_lease()
+        self.assertIsNotNone(acquire_lease())
+
+    def test_simultaneous_cloudsurfs_start_once(self):
+        end = API.objects.get(name="azure", is_provider=True)
+        original = utils_playbook._start_move
+        racing = []
+
+        def start_move(target, user, lease):
+            # Another worker tries to CloudSurf while this one is between checking and creating the transition
+            with self.assertRaises(CloudSurfAlreadyInProgressException):
+                move_self(target=target)
+            racing.append(target)
+            return original(target, user, lease)
+
+        with mock.patch.object(utils_playbook, "_start_move", start_move):
+            move_self(target=end)
+        self.assertEqual(racing, [end])
+        self.assertEqual(Transition.objects.count(), 1)
+        # The lease records the transition and is given back when no playbook was started
+        self.assertEqual(MigrationLease.objects.get().owner, "")
+        self.assertEqual(
+            MigrationLease.objects.get().transition, Transition.objects.get()
+        )
+
+    @override_settings(LEASE_HEARTBEAT_SECONDS=0.01)
+    def test_lease_is_held_while_playbook_runs(self):
+        lease = acquire_lease()
+        job = concurrent.futures.Future()
+
+        def renew(held):
+            # The playbook finishes after two heartbeats
+            if renew.call_count == 2:
+                job.set_result(0)
+            return True
+
+        with mock.patch.object(
+            utils_lease, "renew_lease", side_effect=renew
+        ) as renew, mock.patch.object(utils_lease, "release_lease") as release:
+            hold_lease(lease, job).join(5)
+        self.assertEqual(renew.call_count, 2)
+        release.assert_called_once_with(lease)
+
     def test_cloudsurfing_twice_will_fail(self):
         first_google = self.client.get(reverse("google"), follow=True)
         self.assertContains(first_google, "Moving to")
@@ -315,12 +531,13 @@ class PlaybookUtilsTest(TestCase):
         pass
 
 
-class TemplateTagsTests(TestCase):
+class TemplateTagsTests(ClearCacheMixin, TestCase):
     @classmethod
     def setUpClass(cls):
         super().setUpClass()
 
     def setUp(self):
+        super().setUp()
         user = User.objects.create(username="newtestuser")
         user.set_password("12345")
         user.save()
@@ -449,6 +666,88 @@ class TemplateTagsTests(TestCase):
             "  <td>False</td>", str(response.content),
         )
 
+    def create_transitions(self, count):
+        user = User.objects.create_user("Aidan")
+        azure = API.objects.get(name="azure")
+        google_cloud = API.objects.get(name="google")
+        time = timezone.now()
+        Transition.objects.bulk_create(
+            Transition(
+                user=user,
+                start_time=time - timedelta(minutes=i // 2),
+                end_time=time,
+                start_provider=azure,
+                end_provider=google_cloud,
+            )
+            for i in range(count)
+        )
+        return list(Transition.objects.order_by("-start_time", "-id"))
+
+    def test_table_pages(self):
+        # Pairs of transitions share a start time, so the pages have to be split by id too
+        transitions = self.create_transitions(settings.TABLE_PAGE_SIZE * 2 + 5)
+        ids = [t.id for t in transitions]
+        seen = []
+        url = reverse("index")
+        while url:
+            response = self.client.get(url)
+            seen += [t.id for t in response.context["rows"]]
+            older = response.context["older"]
+            url = (
+                None if older is None else reverse("index") + "?before={}".format(older)
+            )
+        self.assertEqual(seen, ids)
+
+        # Going back to newer rows gives the same pages
+        last = ids[settings.TABLE_PAGE_SIZE * 2]
+        response = self.client.get(reverse("index") + "?after={}".format(last))
+        self.assertEqual(
+            [t.id for t in response.context["rows"]],
+            ids[settings.TABLE_PAGE_SIZE : settings.TABLE_PAGE_SIZE * 2],
+        )
+        self.assertEqual(response.context["newer"], ids[settings.TABLE_PAGE_SIZE])
+
+    def test_table_queries_do_not_grow_with_rows(self):
+        self.create_transitions(settings.TABLE_PAGE_SIZE * 3)
+        template = Template(
+            "{% load leidoscloud_template_tags %}{% transition_table %}"
+        )
+        # The page with its users and providers
+        with self.assertNumQueries(1):
+            html = template.render(Context({}))
+        self.assertEqual(html.count("<td>Aidan</td>"), settings.TABLE_PAGE_SIZE)
+        # Rendered again from the cache without touching the database
+        with self.assertNumQueries(0):
+            self.assertEqual(template.render(Context({})), html)
+
+    def test_table_cache_follows_newest_transition(self):
+        transition = self.create_transitions(1)[0]
+        template = Template(
+            "{% load leidoscloud_template_tags %}{% transition_table %}"
+        )
+        self.assertInHTML("<td>False</td>", template.render(Context({})), count=2)
+        transition.succeeded = True
+        transition.save()
+        self.assertInHTML("<td>True</td>", template.render(Context({})), count=1)
+
+    def test_predictions_table_pages(self):
+        google_cloud = API.objects.get(name="google")
+        time = timezone.now()
+        Prediction.objects.bulk_create(
+            Prediction(provider=google_cloud, time=time - timedelta(hours=i))
+            for i in range(settings.TABLE_PAGE_SIZE + 1)
+        )
+        response = self.client.get(reverse("predictions"))
+        self.assertEqual(len(response.context["rows"]), settings.TABLE_PAGE_SIZE)
+        self.assertContains(response, "Older")
+        oldest = Prediction.objects.earliest("time")
+        response = self.client.get(
+            reverse("predictions") + "?before={}".format(response.context["older"])
+        )
+        self.assertEqual(list(response.context["rows"]), [oldest])
+        self.assertIsNone(response.context["older"])
+        self.assertContains(response, "Latest")
+
 
 class TestUtilsStockAPI(TestCase):
     def test_provider_objects(self):
@@ -476,12 +775,197 @@ class TestUtilsStockAPI(TestCase):
         self.assertEqual(retrieved_key, alpha_key.value)
 
 
-class TestKeyAlert(TestCase):
+class QuoteHandler(BaseHTTPRequestHandler):
+    # Stands in for Alpha Vantage. Every quote takes QUOTE_DELAY seconds, or longer for SLOW_SYMBOLS.
+    QUOTE_DELAY = 0.3
+    SLOW_SYMBOLS = []
+    CHANGES = {"GOOG": "-1.5%", "MSFT": "0.25%", "AMZN": "2.0%"}
+    requested = []
+
+    def do_GET(self):
+        symbol = parse_qs(urlparse(self.path).query)["symbol"][0]
+        self.requested.append(symbol)
+        time.sleep(self.QUOTE_DELAY * (10 if symbol in self.SLOW_SYMBOLS else 1))
+        body = json.dumps(
+            {"Global Quote": {"10. change percent": self.CHANGES[symbol]}}
+        )
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def log_message(self, *args):
+        pass
+
+
+class TestConcurrentQuotes(TestCase):
     @classmethod
     def setUpClass(cls):
         super().setUpClass()
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), QuoteHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = "http://127.0.0.1:{}/query".format(cls.server.server_port)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
 
     def setUp(self):
+        populate()
+        self.providers = API.objects.filter(is_provider=True)
+        patcher = mock.patch.object(utils_stock_api, "ALPHA_VANTAGE_URL", self.url)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_quotes_are_fetched_concurrently(self):
+        started = time.monotonic()
+        stock_dict, symbols = utils_stock_api.get_cloud_target(self.providers, "demo")
+        self.assertLess(time.monotonic() - started, QuoteHandler.QUOTE_DELAY * 2)
+        self.assertEqual(stock_dict, {"google": -1.5, "azure": 0.25, "aws": 2.0})
+        self.assertEqual(
+            utils_stock_api.process_api_json(stock_dict, symbols).name, "google"
+        )
+
+    @mock.patch.object(QuoteHandler, "SLOW_SYMBOLS", ["AMZN"])
+    @mock.patch.object(utils_stock_api, "QUOTE_DEADLINE_SECONDS", 1)
+    def test_deadline_and_partial_results(self):
+        with self.assertRaises(ConnectionError):
+            utils_stock_api.get_cloud_target(self.providers, "demo")
+        stock_dict, symbols = utils_stock_api.get_cloud_target(
+            self.providers, "demo", partial=True
+        )
+        self.assertEqual(stock_dict, {"google": -1.5, "azure": 0.25})
+
+    def test_fresh_quotes_come_from_the_cache(self):
+        utils_stock_api.get_cloud_target(self.providers, "demo")
+        QuoteHandler.requested.clear()
+        stock_dict, symbols = utils_stock_api.get_cloud_target(self.providers, "demo")
+        self.assertEqual(QuoteHandler.requested, [])
+        self.assertEqual(stock_dict["google"], -1.5)
+
+    def test_stale_quotes_are_used_when_rate_limited(self):
+        utils_stock_api.get_cloud_target(self.providers, "demo")
+        QuoteCache.objects.update(
+            fetched_at=timezone.now() - timedelta(seconds=settings.QUOTE_TTL_SECONDS)
+        )
+        utils_stock_api.drain_tokens(utils_stock_api.QUOTE_BUCKET)
+        QuoteHandler.requested.clear()
+        stock_dict, symbols = utils_stock_api.get_cloud_target(self.providers, "demo")
+        self.assertEqual(QuoteHandler.requested, [])
+        self.assertEqual(stock_dict["aws"], 2.0)
+
+        # Once the quotes are too old to use, the rate limit is reported
+        QuoteCache.objects.update(fetched_at=timezone.now() - timedelta(days=1))
+        with self.assertRaises(utils_stock_api.RateLimitedError):
+            utils_stock_api.get_cloud_target(self.providers, "demo")
+
+    def test_token_bucket_refills_over_time(self):
+        self.assertEqual(utils_stock_api.acquire_tokens("test", 10, 5, 12), 5)
+        self.assertEqual(utils_stock_api.acquire_tokens("test", 1, 5, 12), 0)
+        RateLimitBucket.objects.filter(name="test").update(
+            updated_at=timezone.now() - timedelta(seconds=25)
+        )
+        self.assertEqual(utils_stock_api.acquire_tokens("test", 10, 5, 12), 2)
+
+    def test_tokens_are_not_taken_from_a_changed_bucket(self):
+        utils_stock_api.acquire_tokens("test", 1, 5, 12)
+        get_or_create = RateLimitBucket.objects.get_or_create
+        reads = []
+
+        def drained_after_reading(**kwargs):
+            bucket = get_or_create(**kwargs)
+            # Another process empties the bucket between the first read and the update
+            if not reads:
+                utils_stock_api.drain_tokens("test")
+            reads.append(bucket[0].version)
+            return bucket
+
+        with mock.patch.object(
+            RateLimitBucket.objects, "get_or_create", side_effect=drained_after_reading
+        ):
+            self.assertEqual(utils_stock_api.acquire_tokens("test", 10, 5, 12), 0)
+        self.assertEqual(reads, [1, 2])
+        self.assertEqual(RateLimitBucket.objects.get(name="test").version, 3)
+
+    def test_cron_defers_quotes_until_the_rate_limit_allows(self):
+        # Another process has just spent every token
+        utils_stock_api.acquire_tokens(
+            utils_stock_api.QUOTE_BUCKET,
+            settings.QUOTE_RATE_CAPACITY,
+            settings.QUOTE_RATE_CAPACITY,
+            settings.QUOTE_RATE_REFILL_SECONDS,
+        )
+        QuoteHandler.requested.clear()
+        # Nothing is cached yet, so there is nothing to fall back on
+        with self.assertRaises(utils_stock_api.RateLimitedError) as raised:
+            utils_stock_api.get_cloud_target(self.providers, "demo")
+        self.assertAlmostEqual(
+            (raised.exception.retry_at - timezone.now()).total_seconds(),
+            settings.QUOTE_RATE_REFILL_SECONDS,
+            delta=1,
+        )
+        # The cron leaves the decision to a later run instead of failing
+        message = CloudSurfCron().do()
+        self.assertTrue(message.startswith("Deferred until"), message)
+        self.assertEqual(QuoteHandler.requested, [])
+        self.assertFalse(StockData.objects.exists())
+
+        # Once the bucket has refilled, the next run fetches the quotes and decides
+        RateLimitBucket.objects.filter(name=utils_stock_api.QUOTE_BUCKET).update(
+            updated_at=timezone.now() - timedelta(minutes=1)
+        )
+        self.assertEqual(
+            CloudSurfCron().do(),
+            "Attempt a move to google because they have had the largest loss/least gain!",
+        )
+        self.assertEqual(len(QuoteHandler.requested), 3)
+
+    def test_stale_quotes_are_used_when_another_process_takes_the_tokens(self):
+        utils_stock_api.get_cloud_target(self.providers, "demo")
+        QuoteCache.objects.update(
+            fetched_at=timezone.now() - timedelta(seconds=settings.QUOTE_TTL_SECONDS)
+        )
+        RateLimitBucket.objects.filter(name=utils_stock_api.QUOTE_BUCKET).update(
+            tokens=settings.QUOTE_RATE_CAPACITY, updated_at=timezone.now()
+        )
+        get_or_create = RateLimitBucket.objects.get_or_create
+        reads = []
+
+        def taken_after_reading(**kwargs):
+            bucket = get_or_create(**kwargs)
+            # The cron takes all but one token between the first read and the update
+            if not reads:
+                RateLimitBucket.objects.filter(pk=bucket[0].pk).update(
+                    tokens=1, version=bucket[0].version + 1
+                )
+            reads.append(bucket[0].version)
+            return bucket
+
+        QuoteHandler.requested.clear()
+        started = time.monotonic()
+        with mock.patch.object(
+            RateLimitBucket.objects, "get_or_create", side_effect=taken_after_reading
+        ):
+            stock_dict, symbols = utils_stock_api.get_cloud_target(
+                self.providers, "demo"
+            )
+        # Nothing waits for the bucket to refill. The quotes which couldn't be fetched are the stale ones
+        self.assertLess(time.monotonic() - started, QuoteHandler.QUOTE_DELAY * 2)
+        self.assertEqual(len(reads), 2)
+        self.assertEqual(len(QuoteHandler.requested), 1)
+        self.assertEqual(stock_dict, {"google": -1.5, "azure": 0.25, "aws": 2.0})
+
+
+class TestKeyAlert(ClearCacheMixin, TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+
+    def setUp(self):
+        super().setUp()
         user = User.objects.create(username="newtestuser")
         user.set_password("12345")
         user.save()
@@ -510,6 +994,31 @@ class TestKeyAlert(TestCase):
             response, " Please enter all needed keys in the admin page."
         )
 
+    def test_missing_keys_are_listed_and_checked_once(self):
+        populate()
+        for key in Key.objects.exclude(name="access_key"):
+            key.value = "asdf"
+            key.save()
+        self.assertEqual(get_missing_keys(), [("aws", "access_key")])
+        with self.assertNumQueries(0):
+            self.assertFalse(are_population_script_keys_present())
+        response = self.client.get(reverse("index"), follow=True)
+        self.assertContains(response, "Missing: aws access_key")
+
+        key = Key.objects.get(name="access_key")
+        key.value = "asdf"
+        key.save()
+        self.assertTrue(are_population_script_keys_present())
+
+    def test_keys_saved_by_another_process_are_seen(self):
+        populate()
+        self.assertIn(("aws", "access_key"), get_missing_keys())
+        # The admin in another worker saves the key. Its signal starts a new generation in the shared cache
+        Key.objects.filter(name="access_key").update(value="asdf")
+        self.assertIn(("aws", "access_key"), get_missing_keys())
+        utils_cache.invalidate(utils_cache.PROVIDERS)
+        self.assertNotIn(("aws", "access_key"), get_missing_keys())
+
     def test_having_keys_hides_alert(self):
         populate()
         aws = API.objects.filter(name="aws")[0]
@@ -555,12 +1064,13 @@ class TestKeyAlert(TestCase):
         )
 
 
-class TestFullLog(TestCase):
+class TestFullLog(ClearCacheMixin, TestCase):
     @classmethod
     def setUpClass(cls):
         super().setUpClass()
 
     def setUp(self):
+        super().setUp()
         user = User.objects.create(username="newtestuser")
         user.set_password("12345")
         user.save()
@@ -731,7 +1241,456 @@ class TestFullLog(TestCase):
         self.assertContains(response, "2021-01-17T17:02:01")
 
 
-class TestLoginFunctionality(TestCase):
+class TestFullLogPages(ClearCacheMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        user = User.objects.create(username="newtestuser")
+        user.set_password("12345")
+        user.save()
+        self.client.login(username="newtestuser", password="12345")
+        if Path(MAIN_LOG_TXT).exists():
+            os.remove(MAIN_LOG_TXT)
+        with open(MAIN_LOG_TXT, "w+") as f:
+            for i in range(2000):
+                f.write("line number {}\n".format(i))
+
+    def test_tail_shows_only_the_last_lines(self):
+        response = self.client.get(reverse("log"), {"tail": 3})
+        self.assertEqual(
+            response.context["contents"],
+            "line number 1997\nline number 1998\nline number 1999\n",
+        )
+        self.assertIsNotNone(response.context["previous_offset"])
+        self.assertIsNone(response.context["next_offset"])
+
+    def test_page_starts_on_a_whole_line(self):
+        response = self.client.get(reverse("log"), {"offset": 3, "length": 20})
+        self.assertTrue(response.context["contents"].startswith("line number 1\n"))
+        self.assertTrue(response.context["contents"].endswith("\n"))
+        self.assertNotContains(response, "line number 1999")
+        self.assertEqual(response.context["previous_offset"], 0)
+
+    def test_empty_pages_are_not_asked_for(self):
+        response = self.client.get(reverse("log"), {"offset": 500, "length": 0})
+        self.assertEqual(response.context["length"], 1)
+        self.assertLess(response.context["previous_offset"], 500)
+        self.assertGreater(response.context["next_offset"], 500)
+
+    def test_download_streams_gzipped_log(self):
+        response = self.client.get(
+            reverse("log"), {"download": ""}, HTTP_ACCEPT_ENCODING="gzip"
+        )
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        log = gzip.decompress(b"".join(response.streaming_content)).decode()
+        with open(MAIN_LOG_TXT) as f:
+            self.assertEqual(log, f.read())
+
+
+class TestLogTailCache(TestCase):
+    def setUp(self):
+        self.log_path = os.path.join(tempfile.mkdtemp(), "ansible.log")
+        with open(self.log_path, "w") as f:
+            f.write(
+                "2020-01-17 17:02:11,307 p=miles u=14825 | ok: [localhost]\n2020-01-17 17:02:11,326 p=miles u=14825 | "
+                "TASK [Load in the SSH public key]\nasdf\n"
+            )
+        self.cache = LogTailCache(self.log_path)
+
+    def test_only_appended_bytes_are_parsed(self):
+        line, offset, date = self.cache.latest()
+        self.assertIn("Load in the SSH public key", line)
+        cursor = self.cache.cursor
+        with open(self.log_path, "a") as f:
+            f.write(
+                "2020-01-17 17:02:12,001 p=miles u=14825 | TASK [Updating apt cache]\n"
+            )
+        line, offset, date = self.cache.latest()
+        self.assertIn("Updating apt cache", line)
+        self.assertEqual(offset, cursor)
+        self.assertEqual(date, datetime(2020, 1, 17, 17, 2, 1))
+
+    def test_unchanged_log_is_served_from_cache(self):
+        first = self.cache.latest()
+        with mock.patch("builtins.open") as mocked_open:
+            self.assertEqual(self.cache.latest(), first)
+            mocked_open.assert_not_called()
+
+    def test_fatal_after_task_is_reported(self):
+        with open(self.log_path, "a") as f:
+            f.write(
+                "2020-01-17 17:02:12,001 p=miles u=14825 | fatal: [localhost]: FAILED!"
+            )
+        line, offset, date = self.cache.latest()
+        self.assertIn("status", status_from_line(line, date))
+        self.assertIn("fatal", status_from_line(line, date)["error"])
+
+    def test_replaced_log_is_read_again(self):
+        self.cache.latest()
+        os.remove(self.log_path)
+        with open(self.log_path, "w") as f:
+            f.write(
+                "2021-01-17 17:02:11,326 p=miles u=14825 | TASK [Copying self to server]\n"
+            )
+        line, offset, date = self.cache.latest()
+        self.assertIn("Copying self to server", line)
+        self.assertEqual(offset, 0)
+
+    def test_truncated_log_is_read_again_from_the_start(self):
+        self.cache.latest()
+        cursor = self.cache.cursor
+        # Truncated in place and grown past what was read before
+        task = (
+            "2021-01-17 17:02:11,326 p=miles u=14825 | "
+            "TASK [Copying self to server]\n"
+        )
+        with open(self.log_path, "w") as f:
+            f.write(task + "x" * cursor + "\n")
+        line, offset, date = self.cache.latest()
+        self.assertIn("Copying self to server", line)
+        self.assertEqual(offset, 0)
+
+    def test_log_rewritten_with_an_older_mtime_is_read_again(self):
+        first = "2020-01-17 17:02:11,326 p=miles u=14825 | TASK [first]\n"
+        second = "2020-01-17 17:02:12,326 p=miles u=14825 | TASK [second]\n"
+        filler = "x" * 200 + "\n"
+        with open(self.log_path, "w") as f:
+            f.write(first + filler)
+        self.cache.latest()
+        mtime_ns = os.stat(self.log_path).st_mtime_ns
+        # The remembered line and the bytes before the cursor are where they were, so only the mtime gives it away
+        with open(self.log_path, "w") as f:
+            f.write(first + second + filler[len(second) :] + "more\n")
+        os.utime(self.log_path, ns=(mtime_ns, mtime_ns - 1000000000))
+        line, offset, date = self.cache.latest()
+        self.assertIn("second", line)
+        self.assertEqual(offset, len(first))
+
+
+class TestStatusStream(ClearCacheMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        user = User.objects.create(username="newtestuser")
+        user.set_password("12345")
+        user.save()
+        self.client.login(username="newtestuser", password="12345")
+        if Path(MAIN_LOG_TXT).exists():
+            os.remove(MAIN_LOG_TXT)
+        with open(MAIN_LOG_TXT, "w+") as f:
+            f.write(
+                "2020-01-17 17:02:11,326 p=miles u=14825 | TASK [Load in the SSH public key]\nasdf\n"
+            )
+
+    def test_stream_pushes_current_status(self):
+        response = self.client.get(reverse("status_stream"))
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        chunks = iter(response.streaming_content)
+        self.assertIn(b"retry:", next(chunks))
+        event = next(chunks)
+        response.close()
+        self.assertIn(b"event: status", event)
+        self.assertIn(b"Load in the SSH public key", event)
+
+    @override_settings(STREAM_MAX_CONNECTIONS=2)
+    def test_streams_are_capped(self):
+        first = self.client.get(reverse("status_stream"))
+        second = self.client.get(reverse("status_stream"))
+        self.assertEqual(second.status_code, 200)
+        # Further browsers are refused so they poll, leaving threads for other requests
+        self.assertEqual(self.client.get(reverse("status_stream")).status_code, 503)
+        self.assertEqual(self.client.get(reverse("status")).status_code, 200)
+        # A stream which never sent anything still gives its slot back
+        first.close()
+        third = self.client.get(reverse("status_stream"))
+        self.assertEqual(third.status_code, 200)
+        second.close()
+        third.close()
+
+    @mock.patch("leidoscloud.utils_log.STREAM_POLL_SECONDS", 0)
+    @mock.patch("leidoscloud.utils_log.STREAM_KEEPALIVE_SECONDS", 0)
+    def test_stream_resumes_from_last_event_id(self):
+        events = status_events(MAIN_LOG_TXT)
+        next(events)
+        event_id = next(events).split("\n")[0][len("id: ") :]
+        events.close()
+
+        # Nothing has happened since the last event, so only a keepalive is sent
+        events = status_events(MAIN_LOG_TXT, last_event_id=event_id)
+        next(events)
+        self.assertEqual(next(events), ": keepalive\n\n")
+        with open(MAIN_LOG_TXT, "a") as f:
+            f.write(
+                "2020-01-17 17:02:12,001 p=miles u=14825 | TASK [Updating apt cache]\n"
+            )
+        self.assertIn("Updating apt cache", next(events))
+        events.close()
+
+
+class TestPlaybookEvents(ClearCacheMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        populate()
+        self.transition = Transition.objects.create(
+            start_provider=API.objects.get(name="azure"),
+            end_provider=API.objects.get(name="google"),
+        )
+        self.run = PlaybookRun.objects.create(
+            transition=self.transition,
+            kind=PlaybookRun.DEPLOY,
+            event_log=os.path.join(tempfile.mkdtemp(), "events.ndjson"),
+        )
+
+    def write_events(self, *events):
+        with open(self.run.event_log, "a") as f:
+            for event in events:
+                f.write(json.dumps(event) + "\n")
+
+    def test_progress_is_read_incrementally(self):
+        self.write_events(
+            {"event": "playbook_start", "time": 100.0, "tasks": 3},
+            {
+                "event": "task_start",
+                "time": 100.0,
+                "uuid": "a",
+                "task": "Generating keys",
+            },
+            {"event": "task_end", "time": 104.0, "uuid": "a", "status": "ok"},
+            {"event": "task_start", "time": 104.0, "uuid": "b", "task": "apt update"},
+        )
+        self.assertEqual(ingest(self.run), 4)
+        self.assertEqual(ingest(self.run), 0)
+        summary = progress(self.run)
+        self.assertEqual(summary["current"], "apt update")
+        self.assertEqual(summary["done"], 1)
+        self.assertEqual(summary["total"], 3)
+        self.assertEqual(summary["elapsed"][0], ("Generating keys", 4.0))
+        self.assertIsNone(summary["first_failure"])
+        # Nothing supervises this run, so its events finish it
+        self.write_events({"event": "playbook_end", "time": 110.0, "failed": True})
+        ingest(self.run)
+        self.run.refresh_from_db()
+        self.assertTrue(progress(self.run)["finished"])
+        self.assertTrue(self.run.failed)
+
+    def timed_run(self, provider, durations):
+        transition = Transition.objects.create(
+            start_provider=API.objects.get(name="azure"),
+            end_provider=API.objects.get(name=provider),
+        )
+        run = PlaybookRun.objects.create(transition=transition, kind=PlaybookRun.DEPLOY)
+        start = timezone.now()
+        for position, (name, seconds) in enumerate(durations, 1):
+            PlaybookTask.objects.create(
+                run=run,
+                position=position,
+                uuid=name,
+                name=name,
+                status="ok",
+                start_time=start,
+                end_time=start + timedelta(seconds=seconds),
+                duration=seconds,
+            )
+        return transition
+
+    def test_task_durations_are_stored(self):
+        self.write_events(
+            {"event": "task_start", "time": 100.0, "uuid": "a", "task": "pip"},
+            {"event": "task_end", "time": 112.5, "uuid": "a", "status": "ok"},
+        )
+        ingest(self.run)
+        self.assertEqual(self.run.tasks.get().duration, 12.5)
+
+    def test_phase_timings_per_provider(self):
+        for seconds in range(1, 21):
+            self.timed_run(
+                "google", [("Generating keys", 2), ("Copying self to server", seconds)]
+            )
+        self.timed_run("aws", [("Copying self to server", 30)])
+        timings = {t["provider"]: t["phases"] for t in phase_timings()}
+        self.assertEqual(set(timings), {"Google Cloud", "Amazon Web Services"})
+        keys, copying = timings["Google Cloud"]
+        # Phases are in the order they run
+        self.assertEqual(keys["name"], "Generating keys")
+        self.assertEqual(keys["p95"], 2)
+        self.assertEqual(copying["runs"], 20)
+        self.assertEqual(copying["p50"], 10.5)
+        self.assertAlmostEqual(copying["p95"], 19.05)
+        self.assertEqual(timings["Amazon Web Services"][0]["p50"], 30)
+
+        user = User.objects.create(username="newtestuser")
+        user.set_password("12345")
+        user.save()
+        self.client.login(username="newtestuser", password="12345")
+        response = self.client.get(reverse("timings"))
+        self.assertContains(response, "Moving to Google Cloud")
+        self.assertInHTML("<td>19.1</td>", response.content.decode())
+
+        # The timings are cached until another task finishes, and viewing them never reads events
+        with mock.patch.object(utils_events, "ingest") as ingest_mock:
+            with self.assertNumQueries(2):
+                self.client.get(reverse("timings"))
+        ingest_mock.assert_not_called()
+        self.timed_run("azure", [("Generating keys", 5)])
+        self.assertContains(
+            self.client.get(reverse("timings")), "Moving to Microsoft Azure"
+        )
+
+    def test_hung_migration_timings_are_kept(self):
+        Transition.objects.filter(pk=self.transition.pk).update(
+            start_time=timezone.now() - timedelta(days=1), end_time=timezone.now()
+        )
+        hung = self.timed_run("azure", [("Copying self to server", 3600)])
+        Transition.objects.filter(pk=hung.pk).update(
+            start_time=timezone.now() - timedelta(minutes=90)
+        )
+        user = User.objects.create(username="newtestuser")
+        user.set_password("12345")
+        user.save()
+        self.client.login(username="newtestuser", password="12345")
+
+        CheckHangingScripts().do()
+        self.assertEqual(hung.runs.get().status, PlaybookRun.CANCELLED)
+        # The slowest attempts are the ones the timings are there to show
+        response = self.client.get(reverse("timings"))
+        timings = {t["provider"]: t["phases"] for t in response.context["timings"]}
+        self.assertEqual(timings["Microsoft Azure"][0]["p95"], 3600)
+        self.assertContains(response, "3600.0")
+
+    def test_copied_event_log_is_adopted(self):
+        # The database copied to the new host still points at the event log on the old one
+        events_dir = tempfile.mkdtemp()
+        self.write_events(
+            {"event": "task_start", "time": 100.0, "uuid": "a", "task": "apt update"},
+            {"event": "task_end", "time": 130.0, "uuid": "a", "status": "ok"},
+        )
+        copied = os.path.join(events_dir, os.path.basename(self.run.event_log))
+        os.rename(self.run.event_log, copied)
+        with mock.patch("leidoscloud.utils_events.EVENTS_DIR", events_dir):
+            self.assertEqual(adopt_runs(self.transition), 2)
+        self.run.refresh_from_db()
+        self.assertEqual(self.run.event_log, copied)
+        self.assertEqual(self.run.tasks.get().duration, 30)
+
+    def test_ingest_events_ends_the_migration_run(self):
+        events_dir = tempfile.mkdtemp()
+        self.write_events(
+            {"event": "task_start", "time": 100.0, "uuid": "a", "task": "Caddy"},
+            {"event": "task_end", "time": 130.0, "uuid": "a", "status": "ok"},
+            {"event": "task_start", "time": 130.0, "uuid": "b", "task": "Copying"},
+        )
+        os.rename(
+            self.run.event_log,
+            os.path.join(events_dir, os.path.basename(self.run.event_log)),
+        )
+        out = StringIO()
+        with mock.patch("leidoscloud.utils_events.EVENTS_DIR", events_dir):
+            call_command("ingest_events", stdout=out)
+        self.assertIn("Read 3 events and ended 1 runs", out.getvalue())
+        self.run.refresh_from_db()
+        self.assertEqual(self.run.status, PlaybookRun.SUCCEEDED)
+        self.assertFalse(self.run.failed)
+        self.assertIsNotNone(self.run.end_time)
+        self.assertFalse(self.run.tasks.filter(duration__isnull=True).exists())
+        self.assertEqual(self.run.tasks.get(uuid="a").duration, 30)
+
+    def test_first_failure_and_partial_lines(self):
+        self.write_events(
+            {"event": "task_start", "time": 100.0, "uuid": "a", "task": "pip"},
+            {
+                "event": "task_end",
+                "time": 101.0,
+                "uuid": "a",
+                "status": "failed",
+                "msg": "no",
+            },
+            {"event": "task_start", "time": 101.0, "uuid": "b", "task": "caddy"},
+        )
+        with open(self.run.event_log, "a") as f:
+            f.write('{"event": "task_end", "time": 102.0, "uu')
+        ingest(self.run)
+        summary = progress(self.run)
+        self.assertEqual(summary["first_failure"], {"task": "pip", "msg": "no"})
+        self.assertEqual(PlaybookTask.objects.get(uuid="b").status, "running")
+
+    def test_status_includes_progress_while_moving(self):
+        user = User.objects.create(username="newtestuser")
+        user.set_password("12345")
+        user.save()
+        self.client.login(username="newtestuser", password="12345")
+        with open(MAIN_LOG_TXT, "w+") as f:
+            f.write("2020-01-17 17:02:11,326 p=miles u=14825 | TASK [pip]\n")
+        self.write_events(
+            {"event": "playbook_start", "time": 100.0, "tasks": 3},
+            {"event": "task_start", "time": 100.0, "uuid": "a", "task": "pip"},
+        )
+        ingest(self.run)
+        response = self.client.get(reverse("status"))
+        self.assertEqual(response.json()["progress"]["current"], "pip")
+        # Polls only read what the job runner has stored
+        self.write_events(
+            {"event": "task_start", "time": 101.0, "uuid": "b", "task": "caddy"}
+        )
+        response = self.client.get(reverse("status"))
+        self.assertEqual(response.json()["progress"]["current"], "pip")
+        self.assertEqual(self.run.tasks.count(), 1)
+        # Until something changes, polls don't query the database for the progress
+        with self.assertNumQueries(0):
+            self.assertEqual(utils_events.moving_progress()["current"], "pip")
+        ingest(self.run)
+        self.assertEqual(utils_events.moving_progress()["current"], "caddy")
+        self.write_events({"event": "playbook_end", "time": 110.0, "failed": False})
+        ingest(self.run)
+        self.assertTrue(utils_events.moving_progress()["finished"])
+        self.transition.end_time = timezone.now()
+        self.transition.save()
+        self.assertIsNone(utils_events.moving_progress())
+
+    def test_racing_readers_store_events_once(self):
+        self.write_events(
+            {"event": "playbook_start", "time": 100.0, "tasks": 3},
+            {"event": "task_start", "time": 100.0, "uuid": "a", "task": "pip"},
+        )
+        read_events = utils_events._read_events
+
+        def read_then_lose_race(path, offset):
+            # Another reader stores the same lines between this one reading and claiming them
+            result = read_events(path, offset)
+            patcher.stop()
+            self.assertEqual(ingest(PlaybookRun.objects.get(pk=self.run.pk)), 2)
+            return result
+
+        patcher = mock.patch.object(
+            utils_events, "_read_events", side_effect=read_then_lose_race
+        )
+        patcher.start()
+        self.assertEqual(ingest(self.run), 0)
+        self.assertEqual(self.run.tasks.count(), 1)
+        self.run.refresh_from_db()
+        self.assertEqual(self.run.tasks_total, 3)
+        self.assertEqual(progress(self.run)["done"], 0)
+
+    def test_malformed_events_are_skipped(self):
+        with open(self.run.event_log, "a") as f:
+            f.write("not json\n[1, 2]\n")
+        self.write_events(
+            {"event": "task_start", "time": 100.0, "uuid": "a", "task": "pip"},
+            {"event": "task_end", "time": 101.0, "uuid": "a", "status": "exploded"},
+            {"event": "task_start", "uuid": "b", "task": "no time"},
+            {"event": "task_start", "time": 102.0, "uuid": "c", "task": "caddy"},
+        )
+        self.assertEqual(ingest(self.run), 2)
+        self.assertEqual(
+            list(self.run.tasks.values_list("uuid", "status")),
+            [("a", "running"), ("c", "running")],
+        )
+        # Nothing is read twice and later events are still stored
+        self.write_events(
+            {"event": "task_end", "time": 103.0, "uuid": "c", "status": "ok"}
+        )
+        self.assertEqual(ingest(self.run), 1)
+        self.assertEqual(self.run.tasks.get(uuid="c").duration, 1)
+
+
+class TestLoginFunctionality(ClearCacheMixin, TestCase):
     def test_logged_in_user_sees_secret_nav_items(self):
         user = User.objects.create(username="testuser")
         user.set_password("12345")
@@ -764,7 +1723,7 @@ class TestLoginFunctionality(TestCase):
 
 # Create tests that check users cannot access restricted pages unless they are logged
 # If they attempt this they should be redirected to the login page
-class TestLoginRestrictions(TestCase):
+class TestLoginRestrictions(ClearCacheMixin, TestCase):
     def test_index_page_not_showing_if_not_logged_in(self):
         response = self.client.get(reverse("index"), follow=True)
         self.assertContains(response, "Login", html=True)
@@ -797,13 +1756,18 @@ class TestLoginRestrictions(TestCase):
         response = self.client.get(reverse("status"), follow=True)
         self.assertContains(response, "Login", html=True)
 
+    def test_cannot_manually_visit_status_stream(self):
+        response = self.client.get(reverse("status_stream"), follow=True)
+        self.assertContains(response, "Login", html=True)
+
 
-class TestPredictions(TestCase):
+class TestPredictions(ClearCacheMixin, TestCase):
     @classmethod
     def setUpClass(cls):
         super().setUpClass()
 
     def setUp(self):
+        super().setUp()
         user = User.objects.create(username="newtestuser")
         user.set_password("12345")
         user.save()
@@ -817,17 +1781,50 @@ class TestPredictions(TestCase):
 
     # Test that save_stock_data function in utils saves to StockData table correctly
     def test_save_stock_data_function(self):
-        # write to the table and check that it saves the record correctly
+        # write to the table and check that it saves one record per provider
         stock_dict = {"google": 1.0, "azure": 2.0, "aws": 3.0}
         save_stock_data(stock_dict)
-        stock = StockData.objects.get(
-            google=stock_dict["google"],
-            azure=stock_dict["azure"],
-            aws=stock_dict["aws"],
+        stock = StockData.objects.filter(time=StockData.objects.latest("time").time)
+        self.assertEqual(
+            {s.provider.name: s.change for s in stock},
+            {"google": 1.0, "azure": 2.0, "aws": 3.0},
+        )
+
+    def test_stock_data_accepts_new_providers(self):
+        API.objects.create(
+            name="oracle",
+            long_name="Oracle Cloud",
+            is_provider=True,
+            ticker_symbol="ORCL",
+        )
+        save_stock_data({"google": 1.0, "azure": 2.0, "aws": 3.0, "oracle": -4.0})
+        self.assertEqual(save_best_prediction().provider.name, "oracle")
+
+    def test_window_and_latest_helpers(self):
+        now = timezone.now()
+        save_stock_data(
+            {"google": 1.0, "azure": 2.0, "aws": 3.0}, now - timedelta(hours=2)
+        )
+        save_stock_data({"google": 4.0, "azure": 5.0}, now)
+        self.assertEqual(
+            utils_stock_api.get_stock_window(now - timedelta(hours=1)).count(), 2
         )
-        self.assertEqual(stock.google, 1.0)
-        self.assertEqual(stock.azure, 2.0)
-        self.assertEqual(stock.aws, 3.0)
+        google = API.objects.get(name="google")
+        self.assertEqual(
+            [
+                s.change
+                for s in utils_stock_api.get_stock_window(
+                    now - timedelta(hours=3), providers=[google]
+                )
+            ],
+            [1.0, 4.0],
+        )
+        with self.assertNumQueries(1):
+            latest = {
+                s.provider.name: s.change
+                for s in utils_stock_api.get_latest_stock_data()
+            }
+        self.assertEqual(latest, {"google": 4.0, "azure": 5.0, "aws": 3.0})
 
     # Test that the correct prediction is generated from the stock data by save_best_prediction
     def test_save_best_prediction_function(self):
@@ -840,3 +1837,1209 @@ class TestPredictions(TestCase):
         # the lowest average share price should be google, so this provider should be predicted
         prediction = Prediction.objects.latest("time")
         self.assertEqual(prediction.provider.name, "google")
+
+    def test_prediction_only_averages_readings_in_window(self):
+        now = timezone.now()
+        # aws had the largest loss, but only before the window
+        save_stock_data(
+            {"google": 0.0, "azure": 0.0, "aws": -50.0}, now - timedelta(hours=30)
+        )
+        save_stock_data(
+            {"google": 1.0, "azure": -1.0, "aws": 2.0}, now - timedelta(hours=1)
+        )
+        save_stock_data({"google": 1.0, "azure": -1.0, "aws": 2.0}, now)
+        with self.assertNumQueries(3):
+            prediction = save_best_prediction()
+        self.assertEqual(prediction.provider.name, "azure")
+        self.assertEqual(prediction.time, now)
+        self.assertEqual(
+            save_best_prediction(window=timedelta(hours=48)).provider.name, "aws"
+        )
+
+    def test_prediction_without_stock_data(self):
+        self.assertIsNone(save_best_prediction())
+
+    def test_strategies_tag_their_predictions(self):
+        now = timezone.now()
+        for i in range(10):
+            save_stock_data(
+                {"google": 1.0, "azure": -1.0 - i, "aws": 0.5},
+                now - timedelta(minutes=20 * (10 - i)),
+            )
+        predictions = run_strategies()
+        self.assertEqual(set(predictions), set(settings.PREDICTION_STRATEGIES))
+        for name, prediction in predictions.items():
+            self.assertEqual(prediction.strategy, name)
+            self.assertEqual(prediction.time, StockData.objects.latest("time").time)
+        # azure is falling fastest, so every strategy should pick it
+        self.assertEqual(
+            {p.provider.name for p in predictions.values()}, {"azure"},
+        )
+        # Nothing new has been saved, so there is nothing to predict
+        self.assertEqual(run_strategies(), {})
+
+    def test_strategies_update_incrementally(self):
+        now = timezone.now()
+        changes = [
+            {
+                "google": (i * 7) % 5 - 2.0,
+                "azure": (i * 3) % 4 - 1.5,
+                "aws": i % 3 - 1.0,
+            }
+            for i in range(30)
+        ]
+        for i, stock_dict in enumerate(changes[:20]):
+            save_stock_data(stock_dict, now - timedelta(minutes=20 * (30 - i)))
+        run_strategies()
+        # A partial fetch left aws out of the first readings after the run
+        for stock_dict in changes[20:23]:
+            del stock_dict["aws"]
+        for i, stock_dict in enumerate(changes[20:], 20):
+            save_stock_data(stock_dict, now - timedelta(minutes=20 * (30 - i)))
+        # The providers, the states, the readings before and the new readings, then a state and a prediction saved
+        # per strategy
+        with self.assertNumQueries(4 + 2 * len(settings.PREDICTION_STRATEGIES) + 2):
+            incremental = run_strategies()
+        # Starting again from every reading gives the same scores
+        StrategyState.objects.all().delete()
+        full = run_strategies()
+        for name in settings.PREDICTION_STRATEGIES:
+            self.assertEqual(incremental[name].provider, full[name].provider)
+            self.assertAlmostEqual(incremental[name].score, full[name].score)
+
+    @override_settings(PREDICTION_HISTORY=5)
+    def test_new_strategy_does_not_make_a_stale_one_skip_readings(self):
+        now = timezone.now()
+        for i in range(30):
+            if i == 10:
+                run_strategies(["ewma"])
+                saved = StrategyState.objects.get(strategy="ewma")
+            save_stock_data(
+                {"google": (i * 7) % 5 - 2.0, "azure": (i * 3) % 4 - 1.5, "aws": 0.0},
+                now - timedelta(minutes=20 * (30 - i)),
+            )
+        # ewma's state is older than the history sma starts from, so it must still see every reading since
+        predictions = run_strategies(["ewma", "sma"])
+        self.assertEqual(
+            StrategyState.objects.get(strategy="ewma").time,
+            StockData.objects.latest("time").time,
+        )
+        saved.save()
+        StrategyState.objects.filter(strategy="sma").delete()
+        alone = {name: run_strategies([name])[name] for name in ("ewma", "sma")}
+        for name in ("ewma", "sma"):
+            self.assertEqual(predictions[name].provider, alone[name].provider)
+            self.assertAlmostEqual(predictions[name].score, alone[name].score)
+
+    def test_strategy_scores(self):
+        ewma = ExponentialAverage(span=3)
+        state = ewma.start(2)
+        for row in ([1.0, 4.0], [3.0, 0.0]):
+            state = ewma.update(state, np.array(row))
+        self.assertEqual(list(ewma.scores(state)), [2.0, 2.0])
+
+        sma = MovingAverage(window=2)
+        state = sma.start(2)
+        for row in ([9.0, 9.0], [1.0, 4.0], [3.0, 0.0]):
+            state = sma.update(state, np.array(row))
+        self.assertEqual(list(sma.scores(state)), [2.0, 2.0])
+
+    def test_readings_matrix_fills_missing_readings(self):
+        now = timezone.now()
+        later = now + timedelta(minutes=20)
+        times, changes = readings_matrix(
+            [(now, 1, 1.0), (now, 3, 3.0), (later, 1, 2.0), (later, 2, 5.0)], [1, 2, 3],
+        )
+        self.assertEqual(times, [now, later])
+        self.assertEqual(changes.tolist(), [[1.0, 0.0, 3.0], [2.0, 5.0, 3.0]])
+        # Providers without a reading yet carry on from the readings before
+        times, changes = readings_matrix(
+            [(now, 1, 1.0), (later, 2, 5.0)], [1, 2, 3], previous=[9.0, 8.0, None]
+        )
+        self.assertEqual(changes.tolist(), [[1.0, 8.0, 0.0], [1.0, 5.0, 0.0]])
+        # The columns follow the order the providers are given in, whatever their ids
+        times, changes = readings_matrix(
+            [(now, 1, 1.0), (now, 3, 3.0), (later, 2, 5.0)], [3, 1, 2]
+        )
+        self.assertEqual(changes.tolist(), [[3.0, 1.0, 0.0], [3.0, 1.0, 5.0]])
+
+    def test_strategies_are_abstract(self):
+        class Unfinished(Strategy):
+            def start(self, providers):
+                return {}
+
+        with self.assertRaises(TypeError):
+            Unfinished()
+
+    def test_lttb_keeps_ends_and_peaks(self):
+        points = [(x, 0.0) for x in range(1000)]
+        points[500] = (500, 10.0)
+        points[700] = (700, -10.0)
+        sampled = lttb(points, 50)
+        self.assertEqual(len(sampled), 50)
+        self.assertEqual(sampled[0], points[0])
+        self.assertEqual(sampled[-1], points[-1])
+        self.assertIn((500, 10.0), sampled)
+        self.assertIn((700, -10.0), sampled)
+        self.assertEqual(sampled, sorted(sampled))
+        # Short series are returned untouched
+        self.assertEqual(lttb(points[:10], 50), points[:10])
+
+    def test_stock_series_is_downsampled(self):
+        now = timezone.now()
+        for i in range(200):
+            save_stock_data(
+                {"google": i % 7, "azure": -(i % 5), "aws": 1.0},
+                now - timedelta(minutes=20 * i),
+            )
+        response = self.client.get(reverse("stock_series"), {"points": 50})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(set(data["series"]), {"google", "azure", "aws"})
+        google = data["series"]["google"]
+        self.assertEqual(google["long_name"], "Google Cloud")
+        self.assertEqual(google["count"], 200)
+        self.assertEqual(len(google["points"]), 50)
+        self.assertEqual(google["points"][-1], [int(now.timestamp() * 1000), 0.0])
+        self.assertIn("private", response["Cache-Control"])
+        self.assertIn("max-age", response["Cache-Control"])
+
+        # Only the readings in the range asked for are included
+        response = self.client.get(
+            reverse("stock_series"),
+            {"start": (now - timedelta(hours=2)).isoformat(), "end": now.isoformat(),},
+        )
+        self.assertEqual(response.json()["series"]["aws"]["count"], 6)
+
+        # The browser's copy is still valid until a newer reading is saved
+        explicit = {
+            "start": (now - timedelta(hours=2)).isoformat(),
+            "end": (now + timedelta(hours=1)).isoformat(),
+        }
+        response = self.client.get(reverse("stock_series"), explicit)
+        response = self.client.get(
+            reverse("stock_series"), explicit, HTTP_IF_NONE_MATCH=response["ETag"]
+        )
+        self.assertEqual(response.status_code, 304)
+        save_stock_data({"aws": 3.0}, now + timedelta(minutes=20))
+        response = self.client.get(
+            reverse("stock_series"), explicit, HTTP_IF_NONE_MATCH=response["ETag"]
+        )
+        self.assertEqual(response.status_code, 200)
+
+        # The default range moves on with the time, so readings falling out of it aren't kept by the browser
+        response = self.client.get(reverse("stock_series"))
+        later = now + timedelta(days=settings.SERIES_DAYS) - timedelta(hours=1)
+        with mock.patch.object(timezone, "now", return_value=later):
+            response = self.client.get(
+                reverse("stock_series"), HTTP_IF_NONE_MATCH=response["ETag"]
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["series"]["google"]["count"], 3)
+
+    def test_stock_series_rejects_bad_ranges(self):
+        response = self.client.get(reverse("stock_series"), {"start": "yesterday"})
+        self.assertEqual(response.status_code, 400)
+        now = timezone.now()
+        response = self.client.get(
+            reverse("stock_series"),
+            {"start": now.isoformat(), "end": (now - timedelta(days=1)).isoformat()},
+        )
+        self.assertEqual(response.status_code, 400)
+        # Every reading of a range is loaded, so its length is limited
+        response = self.client.get(
+            reverse("stock_series"),
+            {"start": (now - timedelta(days=settings.SERIES_MAX_DAYS + 1)).isoformat()},
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+class TestHotPathIndexes(TestCase):
+    # The EXPLAIN QUERY PLAN output is checked rather than timings. Without the statistics ANALYZE gathers, SQLite plans
+    # a query from the schema alone, so these are the plans of a table of 100k rows or more whatever the number of rows
+    # created here. The rows only check that the lookups find the right one
+    ROWS = 200
+
+    @classmethod
+    def setUpTestData(cls):
+        populate()
+        aws = API.objects.get(name="aws")
+        google = API.objects.get(name="google")
+        now = timezone.now()
+        times = [now - timedelta(minutes=i) for i in range(cls.ROWS)]
+        Transition.objects.bulk_create(
+            Transition(
+                start_provider=aws, end_provider=google, start_time=t, end_time=now
+            )
+            for t in times
+        )
+        # Only the newest transition is still moving
+        Transition.objects.create(start_provider=google, end_provider=aws)
+        StockData.objects.bulk_create(
+            StockData(provider=aws, time=t, change=1.0) for t in times
+        )
+        Prediction.objects.bulk_create(Prediction(provider=aws, time=t) for t in times)
+
+    def assertUsesIndex(self, queryset, index=None):
+        if connection.vendor != "sqlite":
+            self.skipTest("Query plans are only checked on SQLite")
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT count(*) FROM sqlite_master WHERE name = 'sqlite_stat1'"
+            )
+            # Statistics would make the plan depend on the rows created
+            self.assertEqual(cursor.fetchone()[0], 0)
+        plan = queryset.explain()
+        # A full scan or a sort means the lookup gets slower as the table grows
+        self.assertNotIn("TEMP B-TREE", plan)
+        for line in plan.splitlines():
+            if "SCAN" in line:
+                self.assertIn("USING", line, plan)
+        if index is not None:
+            self.assertIn(index, plan)
+
+    def test_latest_transition_uses_index(self):
+        self.assertUsesIndex(Transition.objects.order_by("-start_time")[:1])
+
+    def test_open_transition_uses_partial_index(self):
+        self.assertUsesIndex(
+            Transition.objects.filter(end_time__isnull=True).order_by("-start_time")[
+                :1
+            ],
+            "transition_open_idx",
+        )
+        self.assertEqual(Transition.objects.filter(end_time__isnull=True).count(), 1)
+        # As asked by the CloudSurf launch
+        self.assertUsesIndex(
+            Transition.objects.filter(end_time__isnull=True)[:1], "transition_open_idx"
+        )
+
+    def test_latest_stock_data_uses_index(self):
+        self.assertUsesIndex(StockData.objects.order_by("-time")[:1])
+
+    def test_latest_prediction_uses_index(self):
+        self.assertUsesIndex(Prediction.objects.order_by("-time")[:1])
+
+
+class TestBacktest(TestCase):
+    FIXTURE = os.path.join(os.path.dirname(__file__), "fixtures", "backtest_sample.csv")
+    # Set LEIDOSCLOUD_BENCH_SECONDS to tighten or relax how long a year of readings may take
+    BENCH_SECONDS = float(os.environ.get("LEIDOSCLOUD_BENCH_SECONDS", 10))
+
+    def setUp(self):
+        populate()
+
+    def test_simulate_waits_for_cloudsurfs_to_finish(self):
+        times = np.arange(6) * 1200.0
+        targets = np.array([0, 0, 1, 1, 0, 0])
+        result = utils_backtest.simulate(times, targets, 2, timedelta(minutes=30))
+        # Moves at 2400 and arrives at 4200, then moves back at 4800 until the last reading
+        self.assertEqual(result["migrations"], 2)
+        self.assertEqual(result["transit"], 1800 + 1200)
+        self.assertEqual(result["hosted"].tolist(), [2400, 600])
+
+    def test_policies_match_the_cron(self):
+        now = timezone.now()
+        for i in range(10):
+            save_stock_data(
+                {"google": float(i % 3), "azure": 1.0 - (i % 4), "aws": 0.5},
+                now - timedelta(minutes=20 * (10 - i)),
+            )
+        providers, times, changes = utils_backtest.stored_readings()
+        names = [provider.name for provider in providers]
+        latest = {provider: changes[-1][i] for i, provider in enumerate(names)}
+        self.assertEqual(
+            names[utils_backtest.lowest_policy(times, changes)[-1]],
+            min(latest, key=latest.get),
+        )
+        self.assertEqual(
+            providers[utils_backtest.average_policy(times, changes)[-1]],
+            save_best_prediction().provider,
+        )
+        sma = utils_strategies.MovingAverage(window=4)
+        self.assertTrue(
+            np.allclose(
+                sma.replay(changes), utils_strategies.Strategy.replay(sma, changes)
+            )
+        )
+
+    def test_replays_match_updating_row_by_row(self):
+        rng = np.random.RandomState(0)
+        # Long enough to span several blocks of the exponential averages
+        changes = rng.normal(0, 2, (500, 3))
+        strategies = [strategy() for strategy in STRATEGIES.values()]
+        strategies.append(utils_strategies.ExponentialAverage(span=1))
+        for strategy in strategies:
+            self.assertIsNot(type(strategy).replay, Strategy.replay, strategy.name)
+            for rows in (changes, changes[:1], changes[:0]):
+                np.testing.assert_allclose(
+                    strategy.replay(rows),
+                    Strategy.replay(strategy, rows),
+                    rtol=1e-9,
+                    atol=1e-9,
+                    err_msg=strategy.name,
+                )
+
+    def test_backtest_command(self):
+        out = StringIO()
+        call_command("backtest", csv=self.FIXTURE, stdout=out)
+        output = out.getvalue()
+        self.assertIn("216 readings of 3 providers", output)
+        for name in utils_backtest.POLICIES:
+            self.assertIn(name, output)
+        with self.assertRaises(CommandError):
+            call_command("backtest", stdout=StringIO())
+
+    def test_year_of_readings_benchmark(self):
+        providers, times, changes = utils_backtest.synthetic_readings(365)
+        started = time.monotonic()
+        results = utils_backtest.backtest(times, changes)
+        self.assertLess(time.monotonic() - started, self.BENCH_SECONDS)
+        for result in results.values():
+            # Every second of the year is spent on a provider or CloudSurfing
+            self.assertAlmostEqual(
+                result["hosted"].sum() + result["transit"], times[-1] - times[0]
+            )
+
+
+# The job runner's threads use their own database connections, so the jobs have to be committed for them to see
+class TestJobRunner(TransactionTestCase):
+    def setUp(self):
+        populate()
+        self.transition = Transition.objects.create(
+            start_provider=API.objects.get(name="aws"),
+            end_provider=API.objects.get(name="google"),
+        )
+
+    def submit(self, kind, code):
+        run = PlaybookRun.objects.create(transition=self.transition, kind=kind)
+        return run, utils_jobs.submit(run, [sys.executable, "-c", code])
+
+    def test_exit_code_and_timing_are_recorded(self):
+        run, job = self.submit(PlaybookRun.DELETE, "import sys; sys.exit(3)")
+        self.assertEqual(job.result(10), 3)
+        run.refresh_from_db()
+        self.assertEqual(run.status, PlaybookRun.FAILED)
+        self.assertEqual(run.exit_code, 3)
+        self.assertTrue(run.failed)
+        self.assertIsNotNone(run.pid)
+        self.assertGreaterEqual(run.end_time, run.start_time)
+        self.assertGreaterEqual(run.start_time, run.queued_time)
+        self.assertEqual(json.loads(run.command)[0], sys.executable)
+
+        run, job = self.submit(PlaybookRun.DELETE, "pass")
+        self.assertEqual(job.result(10), 0)
+        run.refresh_from_db()
+        self.assertEqual(run.status, PlaybookRun.SUCCEEDED)
+        self.assertFalse(run.failed)
+
+    def test_only_supervising_processes_start_playbooks(self):
+        # Commands such as the one ending a migration would otherwise wait for the playbook before exiting
+        for argv in (["manage.py", "ingest_events"], ["manage.py", "collectstatic"]):
+            with mock.patch.object(sys, "argv", argv):
+                run = PlaybookRun.objects.create(
+                    transition=self.transition, kind=PlaybookRun.DELETE
+                )
+                with self.assertRaises(utils_jobs.NotSupervisingException):
+                    utils_jobs.submit(run, [sys.executable, "-c", "pass"])
+                run.refresh_from_db()
+                self.assertEqual(run.command, "")
+                self.assertIsNone(run.pid)
+
+        # gunicorn and the cron stay until their playbooks end
+        for argv in (
+            ["/home/ubuntu/.local/bin/gunicorn", "leidoscloud.wsgi"],
+            ["manage.py", "runcrons"],
+        ):
+            with mock.patch.object(sys, "argv", argv):
+                run, job = self.submit(PlaybookRun.DELETE, "pass")
+            self.assertEqual(job.result(10), 0)
+
+    @override_settings(JOB_LIMITS={"deploy": 1})
+    def test_limits_and_cancellation(self):
+        utils_jobs._limits.pop(PlaybookRun.DEPLOY, None)
+        try:
+            first, first_job = self.submit(
+                PlaybookRun.DEPLOY, "import time; time.sleep(30)"
+            )
+            second, second_job = self.submit(PlaybookRun.DEPLOY, "pass")
+            for i in range(100):
+                first.refresh_from_db()
+                if first.pid is not None:
+                    break
+                time.sleep(0.05)
+            # Only one deploy may run at a time
+            second.refresh_from_db()
+            self.assertEqual(first.status, PlaybookRun.RUNNING)
+            self.assertEqual(second.status, PlaybookRun.QUEUED)
+
+            # Cancelling the queued run stops it from starting, cancelling the running one stops the process
+            self.assertTrue(utils_jobs.cancel(second))
+            self.assertEqual(utils_jobs.cancel_runs(self.transition), 1)
+            self.assertEqual(first_job.result(10), -15)
+            self.assertIsNone(second_job.result(10))
+            first.refresh_from_db()
+            second.refresh_from_db()
+            self.assertEqual(first.status, PlaybookRun.CANCELLED)
+            self.assertEqual(second.status, PlaybookRun.CANCELLED)
+            self.assertIsNone(second.pid)
+            self.assertFalse(utils_jobs.cancel(first))
+            # Finished runs are forgotten
+            self.assertEqual(utils_jobs._owned, set())
+            self.assertEqual(utils_jobs._cancelled, set())
+        finally:
+            utils_jobs._limits.pop(PlaybookRun.DEPLOY, None)
+
+    def test_runs_of_other_processes_are_not_remembered(self):
+        process = subprocess.Popen(
+            [sys.executable, "-c", "import time; time.sleep(30)"],
+            preexec_fn=os.setpgrp,
+        )
+        self.addCleanup(process.wait, 10)
+        run = PlaybookRun.objects.create(
+            transition=self.transition,
+            kind=PlaybookRun.DEPLOY,
+            status=PlaybookRun.RUNNING,
+            pid=process.pid,
+        )
+        self.assertTrue(utils_jobs.cancel(run))
+        self.assertEqual(process.wait(10), -15)
+        self.assertEqual(utils_jobs._cancelled, set())
+        run.refresh_from_db()
+        self.assertEqual(run.status, PlaybookRun.CANCELLED)
+
+    @override_settings(JOB_INGEST_SECONDS=0.05)
+    def test_reading_events_keeps_what_the_supervisor_wrote(self):
+        events = os.path.join(tempfile.mkdtemp(), "events.ndjson")
+        run = PlaybookRun.objects.create(
+            transition=self.transition, kind=PlaybookRun.DELETE, event_log=events
+        )
+        lines = [
+            {"event": "playbook_start", "time": 100.0, "tasks": 1},
+            {"event": "task_start", "time": 100.0, "uuid": "a", "task": "pip"},
+            {"event": "task_end", "time": 101.0, "uuid": "a", "status": "ok"},
+            {"event": "playbook_end", "time": 101.0, "failed": False},
+        ]
+        code = "import sys, time; f = open({!r}, 'w')\n".format(events)
+        code += "f.write({!r}); f.flush(); time.sleep(1)\n".format(
+            json.dumps(lines[0]) + "\n"
+        )
+        code += "f.write({!r}); f.flush(); sys.exit(2)".format(
+            "".join(json.dumps(line) + "\n" for line in lines[1:])
+        )
+        job = utils_jobs.submit(run, [sys.executable, "-c", code])
+        # A status poll or adopt_runs holding the run from before it started
+        stale = PlaybookRun.objects.get(pk=run.pk)
+        for i in range(100):
+            run.refresh_from_db()
+            if run.tasks_total:
+                break
+            time.sleep(0.05)
+        ingest(stale)
+        run.refresh_from_db()
+        self.assertEqual(run.status, PlaybookRun.RUNNING)
+        self.assertIsNotNone(run.pid)
+
+        self.assertEqual(job.result(10), 2)
+        # The events say the playbook succeeded, but its exit code is what counts
+        ingest(stale)
+        run.refresh_from_db()
+        self.assertEqual(run.status, PlaybookRun.FAILED)
+        self.assertEqual(run.exit_code, 2)
+        self.assertTrue(run.failed)
+        self.assertGreater(run.end_time, run.start_time)
+        self.assertEqual(run.tasks.get().duration, 1)
+        # Cancelling the finished run finds nothing to stop
+        self.assertFalse(utils_jobs.cancel(run))
+
+    @override_settings(JOB_INGEST_SECONDS=0.05)
+    def test_events_are_read_while_running(self):
+        events = os.path.join(tempfile.mkdtemp(), "events.ndjson")
+        run = PlaybookRun.objects.create(
+            transition=self.transition, kind=PlaybookRun.DEPLOY, event_log=events
+        )
+        event = json.dumps({"event": "task_start", "time": 100.0, "uuid": "a"})
+        code = "import time; open({!r}, 'w').write({!r}); time.sleep(30)".format(
+            events, event + "\n"
+        )
+        job = utils_jobs.submit(run, [sys.executable, "-c", code])
+        try:
+            for i in range(100):
+                if run.tasks.exists():
+                    break
+                time.sleep(0.05)
+            self.assertTrue(run.tasks.exists())
+            run.refresh_from_db()
+            self.assertEqual(run.status, PlaybookRun.RUNNING)
+        finally:
+            utils_jobs.cancel(run)
+            job.result(10)
+        self.assertEqual(run.tasks.count(), 1)
+
+
+class TestFirstStart(TestCase):
+    def setUp(self):
+        populate()
+        self.transition = Transition.objects.create(
+            start_provider=API.objects.get(name="aws"),
+            end_provider=utils_host.get_current_cloud_host(),
+        )
+
+    def start(self, argv):
+        with mock.patch.object(sys, "argv", argv), mock.patch(
+            "leidoscloud.apps.delete_host"
+        ) as delete_host:
+            apps.get_app_config("leidoscloud").ready()
+        self.transition.refresh_from_db()
+        return delete_host
+
+    def test_management_commands_leave_the_transition_to_the_server(self):
+        for argv in (["manage.py", "collectstatic"], ["manage.py", "ingest_events"]):
+            delete_host = self.start(argv)
+            self.assertIsNone(self.transition.end_time)
+            self.assertFalse(self.transition.succeeded)
+            delete_host.assert_not_called()
+
+    def test_server_finishes_the_transition(self):
+        delete_host = self.start(
+            ["/home/ubuntu/.local/bin/gunicorn", "leidoscloud.wsgi"]
+        )
+        self.assertIsNotNone(self.transition.end_time)
+        self.assertTrue(self.transition.succeeded)
+        delete_host.assert_called_once_with(
+            self.transition.start_provider, self.transition
+        )
+
+
+class TestRelease(TestCase):
+    def setUp(self):
+        populate()
+        self.root = tempfile.TemporaryDirectory()
+        self.output = tempfile.TemporaryDirectory()
+        files = {
+            "ansible.cfg": "[defaults]",
+            "ansible-scripts/main.yml": "---",
+            "ansible-scripts/private.pem": "secret",
+            "leidoscloud/manage.py": "print()",
+            "leidoscloud/db.sqlite3": "",
+            "leidoscloud/ansible.log": "",
+            "leidoscloud/events/deploy-1-1.ndjson": "",
+            "leidoscloud/leidoscloud/__pycache__/models.cpython-37.pyc": "",
+            "README.md": "",
+            "wheelhouse/Django-2.2.6-py3-none-any.whl": "",
+        }
+        for path in utils_release.REQUIREMENTS:
+            files[path] = "requests==2.22.0"
+        for path, contents in files.items():
+            full_path = os.path.join(self.root.name, path)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            with open(full_path, "w") as f:
+                f.write(contents)
+
+    def tearDown(self):
+        self.root.cleanup()
+        self.output.cleanup()
+
+    def build(self):
+        return utils_release.build_release(self.output.name, self.root.name)
+
+    def test_only_runtime_files_are_released(self):
+        self.assertEqual(
+            utils_release.release_files(self.root.name),
+            [
+                "ansible-scripts/main.yml",
+                "ansible-scripts/requirements/aws.txt",
+                "ansible-scripts/requirements/azure.txt",
+                "ansible-scripts/requirements/controller.txt",
+                "ansible-scripts/requirements/google.txt",
+                "ansible-scripts/requirements/host.txt",
+                "ansible.cfg",
+                "leidoscloud/manage.py",
+                "leidoscloud/requirements.txt",
+                "wheelhouse/Django-2.2.6-py3-none-any.whl",
+            ],
+        )
+        # The real tree never releases the database or keys
+        files = utils_release.release_files()
+        self.assertIn("leidoscloud/manage.py", files)
+        self.assertFalse(any(path.endswith((".sqlite3", ".pem")) for path in files))
+
+    def test_bundle_is_reused_until_the_files_change(self):
+        path, digest, built = self.build()
+        self.assertTrue(built)
+        self.assertIn(digest, os.path.basename(path))
+        with tarfile.open(path) as tar:
+            self.assertEqual(
+                sorted(tar.getnames()), utils_release.release_files(self.root.name)
+            )
+        with open(path, "rb") as f:
+            contents = f.read()
+        self.assertEqual(self.build(), (path, digest, False))
+
+        # The same files always make the same bundle
+        os.remove(path)
+        self.build()
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), contents)
+
+        with open(os.path.join(self.root.name, "leidoscloud", "manage.py"), "a") as f:
+            f.write("print()")
+        new_path, new_digest, built = self.build()
+        self.assertTrue(built)
+        self.assertNotEqual(new_digest, digest)
+
+    @override_settings(RELEASE_KEEP=2)
+    def test_old_bundles_are_removed(self):
+        manage = os.path.join(self.root.name, "leidoscloud", "manage.py")
+        paths = []
+        for i in range(3):
+            with open(manage, "w") as f:
+                f.write(str(i))
+            paths.append(self.build()[0])
+            # Bundles are pruned oldest first by modification time
+            os.utime(paths[-1], (i, i))
+        self.assertEqual(
+            sorted(os.listdir(self.output.name)),
+            sorted(os.path.basename(path) for path in paths[1:]),
+        )
+
+    def test_release_command(self):
+        source = os.path.join(self.output.name, "source.sqlite3")
+        with sqlite3.connect(source) as database:
+            database.execute("CREATE TABLE cloud (name TEXT)")
+            database.execute("INSERT INTO cloud VALUES ('aws')")
+        database.close()
+        snapshot = utils_release.snapshot_database(
+            os.path.join(self.output.name, "db.sqlite3"), source
+        )
+        with sqlite3.connect(snapshot) as database:
+            self.assertEqual(
+                database.execute("SELECT name FROM cloud").fetchall(), [("aws",)]
+            )
+        database.close()
+
+        out = StringIO()
+        with override_settings(RELEASE_DIR=self.output.name):
+            call_command("release", no_wheelhouse=True, stdout=out)
+        result = json.loads(out.getvalue())
+        self.assertTrue(os.path.exists(result["bundle"]))
+        self.assertEqual(os.path.dirname(result["bundle"]), self.output.name)
+
+        # Whatever else is printed, such as by apps.py, can't spoil the details written to --output
+        path = os.path.join(self.output.name, "release.json")
+        out = StringIO()
+        with override_settings(RELEASE_DIR=self.output.name):
+            call_command("release", no_wheelhouse=True, output=path, stdout=out)
+        self.assertEqual(out.getvalue(), "")
+        with open(path) as f:
+            self.assertEqual(json.load(f)["bundle"], result["bundle"])
+
+    def test_wheelhouse_is_rebuilt_when_requirements_change(self):
+        wheelhouse = os.path.join(self.root.name, "wheelhouse")
+        commands = []
+
+        def pip(command, **kwargs):
+            commands.append(command)
+            partial = command[command.index("--wheel-dir") + 1]
+            os.makedirs(partial)
+            Path(partial, "requests-2.22.0-py2.py3-none-any.whl").touch()
+
+        with mock.patch.object(utils_release.subprocess, "run", side_effect=pip):
+            path, key, built = utils_release.build_wheelhouse(
+                wheelhouse, self.root.name
+            )
+            self.assertTrue(built)
+            self.assertEqual(
+                sorted(os.listdir(wheelhouse)),
+                ["requests-2.22.0-py2.py3-none-any.whl", "wheelhouse.json"],
+            )
+            # Every requirement file is built, reusing the wheels already there
+            self.assertEqual(
+                commands[0].count("--requirement"), len(utils_release.REQUIREMENTS)
+            )
+            self.assertIn("--find-links", commands[0])
+            self.assertEqual(
+                utils_release.build_wheelhouse(wheelhouse, self.root.name),
+                (path, key, False),
+            )
+            self.assertEqual(len(commands), 1)
+
+            with open(
+                os.path.join(self.root.name, utils_release.REQUIREMENTS[0]), "a"
+            ) as f:
+                f.write("\nnumpy==1.17.4")
+            path, new_key, built = utils_release.build_wheelhouse(
+                wheelhouse, self.root.name
+            )
+            self.assertTrue(built)
+            self.assertNotEqual(new_key, key)
+            self.assertEqual(len(commands), 2)
+
+        # A failed build leaves the previous wheelhouse in place
+        with mock.patch.object(
+            utils_release.subprocess,
+            "run",
+            side_effect=subprocess.CalledProcessError(1, "pip"),
+        ):
+            with open(
+                os.path.join(self.root.name, utils_release.REQUIREMENTS[0]), "a"
+            ) as f:
+                f.write("\nsegno==0.3.9")
+            with self.assertRaises(subprocess.CalledProcessError):
+                utils_release.build_wheelhouse(wheelhouse, self.root.name)
+        self.assertEqual(utils_release._wheelhouse_manifest(wheelhouse)["key"], new_key)
+
+
+class TestPlaybookVars(TestCase):
+    def setUp(self):
+        populate()
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_every_key_is_read_at_once(self):
+        aws = API.objects.get(name="aws")
+        Key.objects.filter(provider=aws).delete()
+        Key.objects.create(provider=aws, name="secret_key", value="shh")
+        Key.objects.create(provider=aws, name="access_key", value="let me in")
+        # One query for the APIs and one for their keys, between the savepoint queries of the transaction
+        with self.assertNumQueries(4):
+            variables = utils_vars.playbook_vars()
+        self.assertEqual(
+            variables["provider_keys"]["aws"],
+            {"secret_key": "shh", "access_key": "let me in"},
+        )
+        self.assertEqual(
+            set(variables["provider_keys"]),
+            set(API.objects.values_list("name", flat=True)),
+        )
+
+    def test_vars_file(self):
+        path = os.path.join(self.directory.name, "vars.json")
+        out = StringIO()
+        call_command("playbookvars", path, stdout=out)
+        self.assertEqual(out.getvalue().strip(), path)
+        # The file holds every key, so nobody else may read it
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+        with open(path) as f:
+            self.assertEqual(json.load(f), utils_vars.playbook_vars())
+
+        job = concurrent.futures.Future()
+        utils_vars.remove_when_done(job, path)
+        self.assertTrue(os.path.exists(path))
+        job.set_result(0)
+        self.assertFalse(os.path.exists(path))
+
+    def test_host_is_marked_deleted_when_the_playbook_succeeds(self):
+        first = Transition.objects.create(
+            start_provider=API.objects.get(name="aws"),
+            end_provider=API.objects.get(name="azure"),
+        )
+        for exit_code, deleted in ((2, False), (0, True)):
+            job = concurrent.futures.Future()
+            job.add_done_callback(_mark_deleted(first.id))
+            job.set_result(exit_code)
+            first.refresh_from_db()
+            self.assertEqual(first.deleted, deleted)
+
+
+class TestDatabaseProfile(TransactionTestCase):
+    def setUp(self):
+        populate()
+
+    def test_sqlite_connections_are_configured(self):
+        if connection.vendor != "sqlite":
+            self.skipTest("Only SQLite connections are configured")
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA busy_timeout")
+            self.assertEqual(
+                cursor.fetchone()[0], settings.SQLITE_PRAGMAS["busy_timeout"]
+            )
+            with override_settings(SQLITE_PRAGMAS={"synchronous": "OFF"}):
+                signals.configure_sqlite(sender=None, connection=connection)
+            cursor.execute("PRAGMA synchronous")
+            self.assertEqual(cursor.fetchone()[0], 0)
+            # Put back as the profile has it for the rest of the tests
+            cursor.execute("PRAGMA synchronous = FULL")
+            signals.configure_sqlite(sender=None, connection=connection)
+            cursor.execute("PRAGMA synchronous")
+            self.assertEqual(
+                cursor.fetchone()[0],
+                1 if "synchronous" in settings.SQLITE_PRAGMAS else 2,
+            )
+
+    def test_benchmark_runs_every_workload(self):
+        if not connection.is_in_memory_db():
+            results = utils_dbbench.run_benchmark(
+                {"status": 2, "cron": 1, "transition": 1}, 0.5
+            )
+            readings = StockData.objects.count()
+        else:
+            # The in-memory test database locks whole tables and fails rather than waiting for them, so the benchmark
+            # runs against a copy in a file, as the dbbench command does
+            directory = tempfile.TemporaryDirectory()
+            self.addCleanup(directory.cleanup)
+            path = os.path.join(directory.name, "bench.sqlite3")
+            copy = sqlite3.connect(path)
+            connection.connection.backup(copy)
+            # The benchmark's threads open their connections to the copy
+            with mock.patch.dict(connection.settings_dict, NAME=path):
+                results = utils_dbbench.run_benchmark(
+                    {"status": 2, "cron": 1, "transition": 1}, 0.5
+                )
+            readings = copy.execute(
+                "SELECT COUNT(*) FROM " + StockData._meta.db_table
+            ).fetchone()[0]
+            copy.close()
+        for name, result in results.items():
+            self.assertGreater(result["operations"], 0, name)
+            self.assertLessEqual(result["p50"], result["p99"])
+        self.assertEqual(
+            readings,
+            results["cron"]["operations"]
+            * API.objects.filter(is_provider=True).count(),
+        )
+
+
+@skipUnless(
+    settings.DATABASE_PROFILE == "postgres",
+    "Set LEIDOSCLOUD_DB_PROFILE=postgres to test against PostgreSQL",
+)
+class TestPostgresProfile(TransactionTestCase):
+    def setUp(self):
+        populate()
+
+    def run_threads(self, target, count):
+        def run():
+            try:
+                return target()
+            finally:
+                connection.close()
+
+        with concurrent.futures.ThreadPoolExecutor(count) as executor:
+            return [f.result() for f in [executor.submit(run) for _ in range(count)]]
+
+    def test_benchmark_runs_every_workload(self):
+        results = utils_dbbench.run_benchmark(
+            {"status": 2, "cron": 1, "transition": 1}, 1
+        )
+        for name, result in results.items():
+            self.assertGreater(result["operations"], 0, name)
+            self.assertEqual(result["errors"], 0, name)
+
+    def test_dbbench_command(self):
+        out = StringIO()
+        call_command("dbbench", seconds=0.5, status=2, cron=1, transition=1, stdout=out)
+        self.assertIn("Profile postgres", out.getvalue())
+        for name in utils_dbbench.WORKLOADS:
+            self.assertIn(name, out.getvalue())
+
+    def test_connections_are_kept_between_requests(self):
+        self.assertEqual(
+            connection.settings_dict["CONN_MAX_AGE"], settings.DATABASE_CONN_MAX_AGE
+        )
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_backend_pid()")
+            pid = cursor.fetchone()[0]
+        # What Django does at the end of every request
+        connection.close_if_unusable_or_obsolete()
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_backend_pid()")
+            self.assertEqual(cursor.fetchone()[0], pid)
+
+    def test_tokens_are_granted_once(self):
+        def take():
+            return sum(
+                utils_stock_api.acquire_tokens("test", 1, 20, 3600) for _ in range(5)
+            )
+
+        self.assertEqual(sum(self.run_threads(take, 8)), 20)
+        self.assertEqual(RateLimitBucket.objects.get(name="test").version, 40)
+
+    def test_quotes_are_cached_once(self):
+        def save():
+            QuoteCache.objects.update_or_create(
+                symbol="AMZN",
+                defaults={
+                    "change": random.uniform(-1, 1),
+                    "fetched_at": timezone.now(),
+                },
+            )
+
+        self.run_threads(save, 8)
+        self.assertEqual(QuoteCache.objects.filter(symbol="AMZN").count(), 1)
+
+
+class TestPageCache(ClearCacheMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        user = User.objects.create(username="newtestuser")
+        user.set_password("12345")
+        user.save()
+        self.client.login(username="newtestuser", password="12345")
+        populate()
+        self.aws = API.objects.get(name="aws")
+        self.azure = API.objects.get(name="azure")
+
+    def test_groups_are_invalidated_by_their_rows(self):
+        builds = []
+
+        def build():
+            builds.append(1)
+            return None
+
+        def get():
+            return utils_cache.cached([utils_cache.TRANSITIONS], "test", build)
+
+        get()
+        get()
+        # A cached None is still cached
+        self.assertEqual(len(builds), 1)
+        Prediction.objects.create(provider=self.aws, time=timezone.now())
+        get()
+        self.assertEqual(len(builds), 1)
+        transition = Transition.objects.create(
+            start_provider=self.aws, end_provider=self.azure
+        )
+        get()
+        self.assertEqual(len(builds), 2)
+        transition.delete()
+        get()
+        self.assertEqual(len(builds), 3)
+
+    def test_changes_made_by_other_processes_are_seen(self):
+        builds = []
+
+        def build():
+            builds.append(1)
+
+        def get():
+            return utils_cache.cached([utils_cache.TRANSITIONS], "test", build)
+
+        get()
+        get()
+        self.assertEqual(len(builds), 1)
+        # Such as the cron saving a prediction, or a job runner callback marking a host deleted
+        subprocess.run(
+            [
+                sys.executable,
+                os.path.join(settings.BASE_DIR, "manage.py"),
+                "shell",
+                "-c",
+                "from leidoscloud import utils_cache; utils_cache.invalidate(utils_cache.TRANSITIONS)",
+            ],
+            env=dict(
+                os.environ,
+                LEIDOSCLOUD_DB_NAME=os.path.join(tempfile.mkdtemp(), "db.sqlite3"),
+            ),
+            capture_output=True,
+            check=True,
+        )
+        get()
+        self.assertEqual(len(builds), 2)
+
+    def test_pages_follow_the_database(self):
+        response = self.client.get(reverse("index"))
+        self.assertEqual(response.context["running_time"], "eternity and/or never")
+        transition = Transition.objects.create(
+            start_provider=self.aws, end_provider=self.azure
+        )
+        response = self.client.get(reverse("index"))
+        self.assertEqual(response.context["end_provider"], self.azure.long_name)
+        transition.end_time = timezone.now()
+        transition.save()
+        response = self.client.get(reverse("index"))
+        self.assertIsNone(response.context["end_provider"])
+        self.assertEqual(response.context["running_time"], "0\xa0minutes")
+
+        self.assertContains(self.client.get(reverse("CloudSurf")), self.aws.long_name)
+        self.aws.long_name = "Amazon Cloud"
+        self.aws.save()
+        self.assertContains(self.client.get(reverse("CloudSurf")), "Amazon Cloud")
+
+    def test_deleted_hosts_are_shown(self):
+        transition = Transition.objects.create(
+            start_provider=self.aws, end_provider=self.azure
+        )
+        template = Template(
+            "{% load leidoscloud_template_tags %}{% transition_table %}"
+        )
+        self.assertInHTML("<td>False</td>", template.render(Context({})), count=2)
+        # Marked by a queryset update, which doesn't send a signal
+        job = concurrent.futures.Future()
+        job.add_done_callback(_mark_deleted(transition.id))
+        job.set_result(0)
+        self.assertInHTML("<td>True</td>", template.render(Context({})), count=1)
+
+
+class TestStaticFiles(ClearCacheMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        user = User.objects.create(username="newtestuser")
+        user.set_password("12345")
+        user.save()
+        self.client.login(username="newtestuser", password="12345")
+        populate()
+
+    def test_optimized_images_are_no_larger(self):
+        images = Path(settings.STATICFILES_DIRS[0]) / "images"
+        for image in images.glob("*.png"):
+            data = image.read_bytes()
+            optimized = storage.optimize_png(data)
+            self.assertLessEqual(len(optimized), len(data))
+            self.assertTrue(optimized.startswith(storage.PNG_SIGNATURE))
+            self.assertTrue(optimized.endswith(data[-12:]))
+        self.assertEqual(storage.optimize_png(b"not a png"), b"not a png")
+
+    def test_collectstatic_keeps_only_hashed_files(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with override_settings(STATIC_ROOT=directory):
+                call_command("collectstatic", interactive=False, verbosity=0)
+                manifest = json.loads(
+                    (Path(directory) / "staticfiles.json").read_text()
+                )["paths"]
+                css = Path(directory) / manifest["custom-colors.css"]
+                self.assertNotEqual(manifest["custom-colors.css"], "custom-colors.css")
+                self.assertFalse((Path(directory) / "custom-colors.css").exists())
+                self.assertEqual(
+                    gzip.decompress(Path(str(css) + ".gz").read_bytes()),
+                    css.read_bytes(),
+                )
+                for name in ("aws", "azure", "google"):
+                    hashed = manifest["images/{}.png".format(name)]
+                    self.assertTrue((Path(directory) / hashed).exists())
+                    self.assertFalse(
+                        (Path(directory) / "images/{}.png".format(name)).exists()
+                    )
+
+                # Pages link the hashed names
+                response = self.client.get(reverse("CloudSurf"))
+                self.assertContains(response, "/static/" + manifest["images/aws.png"])
+
+    def test_pages_link_unhashed_names_before_collectstatic(self):
+        response = self.client.get(reverse("CloudSurf"))
+        self.assertContains(response, "/static/images/aws.png")
+
+
+class TestLoadTest(ClearCacheMixin, LiveServerTestCase):
+    def setUp(self):
+        super().setUp()
+        user = User.objects.create(username="newtestuser")
+        user.set_password("12345")
+        user.save()
+        self.client.login(username="newtestuser", password="12345")
+        populate()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.log = os.path.join(directory.name, "ansible.log")
+        utils_loadtest.seed(30, 90, self.log, 5000)
+        patcher = mock.patch.object(utils_host, "MAIN_LOG_TXT", self.log)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_seeded_data(self):
+        self.assertEqual(Transition.objects.count(), 30)
+        self.assertFalse(Transition.objects.filter(end_time=None).exists())
+        for provider in API.objects.filter(is_provider=True):
+            self.assertEqual(StockData.objects.filter(provider=provider).count(), 30)
+        log = Path(self.log).read_bytes()
+        self.assertGreaterEqual(len(log), 5000)
+        # The same seed writes the same log
+        again = self.log + ".again"
+        utils_loadtest.seed(0, 0, again, 5000)
+        self.assertEqual(Path(again).read_bytes(), log)
+        # The seeded log finished long ago
+        response = self.client.get(reverse("status"))
+        self.assertEqual(response.json()["status"], "Not CloudSurfing")
+
+    def test_queries_are_counted(self):
+        counts = utils_loadtest.count_queries(self.client, utils_loadtest.endpoints())
+        for name, count in counts.items():
+            self.assertLessEqual(count["warm_queries"], count["cold_queries"], name)
+        self.assertLess(
+            counts["index"]["warm_queries"], counts["index"]["cold_queries"]
+        )
+        self.client.logout()
+        with self.assertRaises(ValueError):
+            utils_loadtest.count_queries(self.client, utils_loadtest.endpoints())
+
+    def test_load(self):
+        headers = {
+            "Cookie": "{}={}".format(
+                settings.SESSION_COOKIE_NAME,
+                self.client.cookies[settings.SESSION_COOKIE_NAME].value,
+            )
+        }
+        paths = utils_loadtest.endpoints()
+        results = utils_loadtest.run_load(self.live_server_url, paths, 2, 1, headers)
+        self.assertEqual(set(results), set(paths))
+        for name, result in results.items():
+            self.assertGreater(result["requests"], 0, name)
+            self.assertEqual(result["errors"], 0, name)
+            self.assertLessEqual(result["p50"], result["p95"])
+            self.assertLessEqual(result["p95"], result["p99"])
+        # Without the session every page redirects to the login page
+        results = utils_loadtest.run_load(
+            self.live_server_url, {"index": paths["index"]}, 1, 0.2
+        )
+        self.assertEqual(results["index"]["requests"], 0)
+        self.assertGreater(results["index"]["errors"], 0)
+
+    def test_regressions(self):
+        baseline = {
+            "index": {"p50": 10, "p95": 20, "p99": 40, "warm_queries": 2},
+            "status": {"p50": 10, "throughput": 100, "errors": 0},
+        }
+        results = {
+            "index": {"p50": 11.5, "p95": 30, "p99": 40, "warm_queries": 3},
+            "status": {"p50": 1, "throughput": 70, "errors": 2},
+            "log": {"p50": 1000},
+        }
+        regressions = utils_loadtest.compare(results, baseline, 0.2)
+        self.assertEqual(len(regressions), 4)
+        for expected in ("index p95", "index warm_queries", "status errors"):
+            self.assertTrue(any(r.startswith(expected) for r in regressions))
+        self.assertTrue(any("throughput" in r for r in regressions))
+        # Any error is a regression from none
+        self.assertEqual(
+            utils_loadtest.compare(results, baseline, 1),
+            ["status errors went from 0 to 2"],
+        )
+
+
+class TestStockDataMigration(TransactionTestCase):
+    before = [("leidoscloud", "0010_stockdata_provider_change")]
+    after = [("leidoscloud", "0012_remove_stockdata_provider_columns")]
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_years_of_readings_are_converted(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.before)
+        apps = executor.loader.project_state(self.before).apps
+        API = apps.get_model("leidoscloud", "API")
+        StockData = apps.get_model("leidoscloud", "StockData")
+        for name in ("google", "azure", "aws"):
+            API.objects.create(name=name, long_name=name, is_provider=True)
+        # More old rows than SQLite allows variables in one query
+        start = timezone.now()
+        for i in range(1200):
+            StockData.objects.create(
+                time=start - timedelta(hours=i), google=i, azure=-i, aws=0.5
+            )
+
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.after)
+        apps = executor.loader.project_state(self.after).apps
+        StockData = apps.get_model("leidoscloud", "StockData")
+        self.assertEqual(StockData.objects.count(), 3600)
+        self.assertFalse(StockData.objects.filter(provider__isnull=True).exists())
+        self.assertEqual(
+            StockData.objects.get(
+                provider__name="azure", time=start - timedelta(hours=7)
+            ).change,
+            -7,
+        )
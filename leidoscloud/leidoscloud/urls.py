@@ -29,7 +29,10 @@ urlpatterns = [
     path("log/", views.full_log, name="log"),
     path("log/delete/", views.full_log, name="delete_log"),
     path("status.json", views.cloudsurfing_status, name="status"),
+    path("status/stream/", views.cloudsurfing_status_stream, name="status_stream"),
     path("accounts/login/", auth_views.LoginView.as_view(), name="login"),
     path("accounts/logout/", auth_views.LogoutView.as_view(), name="logout"),
     path("predictions/", views.prediction, name="predictions"),
+    path("predictions/series.json", views.stock_series, name="stock_series"),
+    path("timings/", views.migration_timings, name="timings"),
 ]
@@ -0,0 +1,193 @@
+import csv
+import datetime
+
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import API, StockData
+from .utils_strategies import STRATEGIES, readings_matrix
+
+# How long a CloudSurf takes in a backtest unless told otherwise. The cron can't start another one until it is over
+TRANSIT_MINUTES = 30
+
+
+def lowest_policy(times, changes):
+    """
+    The policy of the CloudSurf cron, see process_api_json. Moves to the provider with the lowest change of each reading
+    :param times: NumPy array of the time of each reading in seconds since the epoch
+    :param changes: NumPy array with a row per reading and a column per provider
+    :return: NumPy array of the column of the provider to be hosted on after each reading
+    """
+    return np.argmin(changes, axis=1)
+
+
+def average_policy(times, changes, window=None):
+    """
+    The policy of save_best_prediction. Moves to the provider with the lowest mean change over a window of time
+    :param times: NumPy array of the time of each reading in seconds since the epoch
+    :param changes: NumPy array with a row per reading and a column per provider
+    :param window: timedelta. How far back to average over. Defaults to PREDICTION_WINDOW_HOURS
+    :return: NumPy array of the column of the provider to be hosted on after each reading
+    """
+    if window is None:
+        window = datetime.timedelta(hours=settings.PREDICTION_WINDOW_HOURS)
+    totals = np.vstack([np.zeros(changes.shape[1]), np.cumsum(changes, axis=0)])
+    # The first reading inside the window of every reading
+    starts = np.searchsorted(times, times - window.total_seconds(), side="right")
+    ends = np.arange(1, len(times) + 1)
+    means = (totals[ends] - totals[starts]) / (ends - starts)[:, None]
+    return np.argmin(means, axis=1)
+
+
+def strategy_policy(name):
+    """
+    Turns a prediction strategy into a policy which moves to the provider the strategy scores best
+    :param name: str. Name of the strategy in utils_strategies.STRATEGIES
+    :return: function taking the reading times and changes and returning the column of the provider after each reading
+    """
+
+    def policy(times, changes):
+        return np.argmin(STRATEGIES[name]().replay(changes), axis=1)
+
+    return policy
+
+
+# Every policy that can be backtested by name
+POLICIES = {"lowest": lowest_policy, "average": average_policy}
+POLICIES.update({name: strategy_policy(name) for name in STRATEGIES})
+
+
+def simulate(times, targets, columns, transit=None, start=None):
+    """
+    Follows the provider chosen after each reading, as the CloudSurf cron would. A CloudSurf starts whenever the chosen
+    provider isn't the current host, and no other can start until it has finished.
+    :param times: NumPy array of the time of each reading in seconds since the epoch
+    :param targets: NumPy array of the column of the provider chosen after each reading
+    :param columns: int. The number of providers
+    :param transit: timedelta. How long a CloudSurf takes. Defaults to TRANSIT_MINUTES
+    :param start: int. Column of the provider hosting at the first reading. Defaults to the first provider chosen
+    :return: dictionary containing
+    migrations: int. The number of CloudSurfs started
+    transit: float. Seconds spent CloudSurfing
+    hosted: NumPy array of the seconds spent on each provider, not counting CloudSurfs
+    """
+    if transit is None:
+        transit = datetime.timedelta(minutes=TRANSIT_MINUTES)
+    transit = transit.total_seconds()
+    hosted = np.zeros(columns)
+    if not len(times):
+        return {"migrations": 0, "transit": 0.0, "hosted": hosted}
+
+    host = targets[0] if start is None else start
+    now = times[0]
+    migrations = 0
+    in_transit = 0.0
+    while True:
+        # The next reading which isn't the current host and isn't during a CloudSurf
+        ready = np.searchsorted(times, now, side="left")
+        different = np.flatnonzero(targets[ready:] != host)
+        if not len(different):
+            break
+        index = ready + different[0]
+        hosted[host] += times[index] - now
+        arrival = min(times[index] + transit, times[-1])
+        in_transit += arrival - times[index]
+        migrations += 1
+        host = targets[index]
+        now = arrival
+    hosted[host] += times[-1] - now
+    return {"migrations": migrations, "transit": in_transit, "hosted": hosted}
+
+
+def backtest(times, changes, policies=None, transit=None):
+    """
+    Replays stock market readings through policies and simulates the CloudSurfs each of them would have made
+    :param times: NumPy array of the time of each reading in seconds since the epoch
+    :param changes: NumPy array with a row per reading and a column per provider
+    :param policies: list of policy names from POLICIES. Defaults to all of them
+    :param transit: timedelta. How long a CloudSurf takes. Defaults to TRANSIT_MINUTES
+    :return: dictionary of policy name to the result of simulate
+    """
+    if policies is None:
+        policies = list(POLICIES)
+    return {
+        name: simulate(times, POLICIES[name](times, changes), changes.shape[1], transit)
+        for name in policies
+    }
+
+
+def _as_arrays(times, changes):
+    return np.array([t.timestamp() for t in times]), changes
+
+
+def stored_readings(start=None, end=None):
+    """
+    Gets the stock market readings saved in the database as arrays ready for backtest
+    :param start: datetime. Only readings after this time are used
+    :param end: datetime. Only readings up to this time are used
+    :return:
+    providers: list of API objects, in the order of the columns
+    times: NumPy array of the time of each reading in seconds since the epoch
+    changes: NumPy array with a row per reading and a column per provider
+    """
+    providers = list(API.objects.filter(is_provider=True).order_by("id"))
+    readings = StockData.objects.all()
+    if start is not None:
+        readings = readings.filter(time__gt=start)
+    if end is not None:
+        readings = readings.filter(time__lte=end)
+    times, changes = readings_matrix(
+        readings.order_by("time").values_list("time", "provider_id", "change"),
+        [provider.id for provider in providers],
+    )
+    return (providers,) + _as_arrays(times, changes)
+
+
+def csv_readings(path):
+    """
+    Reads stock market readings from a CSV file with a time, provider and change column, like the benchmark fixtures
+    :param path: str. Location of the CSV file
+    :return:
+    providers: list of provider names, in the order of the columns
+    times: NumPy array of the time of each reading in seconds since the epoch
+    changes: NumPy array with a row per reading and a column per provider
+    :raise:
+    ValueError
+        Raised when a time in the file cannot be parsed
+    """
+    with open(path, newline="") as f:
+        rows = [
+            (parse_datetime(row["time"]), row["provider"], float(row["change"]))
+            for row in csv.DictReader(f)
+        ]
+    if any(time is None for time, provider, change in rows):
+        raise ValueError("Invalid time in " + path)
+    providers = sorted({provider for time, provider, change in rows})
+    columns = {provider: i for i, provider in enumerate(providers)}
+    times, changes = readings_matrix(
+        sorted(((t, columns[p], c) for t, p, c in rows), key=lambda row: row[0]),
+        list(range(len(providers))),
+    )
+    return (providers,) + _as_arrays(times, changes)
+
+
+def synthetic_readings(days=365, providers=3, minutes=20, seed=0):
+    """
+    Generates a random walk of share price changes for benchmarking backtests at a realistic size
+    :param days: int. Number of days of readings
+    :param providers: int. Number of providers
+    :param minutes: int. Minutes between readings, as run by the CloudSurf cron
+    :param seed: int. Seed of the random numbers so benchmarks are repeatable
+    :return:
+    providers: list of provider names, in the order of the columns
+    times: NumPy array of the time of each reading in seconds since the epoch
+    changes: NumPy array with a row per reading and a column per provider
+    """
+    random = np.random.RandomState(seed)
+    ticks = days * 24 * 60 // minutes
+    start = timezone.now().timestamp() - ticks * minutes * 60
+    times = start + np.arange(ticks) * minutes * 60.0
+    changes = np.cumsum(random.normal(0, 0.1, (ticks, providers)), axis=0)
+    return ["provider" + str(i) for i in range(providers)], times, changes
@@ -0,0 +1,66 @@
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+# Groups of cached data, named after the rows they are built from. Saving or deleting one of the rows starts a new
+# generation of its group, see signals.py, and everything cached for the old generation is never read again.
+TRANSITIONS = "transitions"
+PREDICTIONS = "predictions"
+PROVIDERS = "providers"
+TIMINGS = "timings"
+RUNS = "runs"
+
+# Tells a missing entry apart from a cached None
+_missing = object()
+
+
+def _generation_key(group):
+    return "generation:" + group
+
+
+def generations(*groups):
+    """
+    Gets the current generation of each group, starting one for any group which doesn't have one in the cache
+    :param groups: names of the groups
+    :return: list of str. The generation of each group
+    """
+    keys = [_generation_key(group) for group in groups]
+    found = cache.get_many(keys)
+    values = []
+    for key in keys:
+        value = found.get(key)
+        if value is None:
+            value = uuid.uuid4().hex
+            # Another process or thread may have started one first
+            if not cache.add(key, value, None):
+                value = cache.get(key, value)
+        values.append(value)
+    return values
+
+
+def invalidate(*groups):
+    """
+    Starts a new generation of groups, so data cached for them is built again the next time it is asked for.
+    Called by the post_save and post_delete receivers, and after queryset updates which don't send signals.
+    :param groups: names of the groups
+    :return: None
+    """
+    cache.set_many({_generation_key(group): uuid.uuid4().hex for group in groups}, None)
+
+
+def cached(groups, name, build, timeout=None):
+    """
+    Gets a value built from the rows of some groups from the cache, building and caching it if it isn't there
+    :param groups: list of the names of the groups the value is built from
+    :param name: str. Identifies the value within its groups, including anything else it depends on such as the page
+    :param build: function taking no arguments which returns the value. It must be picklable
+    :param timeout: int. Seconds to keep the value for. Defaults to settings.CACHE_SECONDS
+    :return: the value
+    """
+    key = "{}:{}".format(name, ":".join(generations(*groups)))
+    value = cache.get(key, _missing)
+    if value is _missing:
+        value = build()
+        cache.set(key, value, settings.CACHE_SECONDS if timeout is None else timeout)
+    return value
@@ -0,0 +1,140 @@
+import random
+import threading
+import time
+import uuid
+
+import numpy as np
+from django.conf import settings
+from django.db import DatabaseError, connection, transaction
+from django.utils import timezone
+
+from .models import API, PlaybookRun, PlaybookTask, Transition
+from .utils_events import progress
+from .utils_host import get_moving_transition
+from .utils_stock_api import save_stock_data
+
+
+def poll_status(providers):
+    """
+    The reads made by every poll of cloudsurfing_status and every view of the transition table
+    :param providers: list of the ids of the cloud providers
+    :return: None
+    """
+    moving = get_moving_transition()
+    if moving is not None:
+        run = moving.runs.order_by("-id").first()
+        if run is not None:
+            progress(run)
+    list(
+        Transition.objects.select_related("start_provider", "end_provider").order_by(
+            "-start_time", "-id"
+        )[: settings.TABLE_PAGE_SIZE]
+    )
+
+
+def write_readings(providers):
+    """
+    The writes made by a run of the CloudSurf cron saving a stock market reading of every provider
+    :param providers: list of the ids of the cloud providers
+    :return: None
+    """
+    names = API.objects.filter(id__in=providers).values_list("name", flat=True)
+    save_stock_data({name: random.uniform(-1, 1) for name in names})
+
+
+def update_transition(providers):
+    """
+    The writes made over a CloudSurf: the transition and its run are created, a task is recorded, and the transition
+    is closed
+    :param providers: list of the ids of the cloud providers
+    :return: None
+    """
+    start, end = random.sample(providers, 2)
+    now = timezone.now()
+    with transaction.atomic():
+        transition = Transition.objects.create(
+            start_provider_id=start, end_provider_id=end
+        )
+        run = PlaybookRun.objects.create(
+            transition=transition, kind=PlaybookRun.DEPLOY, event_log=""
+        )
+    PlaybookTask.objects.create(
+        run=run, position=0, uuid=uuid.uuid4().hex, name="Benchmark", start_time=now
+    )
+    Transition.objects.filter(pk=transition.pk).update(
+        end_time=timezone.now(), succeeded=True
+    )
+
+
+# The operations run by each kind of benchmark client
+WORKLOADS = {
+    "status": poll_status,
+    "cron": write_readings,
+    "transition": update_transition,
+}
+
+
+def run_benchmark(clients, seconds):
+    """
+    Runs each kind of client in WORKLOADS from its own threads against the default database for a while, recording
+    how long every operation takes and how many fail, for instance with "database is locked"
+    :param clients: dictionary of workload name to the number of threads running it
+    :param seconds: float. How long to run for
+    :return: dictionary of workload name to a dictionary containing
+    operations: int. The number of operations which succeeded
+    errors: int. The number which raised a DatabaseError
+    throughput: float. Successful operations per second
+    p50, p95, p99: float. Percentiles of the time taken by the successful operations in milliseconds
+    """
+    providers = list(API.objects.filter(is_provider=True).values_list("id", flat=True))
+    timings = {name: [] for name in clients}
+    errors = {name: 0 for name in clients}
+    lock = threading.Lock()
+    barrier = threading.Barrier(sum(clients.values()) + 1)
+
+    def client(name):
+        operation = WORKLOADS[name]
+        taken = []
+        failed = 0
+        try:
+            barrier.wait()
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                started = time.perf_counter()
+                try:
+                    operation(providers)
+                except DatabaseError:
+                    failed += 1
+                    continue
+                taken.append(time.perf_counter() - started)
+        finally:
+            with lock:
+                timings[name] += taken
+                errors[name] += failed
+            # Each thread has its own database connection, which Django won't close for us
+            connection.close()
+
+    threads = [
+        threading.Thread(target=client, args=(name,), name="bench-" + name)
+        for name, count in clients.items()
+        for i in range(count)
+    ]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    for thread in threads:
+        thread.join()
+
+    results = {}
+    for name in clients:
+        taken = np.array(timings[name]) * 1000
+        p50, p95, p99 = np.percentile(taken, [50, 95, 99]) if len(taken) else [0] * 3
+        results[name] = {
+            "operations": len(taken),
+            "errors": errors[name],
+            "throughput": len(taken) / seconds,
+            "p50": float(p50),
+            "p95": float(p95),
+            "p99": float(p99),
+        }
+    return results
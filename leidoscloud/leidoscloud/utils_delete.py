@@ -1,19 +1,29 @@
 import os
-import subprocess
-import threading
+
+from django.db import connection
 
 from .utils_host import DELETE_LOG_TXT
 
 
-# For a many long annoying reasons this needs to be here.
-# Gunicorn will murder the subprocess, stopping the deletion script from running
-# to prevent this we must wait for the process to finish. However, doing so blocks the
-# webserver, which is the opposite of ideal. To solve this, we wait for the subprocess to finish in a thread!
-def thread_function(proc):
-    proc.wait()
+def _mark_deleted(transition_id):
+    # Records that the host made by a transition is gone once the playbook deleting it succeeds
+    def done(job):
+        from . import utils_cache
+        from .models import Transition
+
+        try:
+            if not job.cancelled() and job.result() == 0:
+                Transition.objects.filter(pk=transition_id).update(deleted=True)
+                # Updating a queryset doesn't send post_save
+                utils_cache.invalidate(utils_cache.TRANSITIONS)
+        finally:
+            # Callbacks run in the job runner's threads, which have their own database connections
+            connection.close()
+
+    return done
 
 
-def delete_host(target):
+def delete_host(target, transition=None):
     # Using os.system is the most efficient way to run the playbook, given that
     # Ansible's python API is private and not at all documented
 
@@ -25,20 +35,36 @@ def delete_host(target):
     new_env = os.environ.copy()
     new_env["ANSIBLE_LOG_PATH"] = DELETE_LOG_TXT
 
-    try:
-        child_proc = subprocess.Popen(
-            [
-                "/home/ubuntu/.local/bin/ansible-playbook",
-                "/home/ubuntu/storm/ansible-scripts/death.yml",
-                "-e",
-                "to_delete_host='" + target.name + "'",
-            ],
-            env=new_env,
-            shell=False,
-            preexec_fn=os.setpgrp,
-        )
-        wait_thread = threading.Thread(target=thread_function, args=(child_proc,))
-        wait_thread.start()
-    except Exception as e:
-        print("Failed to launch deletion script:")
-        print(e)
+    # Record the progress of the deletion against the transition that made it necessary
+    from .models import PlaybookRun, Transition
+    from .utils_events import start_run
+    from .utils_jobs import submit
+    from .utils_vars import remove_when_done, write_playbook_vars
+
+    run, run_env = start_run(transition, PlaybookRun.DELETE)
+    new_env.update(run_env)
+
+    # The host being deleted was made by the transition before the latest one
+    made_by = (
+        Transition.objects.order_by("-id").values_list("id", flat=True)[1:2].first()
+    )
+    vars_path = write_playbook_vars()
+
+    # For a many long annoying reasons the playbook has to be waited on. Gunicorn will murder the subprocess, stopping
+    # the deletion script from running. The job runner waits for it in one of its threads instead of blocking the
+    # webserver, and runs it in its own process group.
+    job = submit(
+        run,
+        [
+            "/home/ubuntu/.local/bin/ansible-playbook",
+            "/home/ubuntu/storm/ansible-scripts/death.yml",
+            "-e",
+            "to_delete_host='" + target.name + "'",
+            "-e",
+            "@" + vars_path,
+        ],
+        new_env,
+    )
+    if made_by is not None:
+        job.add_done_callback(_mark_deleted(made_by))
+    return remove_when_done(job, vars_path)
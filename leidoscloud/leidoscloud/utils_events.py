@@ -0,0 +1,320 @@
+import datetime
+import json
+import os
+
+import numpy as np
+from django.db import transaction
+from django.utils import timezone
+
+from . import utils_cache
+from .models import PlaybookRun, PlaybookTask
+from .utils_host import EVENTS_DIR, get_moving_transition
+
+# Environment variable read by ansible-scripts/callback_plugins/ndjson_events.py
+EVENT_LOG_ENV = "LEIDOSCLOUD_EVENT_LOG"
+
+# Results ordered from best to worst. A task run on several hosts keeps the worst one.
+STATUS_RANK = ["ok", "changed", "skipped", "ignored", "failed", "unreachable"]
+
+
+def start_run(transition, kind):
+    """
+    Records a new playbook run for a transition and picks the file its events will be written to
+    :param transition: Transition object the playbook is being run for
+    :param kind: str. PlaybookRun.DEPLOY or PlaybookRun.DELETE
+    :return:
+    run: the new PlaybookRun object
+    env: dictionary of environment variables to pass to ansible-playbook
+    """
+    os.makedirs(EVENTS_DIR, exist_ok=True)
+    run = PlaybookRun.objects.create(transition=transition, kind=kind)
+    run.event_log = os.path.join(
+        EVENTS_DIR, "{}-{}-{}.ndjson".format(kind, run.transition_id, run.id)
+    )
+    run.save(update_fields=["event_log"])
+    return run, {EVENT_LOG_ENV: run.event_log}
+
+
+def _time(event):
+    return datetime.datetime.fromtimestamp(event["time"], tz=datetime.timezone.utc)
+
+
+def _read_events(path, offset):
+    # The whole lines appended to an event log since offset, and the events on them
+    try:
+        if os.path.getsize(path) <= offset:
+            return 0, []
+        with open(path, "rb") as f:
+            f.seek(offset)
+            data = f.read()
+    except OSError:
+        # ansible hasn't started writing events yet
+        return 0, []
+
+    # Only whole lines are read. The rest is picked up next time.
+    data = data[: data.rfind(b"\n") + 1]
+    events = []
+    for line in data.splitlines():
+        if not line.strip():
+            continue
+        try:
+            event = json.loads(line)
+        except ValueError:
+            event = None
+        if not isinstance(event, dict):
+            # One bad line mustn't stop the rest of the run from being read
+            print("Skipping malformed event in {}: {!r}".format(path, line[:200]))
+            continue
+        events.append(event)
+    return len(data), events
+
+
+def ingest(run):
+    """
+    Reads the events appended to a run's event log since it was last read and stores them in the database.
+    Several readers may race, such as the run's supervisor and adopt_runs in another process. Each of them claims the
+    lines it read by moving the stored offset on from where it found it, so only one of them stores the events.
+    Events which can't be understood are skipped.
+    :param run: PlaybookRun object
+    :return: int. The number of events stored
+    """
+    offset = (
+        PlaybookRun.objects.filter(pk=run.pk).values_list("offset", flat=True).first()
+    )
+    if offset is None:
+        return 0
+    read, events = _read_events(run.event_log, offset)
+    if not read:
+        return 0
+
+    with transaction.atomic():
+        # Claim the lines before storing anything. Whoever read them from the same offset claims nothing
+        if not PlaybookRun.objects.filter(pk=run.pk, offset=offset).update(
+            offset=offset + read
+        ):
+            return 0
+        run.offset = offset + read
+        changed = {}
+        ended = {}
+        tasks = {}
+        position = run.tasks.count()
+        stored = 0
+        for event in events:
+            kind = event.get("event")
+            try:
+                if kind == "playbook_start":
+                    changed["tasks_total"] = int(event.get("tasks", 0))
+                elif kind == "task_start":
+                    start_time = _time(event)
+                    position += 1
+                    tasks[event["uuid"]] = PlaybookTask.objects.create(
+                        run=run,
+                        position=position,
+                        uuid=event["uuid"],
+                        name=str(event.get("task", ""))[:255],
+                        start_time=start_time,
+                    )
+                elif kind == "task_end":
+                    status = event.get("status", "ok")
+                    if status not in STATUS_RANK:
+                        raise ValueError("unknown status " + str(status))
+                    end_time = _time(event)
+                    task = tasks.get(event["uuid"])
+                    if task is None:
+                        task = (
+                            run.tasks.filter(uuid=event["uuid"])
+                            .order_by("-position")
+                            .first()
+                        )
+                        if task is None:
+                            continue
+                        tasks[event["uuid"]] = task
+                    if task.status == PlaybookTask.RUNNING or STATUS_RANK.index(
+                        status
+                    ) > STATUS_RANK.index(task.status):
+                        task.status = status
+                        task.message = event.get("msg", "") or ""
+                    task.end_time = end_time
+                    task.duration = (task.end_time - task.start_time).total_seconds()
+                    task.save()
+                elif kind == "playbook_end":
+                    ended["end_time"] = _time(event)
+                    ended["failed"] = bool(event.get("failed", False))
+            except (KeyError, TypeError, ValueError, OverflowError) as e:
+                print("Skipping event of run {}: {}".format(run.pk, e))
+                continue
+            stored += 1
+        # Only the fields read from the events are written, as the supervisor of the run writes the others meanwhile
+        if changed:
+            PlaybookRun.objects.filter(pk=run.pk).update(**changed)
+        # The supervisor knows best when and how the playbook ended, from its exit code. The events only finish runs
+        # nothing supervised, such as the migration run adopted by the new host
+        if ended and PlaybookRun.objects.filter(
+            pk=run.pk, end_time__isnull=True
+        ).update(**ended):
+            changed.update(ended)
+        for field, value in changed.items():
+            setattr(run, field, value)
+    # Queryset updates don't send the signals which would do this
+    if changed:
+        utils_cache.invalidate(utils_cache.RUNS)
+    return stored
+
+
+def latest_run(transition, kind=PlaybookRun.DEPLOY):
+    """
+    Gets the most recent playbook run of a transition. Its events are read in by the job runner supervising it, see
+    utils_jobs, so this only reads the database.
+    :param transition: Transition object
+    :param kind: str. PlaybookRun.DEPLOY or PlaybookRun.DELETE
+    :return: PlaybookRun object or None if the playbook was never run for the transition
+    """
+    return transition.runs.filter(kind=kind).order_by("-id").first()
+
+
+def progress(run):
+    """
+    Summarises a playbook run from its stored tasks
+    :param run: PlaybookRun object
+    :return: dictionary with the current task, the number of tasks done and expected, the elapsed time of each task in
+    seconds, and the first failure or None
+    """
+    return _summarise(_progress_rows(run))
+
+
+def moving_progress():
+    """
+    Summarises the playbook run of the CloudSurf in progress, as progress does. The rows the summary is built from are
+    cached until a transition, run or task changes, so polls while nothing has changed don't query the database. The
+    elapsed time of the running task is still worked out on every call.
+    :return: dictionary as returned by progress, or None if nothing is moving or its playbook hasn't started
+    """
+    rows = utils_cache.cached(
+        [utils_cache.TRANSITIONS, utils_cache.RUNS], "moving_progress", _moving_rows
+    )
+    return None if rows is None else _summarise(rows)
+
+
+def _moving_rows():
+    moving = get_moving_transition()
+    run = latest_run(moving) if moving is not None else None
+    return None if run is None else _progress_rows(run)
+
+
+def _progress_rows(run):
+    # Everything the summary of a run is built from, which can be cached
+    return {
+        "tasks": list(
+            run.tasks.order_by("position").values(
+                "name", "status", "message", "start_time", "end_time"
+            )
+        ),
+        "tasks_total": run.tasks_total,
+        "end_time": run.end_time,
+        "failed": run.failed,
+    }
+
+
+def _summarise(rows):
+    tasks = rows["tasks"]
+    now = timezone.now()
+    current = tasks[-1] if tasks else None
+    first_failure = next(
+        (t for t in tasks if t["status"] in PlaybookTask.FAILED_STATUSES), None
+    )
+    done = sum(1 for t in tasks if t["status"] != PlaybookTask.RUNNING)
+    return {
+        "current": current["name"] if current else None,
+        "done": done,
+        # More tasks may have run than were counted at the start because of include_tasks
+        "total": max(rows["tasks_total"], done),
+        "finished": rows["end_time"] is not None,
+        "failed": rows["failed"],
+        "elapsed": [
+            (t["name"], ((t["end_time"] or now) - t["start_time"]).total_seconds())
+            for t in tasks
+        ],
+        "first_failure": {
+            "task": first_failure["name"],
+            "msg": first_failure["message"],
+        }
+        if first_failure
+        else None,
+    }
+
+
+def adopt_runs(transition):
+    """
+    Reads the events of a transition's unfinished runs on the host it moved to. The migration playbook copies its event
+    log into EVENTS_DIR on the new host, but the database copied along with it still points at the old host's file.
+    :param transition: Transition object
+    :return: int. The number of events read
+    """
+    read = 0
+    for run in transition.runs.filter(end_time__isnull=True):
+        copied = os.path.join(EVENTS_DIR, os.path.basename(run.event_log))
+        if run.event_log != copied and os.path.exists(copied):
+            run.event_log = copied
+            run.save(update_fields=["event_log"])
+        read += ingest(run)
+    return read
+
+
+def finish_runs(transition):
+    """
+    Ends the unfinished deploy runs of a transition once the migration playbook has reached its last task on the new
+    host. Their supervisor was on the old host, and the events of the tasks still running are only written after the
+    event log was copied, so those tasks are ended now as well.
+    :param transition: Transition object
+    :return: int. The number of runs ended
+    """
+    now = timezone.now()
+    runs = transition.runs.filter(kind=PlaybookRun.DEPLOY, end_time__isnull=True)
+    for task in PlaybookTask.objects.filter(run__in=runs, end_time__isnull=True):
+        task.status = "ok"
+        task.end_time = now
+        task.duration = (task.end_time - task.start_time).total_seconds()
+        task.save()
+    # A failed task would have stopped the playbook before its last task
+    finished = runs.update(status=PlaybookRun.SUCCEEDED, end_time=now, failed=False)
+    utils_cache.invalidate(utils_cache.RUNS)
+    return finished
+
+
+def phase_timings(kind=PlaybookRun.DEPLOY):
+    """
+    Works out how long each task of a playbook usually takes when moving to each provider
+    :param kind: str. PlaybookRun.DEPLOY or PlaybookRun.DELETE
+    :return: list of dictionaries, one per provider moved to, containing
+    provider: str. The long name of the provider
+    phases: list of dictionaries of the task name, the number of times it ran, and the p50 and p95 of its duration in
+    seconds, in the order the tasks usually run
+    """
+    finished = PlaybookTask.objects.filter(
+        run__kind=kind, duration__isnull=False
+    ).values_list(
+        "run__transition__end_provider__long_name", "name", "position", "duration"
+    )
+    grouped = {}
+    for provider, name, position, duration in finished.iterator():
+        phase = grouped.setdefault(provider or "Unknown", {}).setdefault(name, ([], []))
+        phase[0].append(position)
+        phase[1].append(duration)
+
+    timings = []
+    for provider in sorted(grouped):
+        phases = []
+        for name, (positions, durations) in grouped[provider].items():
+            p50, p95 = np.percentile(durations, [50, 95])
+            phases.append(
+                {
+                    "name": name,
+                    "runs": len(durations),
+                    "p50": float(p50),
+                    "p95": float(p95),
+                    "position": float(np.median(positions)),
+                }
+            )
+        phases.sort(key=lambda phase: phase["position"])
+        timings.append({"provider": provider, "phases": phases})
+    return timings
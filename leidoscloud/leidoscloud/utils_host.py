@@ -1,90 +1,120 @@
+import functools
 import os
+import sys
 from pathlib import Path
 
 from django.core.exceptions import ImproperlyConfigured
 from django.db.models import CharField, F, Value
 
+from . import utils_cache
 from .settings import BASE_DIR
 
 DELETE_LOG_TXT = os.path.join(BASE_DIR, "delete_log.txt")
-MAIN_LOG_TXT = os.path.join(os.path.dirname(__file__), "..", "ansible.log")
+# The load tests point a server at a log of their own with LEIDOSCLOUD_MAIN_LOG, see utils_loadtest, and so do the
+# tests, see settings.py
+MAIN_LOG_TXT = os.environ.get(
+    "LEIDOSCLOUD_MAIN_LOG", os.path.join(os.path.dirname(__file__), "..", "ansible.log")
+)
+# The ansible callback in ansible-scripts/callback_plugins writes one NDJSON file per playbook run here
+EVENTS_DIR = os.path.join(BASE_DIR, "events")
+
+
+def get_management_command():
+    """
+    Finds the manage.py command this process was started to run
+    :return: str. The name of the command, or None when Django is being served by gunicorn or anything but manage.py
+    """
+    if os.path.basename(sys.argv[0]) != "manage.py":
+        return None
+    return sys.argv[1] if len(sys.argv) > 1 else "help"
+
+
+# The keys created by the population script which are vital for normal operation, by the name of the API they belong to
+# google is left out until we get it in the database
+REQUIRED_KEYS = {
+    "DuckDNS": ["token"],
+    "azure": ["subscription_id", "client_id", "tenant", "secret"],
+    "aws": ["secret_key", "access_key"],
+    "AlphaVantage": ["key"],
+}
+
+
+def get_missing_keys():
+    """
+    Finds the keys in REQUIRED_KEYS which don't exist or have no value, using a single query.
+    The result is cached until a Key or API object is saved or deleted by any process sharing the cache, see utils_cache
+    :return: list of (API name, key name) tuples, empty if every key is present
+    """
+    return utils_cache.cached(
+        [utils_cache.PROVIDERS], "missing_keys", _find_missing_keys
+    )
+
+
+def _find_missing_keys():
+    from .models import Key
+
+    present = set(
+        Key.objects.filter(provider__name__in=REQUIRED_KEYS.keys())
+        .exclude(value="")
+        .values_list("provider__name", "name")
+    )
+    return [
+        (api, key)
+        for api, keys in REQUIRED_KEYS.items()
+        for key in keys
+        if (api, key) not in present
+    ]
 
 
-# This is heavily customized for the default population script keys that are included
-# But are vital for normal operation
 def are_population_script_keys_present():
-    try:
-        from .models import Key
-        from .models import API
-
-        # google = API.objects.filter(name="google")[0] # Commented out until we get it in the database
-        aws = API.objects.filter(name="aws")[0]
-        azure = API.objects.filter(name="azure")[0]
-        duck = API.objects.filter(name="DuckDNS")[0]
-        av = API.objects.filter(name="AlphaVantage")[0]
-
-        # Check for duck key
-        duck_token = Key.objects.get(provider=duck, name="token")
-        if duck_token.value is "":
-            return False
-
-        # Check for azure keys
-        azure_token = Key.objects.get(provider=azure, name="subscription_id")
-        if azure_token.value is "":
-            return False
-        azure_token = Key.objects.get(provider=azure, name="client_id")
-        if azure_token.value is "":
-            return False
-        azure_token = Key.objects.get(provider=azure, name="tenant")
-        if azure_token.value is "":
-            return False
-        azure_token = Key.objects.get(provider=azure, name="secret")
-        if azure_token.value is "":
-            return False
-
-        # Check for AWS keys
-        aws_token = Key.objects.get(provider=aws, name="secret_key")
-        if aws_token.value is "":
-            return False
-        aws_token = Key.objects.get(provider=aws, name="access_key")
-        if aws_token.value is "":
-            return False
-
-        # Check for AlphaVantage key
-        av_token = Key.objects.get(provider=av, name="key")
-        if av_token.value is "":
-            return False
-
-        # If all succeed!
-        return True
-    except:
-        # If anything goes wrong, tell the user
-        return False
+    """
+    Checks that every key in REQUIRED_KEYS has been given a value
+    :return: True if all keys are present
+    """
+    return not get_missing_keys()
+
+
+@functools.lru_cache(maxsize=None)
+def read_sys_vendor():
+    """
+    Reads the file that identifies the hardware vendor, and so the cloud provider, of the machine
+    :return: str. contents of the file, or an empty string if it does not exist
+    """
+    # The contents of this file is unique on every cloud provider.
+    bv_file = Path("/sys/devices/virtual/dmi/id/sys_vendor")
+
+    file_content = ""
+    if bv_file.exists():
+        f = open(bv_file, "r")
+        file_content = f.read()
+        f.close()
+    return file_content
 
 
 def get_current_cloud_host():
     """
-    Retrieves the current cloud host from a specific file on the provider it's on that identifies which provider it's on
+    Retrieves the current cloud host from a specific file on the provider it's on that identifies which provider it's on.
+    The host can't change while the machine is running, so the result is cached until an API object is saved or deleted
+    by any process sharing the cache, see utils_cache
     :return:
     provider object of the host it is on
     :raise:
     ImproperlyConfigured
         Raised when the population script was not run
     """
+    return utils_cache.cached(
+        [utils_cache.PROVIDERS], "current_cloud_host", _find_current_cloud_host
+    )
+
+
+def _find_current_cloud_host():
     # Have to import here because otherwise the method is imported at the wrong time
     from .models import API
 
-    # The contents of this file is unique on every cloud provider.
-    bv_file = Path("/sys/devices/virtual/dmi/id/sys_vendor")
-
-    file_content = ""
-    if bv_file.exists():
-        f = open(bv_file, "r")
-        file_content = f.read()
-        f.close()
+    file_content = read_sys_vendor()
 
     # Check if we need to run the population script by testing for Duck, our test value
-    if API.objects.filter(name="DuckDNS").count() == 0:
+    if not API.objects.filter(name="DuckDNS").exists():
         # we need to run the population script!
         raise ImproperlyConfigured(
             "The population script was not run, will not return current cloud host as this could have dangerous "
@@ -101,3 +131,23 @@ def get_current_cloud_host():
     if len(cloud_host) > 0:
         return cloud_host[0]
     return API.objects.filter(name="none")[0]
+
+
+def get_moving_transition():
+    """
+    Gets the CloudSurf in progress, which is the latest transition if it hasn't ended. An older transition left open by
+    a move which failed long ago is not in progress. The newest open transition is found through transition_open_idx,
+    so when nothing is moving this is one query which doesn't get slower as the history grows.
+    :return: Transition object or None if nothing is moving
+    """
+    from .models import Transition
+
+    moving = (
+        Transition.objects.filter(end_time__isnull=True).order_by("-start_time").first()
+    )
+    if (
+        moving is not None
+        and Transition.objects.filter(start_time__gt=moving.start_time).exists()
+    ):
+        return None
+    return moving
@@ -0,0 +1,212 @@
+import concurrent.futures
+import json
+import os
+import signal
+import subprocess
+import threading
+
+from django.conf import settings
+from django.db import DatabaseError, connection
+from django.utils import timezone
+
+from . import utils_cache
+from .models import PlaybookRun
+from .utils_events import ingest
+from .utils_host import get_management_command
+
+# Shared by every job started by the process, created the first time one is submitted
+_executor = None
+_limits = {}
+_processes = {}
+# The runs submitted by this process which haven't finished yet, and those of them which have been cancelled
+_owned = set()
+_cancelled = set()
+_jobs_lock = threading.Lock()
+
+
+# Custom exceptions
+class NotSupervisingException(Exception):
+    pass
+
+
+def _get_executor():
+    # The pool's threads only supervise the playbooks, so a few of them are plenty
+    global _executor
+    with _jobs_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=settings.JOB_WORKERS, thread_name_prefix="job"
+            )
+        return _executor
+
+
+def _get_limit(kind):
+    # Jobs of a kind wait for one of its JOB_LIMITS slots before starting
+    with _jobs_lock:
+        if kind not in _limits:
+            _limits[kind] = threading.BoundedSemaphore(
+                settings.JOB_LIMITS.get(kind, settings.JOB_WORKERS)
+            )
+        return _limits[kind]
+
+
+def submit(run, command, env=None):
+    """
+    Queues a playbook run to be started by the worker pool once the limit for its kind allows. The run's status, process
+    id, exit code and timings are recorded as it goes.
+    The pool's threads supervise the run until the playbook ends, and this process won't exit before then. So only the
+    web server and the manage.py commands in settings.JOB_COMMANDS may start playbooks, rather than a short command
+    silently waiting an hour for one to finish.
+    :param run: PlaybookRun object, see utils_events.start_run
+    :param command: list of the command line arguments of the playbook
+    :param env: dictionary of environment variables for the playbook. Defaults to those of this process
+    :return: Future which resolves to the exit code of the playbook, or None if it was cancelled before starting
+    :raise:
+    NotSupervisingException
+        Raised when this process is running a manage.py command which isn't in settings.JOB_COMMANDS
+    """
+    command_name = get_management_command()
+    if command_name is not None and command_name not in settings.JOB_COMMANDS:
+        raise NotSupervisingException(
+            "manage.py "
+            + command_name
+            + " can't start playbooks, as it would have to wait for them to end before exiting"
+        )
+    run.command = json.dumps(command)
+    run.status = PlaybookRun.QUEUED
+    run.queued_time = timezone.now()
+    run.save(update_fields=["command", "status", "queued_time"])
+    with _jobs_lock:
+        _owned.add(run.pk)
+    return _get_executor().submit(_supervise, run.pk, run.kind, command, env)
+
+
+def _supervise(run_id, kind, command, env):
+    try:
+        with _get_limit(kind):
+            # Only start the run if it hasn't been cancelled while it was queued
+            if not PlaybookRun.objects.filter(
+                pk=run_id, status=PlaybookRun.QUEUED
+            ).update(status=PlaybookRun.RUNNING, start_time=timezone.now()):
+                return None
+            try:
+                # The playbook leads its own process group, so it can be cancelled along with its ssh children and
+                # gunicorn won't take it down when a worker restarts
+                process = subprocess.Popen(command, env=env, preexec_fn=os.setpgrp)
+            except OSError as e:
+                print("Failed to launch " + kind + " playbook:")
+                print(e)
+                _finish(run_id, None, PlaybookRun.FAILED)
+                return None
+
+            PlaybookRun.objects.filter(pk=run_id).update(pid=process.pid)
+            with _jobs_lock:
+                _processes[run_id] = process
+                cancelled = run_id in _cancelled
+            if cancelled:
+                _terminate(process.pid)
+
+            # Events are read in as the playbook writes them, so the status views only have to read the database
+            run = PlaybookRun.objects.get(pk=run_id)
+            while True:
+                try:
+                    exit_code = process.wait(settings.JOB_INGEST_SECONDS)
+                    break
+                except subprocess.TimeoutExpired:
+                    _ingest(run)
+            with _jobs_lock:
+                del _processes[run_id]
+                cancelled = run_id in _cancelled
+            if cancelled:
+                status = PlaybookRun.CANCELLED
+            elif exit_code == 0:
+                status = PlaybookRun.SUCCEEDED
+            else:
+                status = PlaybookRun.FAILED
+            _finish(run_id, exit_code, status)
+            # Read the rest of the events so the timing of every task is kept
+            _ingest(run)
+            return exit_code
+    finally:
+        with _jobs_lock:
+            _owned.discard(run_id)
+            _cancelled.discard(run_id)
+        # Each pool thread has its own database connection, which Django won't close for us
+        connection.close()
+
+
+def _ingest(run):
+    # A busy database only delays the events until the next try
+    try:
+        ingest(run)
+    except DatabaseError as e:
+        print("Failed to read the events of run {}:".format(run.pk))
+        print(e)
+
+
+def _finish(run_id, exit_code, status):
+    now = timezone.now()
+    PlaybookRun.objects.filter(pk=run_id).update(
+        exit_code=exit_code, failed=status != PlaybookRun.SUCCEEDED
+    )
+    # A run cancelled from another process has already been marked as such
+    PlaybookRun.objects.filter(pk=run_id, status=PlaybookRun.RUNNING).update(
+        status=status, end_time=now
+    )
+    utils_cache.invalidate(utils_cache.RUNS)
+
+
+def _terminate(pid):
+    try:
+        os.killpg(pid, signal.SIGTERM)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def cancel(run):
+    """
+    Cancels a playbook run. A queued run never starts, and a running one is sent SIGTERM along with every process it
+    started. Runs started by another process on this host are stopped by their recorded process id.
+    :param run: PlaybookRun object
+    :return: bool. True if the run was queued or running
+    """
+    now = timezone.now()
+    if PlaybookRun.objects.filter(pk=run.pk, status=PlaybookRun.QUEUED).update(
+        status=PlaybookRun.CANCELLED, end_time=now
+    ):
+        utils_cache.invalidate(utils_cache.RUNS)
+        return True
+
+    with _jobs_lock:
+        # If the run is ours but hasn't been registered yet, its supervisor stops it as soon as it starts. Runs of other
+        # processes are never remembered, as nothing here would forget them
+        if run.pk in _owned:
+            _cancelled.add(run.pk)
+        process = _processes.get(run.pk)
+    if process is not None:
+        _terminate(process.pid)
+        return True
+
+    running = PlaybookRun.objects.filter(pk=run.pk, status=PlaybookRun.RUNNING)
+    pid = running.values_list("pid", flat=True).first()
+    if pid is None:
+        return running.exists()
+    _terminate(pid)
+    running.update(status=PlaybookRun.CANCELLED, end_time=now, failed=True)
+    utils_cache.invalidate(utils_cache.RUNS)
+    return True
+
+
+def cancel_runs(transition, kind=None):
+    """
+    Cancels every queued or running playbook run of a transition
+    :param transition: Transition object
+    :param kind: str. PlaybookRun.DEPLOY or PlaybookRun.DELETE to only cancel runs of that kind
+    :return: int. The number of runs cancelled
+    """
+    runs = PlaybookRun.objects.filter(
+        transition=transition, status__in=[PlaybookRun.QUEUED, PlaybookRun.RUNNING]
+    )
+    if kind is not None:
+        runs = runs.filter(kind=kind)
+    return sum(cancel(run) for run in runs)
@@ -0,0 +1,113 @@
+import concurrent.futures
+import datetime
+import os
+import socket
+import threading
+import uuid
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import MigrationLease
+
+# The lease which has to be held to launch the migration playbook
+CLOUDSURF_LEASE = "cloudsurf"
+
+
+def _expiry(now):
+    return now + datetime.timedelta(seconds=settings.LEASE_SECONDS)
+
+
+def acquire_lease(name=CLOUDSURF_LEASE):
+    """
+    Takes a lease if it is free or has expired. Only one caller can succeed however many processes try at once,
+    because the lease is taken by a single UPDATE which only matches a free row.
+    :param name: str. Name of the lease
+    :return: the MigrationLease now held, or None if someone else holds it
+    """
+    now = timezone.now()
+    MigrationLease.objects.get_or_create(name=name)
+    owner = "{}:{}:{}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+    taken = (
+        MigrationLease.objects.filter(name=name)
+        .filter(Q(owner="") | Q(expires_at__lt=now))
+        .update(
+            owner=owner,
+            transition=None,
+            acquired_at=now,
+            heartbeat_at=now,
+            expires_at=_expiry(now),
+        )
+    )
+    if not taken:
+        return None
+    return MigrationLease.objects.get(name=name)
+
+
+def renew_lease(lease, transition=None):
+    """
+    Pushes back the expiry of a lease, as long as it is still held by the same owner
+    :param lease: MigrationLease returned by acquire_lease
+    :param transition: Transition object to record against the lease. The recorded transition is kept if None
+    :return: bool. False if the lease has been lost
+    """
+    now = timezone.now()
+    fields = {"heartbeat_at": now, "expires_at": _expiry(now)}
+    if transition is not None:
+        fields["transition"] = transition
+    return bool(
+        MigrationLease.objects.filter(pk=lease.pk, owner=lease.owner).update(**fields)
+    )
+
+
+def release_lease(lease):
+    """
+    Frees a lease, unless it has already lapsed and been taken by someone else
+    :param lease: MigrationLease returned by acquire_lease
+    :return: None
+    """
+    MigrationLease.objects.filter(pk=lease.pk, owner=lease.owner).update(
+        owner="", expires_at=None
+    )
+
+
+def break_lease(name=CLOUDSURF_LEASE):
+    """
+    Frees a lease whoever holds it. Only for when the holder is known to be gone, such as after killing ansible or
+    when the database has been copied from the previous host
+    :param name: str. Name of the lease
+    :return: None
+    """
+    MigrationLease.objects.filter(name=name).update(owner="", expires_at=None)
+
+
+def hold_lease(lease, job):
+    """
+    Keeps renewing a lease every LEASE_HEARTBEAT_SECONDS until a job finishes, then releases it. The thread isn't a
+    daemon, so a short-lived command such as runcrons keeps the lease until the playbook it started exits.
+    :param lease: MigrationLease returned by acquire_lease
+    :param job: Future of the playbook, see utils_jobs.submit
+    :return: the Thread renewing the lease
+    """
+
+    def heartbeat():
+        try:
+            while True:
+                done, running = concurrent.futures.wait(
+                    [job], settings.LEASE_HEARTBEAT_SECONDS
+                )
+                if done:
+                    break
+                if not renew_lease(lease):
+                    # Broken by someone who knows we are gone
+                    return
+            release_lease(lease)
+        finally:
+            # Threads get their own database connection, which Django won't close for us
+            connection.close()
+
+    thread = threading.Thread(target=heartbeat, name="lease-" + lease.name)
+    thread.start()
+    return thread
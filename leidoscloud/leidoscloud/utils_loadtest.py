@@ -0,0 +1,273 @@
+import datetime
+import http.client
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+import numpy as np
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import utils_cache
+from .models import API, StockData, Transition
+
+# Sizes of the seeded datasets. large is what a host which has been CloudSurfing for years might hold
+DATASETS = {
+    "small": {"transitions": 1000, "stock_data": 10000, "log_bytes": 1024 ** 2},
+    "medium": {"transitions": 10000, "stock_data": 100000, "log_bytes": 10 * 1024 ** 2},
+    "large": {
+        "transitions": 100000,
+        "stock_data": 1000000,
+        "log_bytes": 50 * 1024 ** 2,
+    },
+}
+# Rows are saved this many at a time
+SEED_BATCH_SIZE = 5000
+# Readings are spread over this many days before now, so the default range of the chart covers some of them
+SEED_DAYS = 90
+# Tasks repeated to fill the seeded log. The last one is the task every log on a migrated host finishes with
+SEED_TASKS = [
+    "Gathering Facts",
+    "Load in the SSH public key",
+    "Updating apt cache",
+    "Installing the requirements from the wheelhouse",
+    "Unpacking the release",
+    "Copying self to server",
+]
+# The first seeded log line is dated here, and each following task a second later
+SEED_LOG_START = datetime.datetime(2020, 1, 1)
+
+# Latencies are only counted as regressions once they have grown by this many milliseconds as well, so noise in
+# requests which take a few milliseconds doesn't fail the run
+LATENCY_SLACK_MS = 1.0
+# Metrics compared against the baseline which should not go up
+LOWER_IS_BETTER = ["p50", "p95", "p99", "errors", "cold_queries", "warm_queries"]
+
+
+def endpoints():
+    """
+    The pages measured by the load tests. The status stream is left out as it never finishes
+    :return: dictionary of name to path
+    """
+    return {
+        "index": reverse("index"),
+        "status": reverse("status"),
+        "log": reverse("log"),
+        "cloudsurf": reverse("CloudSurf"),
+        "predictions": reverse("predictions"),
+        "stock_series": reverse("stock_series"),
+    }
+
+
+def seed(transitions, stock_data, log_path, log_bytes, seed=0):
+    """
+    Fills the database with transitions between the providers and readings of their stock market change, and writes
+    an ansible log. The same seed always gives the same rows, dated relative to now, and the same log.
+    The population script must have been run first.
+    :param transitions: int. Number of finished transitions to add
+    :param stock_data: int. Number of readings to add, shared between the providers
+    :param log_path: str. Where to write the log
+    :param log_bytes: int. Size of the log
+    :param seed: int. Seed of the random numbers
+    :return: None
+    """
+    rng = random.Random(seed)
+    providers = list(API.objects.filter(is_provider=True).order_by("id"))
+    now = timezone.now()
+    span = datetime.timedelta(days=SEED_DAYS)
+
+    def batches(rows, total):
+        for start in range(0, total, SEED_BATCH_SIZE):
+            yield [rows(i) for i in range(start, min(start + SEED_BATCH_SIZE, total))]
+
+    def transition(i):
+        start_provider, end_provider = rng.sample(providers, 2)
+        start_time = now - span * (i + 1) / transitions
+        return Transition(
+            start_provider=start_provider,
+            end_provider=end_provider,
+            start_time=start_time,
+            end_time=start_time + datetime.timedelta(minutes=rng.uniform(5, 30)),
+            succeeded=rng.random() < 0.9,
+            deleted=True,
+        )
+
+    def reading(i):
+        return StockData(
+            provider=providers[i % len(providers)],
+            time=now - span * (i // len(providers) + 1) * len(providers) / stock_data,
+            change=rng.gauss(0, 1),
+        )
+
+    with transaction.atomic():
+        for batch in batches(transition, transitions):
+            Transition.objects.bulk_create(batch)
+        for batch in batches(reading, stock_data):
+            StockData.objects.bulk_create(batch)
+    # bulk_create doesn't send the signals which would do this
+    utils_cache.invalidate(
+        utils_cache.TRANSITIONS, utils_cache.PREDICTIONS, utils_cache.PROVIDERS
+    )
+
+    written = 0
+    step = 0
+    with open(log_path, "w") as f:
+        while written < log_bytes or step % len(SEED_TASKS):
+            date = SEED_LOG_START + datetime.timedelta(seconds=step)
+            prefix = "{},000 p=ansible u=1000 | ".format(
+                date.strftime("%Y-%m-%d %H:%M:%S")
+            )
+            lines = [
+                prefix
+                + "TASK [{}] ".format(SEED_TASKS[step % len(SEED_TASKS)])
+                + "*" * 40,
+                prefix + "ok: [cloudhost]",
+                "",
+            ]
+            text = "\n".join(lines) + "\n"
+            f.write(text)
+            written += len(text)
+            step += 1
+
+
+def count_queries(client, paths):
+    """
+    Counts the database queries made by requests for each page, first with nothing cached and then again
+    :param client: django.test.Client logged in as a user
+    :param paths: dictionary of name to path
+    :return: dictionary of name to a dictionary containing cold_queries and warm_queries
+    :raise:
+    ValueError
+        Raised when a page isn't answered with status 200, as its count wouldn't be the count of the page
+    """
+    cache.clear()
+    counts = {}
+    for name, path in paths.items():
+        counts[name] = {}
+        for key in ("cold_queries", "warm_queries"):
+            with CaptureQueriesContext(connection) as queries:
+                response = client.get(path)
+            if response.status_code != 200:
+                raise ValueError(
+                    "{} answered with status {}".format(path, response.status_code)
+                )
+            counts[name][key] = len(queries)
+    return counts
+
+
+def run_load(url, paths, clients, seconds, headers=None):
+    """
+    Requests the pages from a running server with concurrent clients for a while. Each client is a thread with its
+    own keep-alive connection, asking for each page in turn, and waits for every response before sending the next
+    :param url: str. Root URL of the server, such as http://127.0.0.1:8000
+    :param paths: dictionary of name to path
+    :param clients: int. Number of clients
+    :param seconds: float. How long to run for
+    :param headers: dictionary of headers sent with every request, such as the session cookie
+    :return: dictionary of page name to a dictionary containing
+    requests: int. The number of requests answered with status 200
+    errors: int. The number of requests which failed or were answered with another status
+    throughput: float. Successful requests per second
+    p50, p95, p99: float. Percentiles of the time taken by the successful requests in milliseconds
+    """
+    location = urlparse(url)
+    names = list(paths)
+    timings = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+    lock = threading.Lock()
+    barrier = threading.Barrier(clients + 1)
+
+    def client(number):
+        server = http.client.HTTPConnection(
+            location.hostname, location.port, timeout=60
+        )
+        taken = {name: [] for name in names}
+        failed = {name: 0 for name in names}
+        # Clients start on different pages so they aren't all waiting on the slowest one at once
+        position = number
+        try:
+            barrier.wait()
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                name = names[position % len(names)]
+                position += 1
+                started = time.perf_counter()
+                try:
+                    server.request("GET", paths[name], headers=headers or {})
+                    response = server.getresponse()
+                    response.read()
+                except (OSError, http.client.HTTPException):
+                    failed[name] += 1
+                    server.close()
+                    continue
+                if response.status != 200:
+                    failed[name] += 1
+                    continue
+                taken[name].append(time.perf_counter() - started)
+        finally:
+            server.close()
+            with lock:
+                for name in names:
+                    timings[name] += taken[name]
+                    errors[name] += failed[name]
+
+    threads = [
+        threading.Thread(target=client, args=(i,), name="load-{}".format(i))
+        for i in range(clients)
+    ]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    for thread in threads:
+        thread.join()
+
+    results = {}
+    for name in names:
+        taken = np.array(timings[name]) * 1000
+        p50, p95, p99 = np.percentile(taken, [50, 95, 99]) if len(taken) else [0] * 3
+        results[name] = {
+            "requests": len(taken),
+            "errors": errors[name],
+            "throughput": len(taken) / seconds,
+            "p50": float(p50),
+            "p95": float(p95),
+            "p99": float(p99),
+        }
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Finds the pages which have got slower or make more queries than in an earlier run. A metric has regressed when it
+    has grown by more than threshold times its baseline, or throughput has fallen by as much. Pages or metrics missing
+    from the baseline are not compared.
+    :param results: dictionary of page name to metrics, as returned by run_load with the counts of count_queries
+    :param baseline: results of the earlier run
+    :param threshold: float. Fraction of the baseline a metric may grow by, such as 0.2 for 20%
+    :return: list of str. Describes each regression
+    """
+    regressions = []
+    for name, result in results.items():
+        old = baseline.get(name, {})
+        for metric in LOWER_IS_BETTER:
+            if metric not in result or metric not in old:
+                continue
+            slack = LATENCY_SLACK_MS if metric.startswith("p") else 0
+            if result[metric] > old[metric] * (1 + threshold) + slack:
+                regressions.append(
+                    "{} {} went from {:g} to {:g}".format(
+                        name, metric, old[metric], result[metric]
+                    )
+                )
+        if "throughput" in result and "throughput" in old:
+            if result["throughput"] < old["throughput"] * (1 - threshold):
+                regressions.append(
+                    "{} throughput went from {:g} to {:g} requests per second".format(
+                        name, old["throughput"], result["throughput"]
+                    )
+                )
+    return regressions
@@ -0,0 +1,403 @@
+import datetime
+import json
+import os
+import threading
+import time
+import zlib
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.dateparse import parse_datetime
+
+from .utils_host import MAIN_LOG_TXT
+
+# Size of the first window read from the end of a log that has not been seen before.
+# The window doubles until a status line is found or the start of the file is reached.
+TAIL_WINDOW_BYTES = 4096
+
+# How often a status stream checks the log, sends a keepalive comment and how long it lives before the browser
+# has to reconnect. Streams are closed periodically so they don't hold a gunicorn thread forever.
+STREAM_POLL_SECONDS = 1
+STREAM_KEEPALIVE_SECONDS = 15
+STREAM_MAX_SECONDS = 300
+STREAM_RETRY_MILLISECONDS = 3000
+
+# Pages of the full log views. Reads are bounded by these so memory use doesn't grow with the log.
+LOG_TAIL_LINES = 500
+LOG_MAX_TAIL_LINES = 5000
+LOG_PAGE_BYTES = 64 * 1024
+LOG_MAX_PAGE_BYTES = 1024 * 1024
+LOG_CHUNK_BYTES = 64 * 1024
+
+# Number of bytes before the cursor that are re-read to make sure the file has only been appended to
+ANCHOR_BYTES = 64
+
+
+def _is_status_line(line):
+    return b"TASK" in line or b"fatal" in line
+
+
+class LogTailCache:
+    """
+    Incrementally follows an ansible log and remembers the newest line containing a TASK or a fatal error.
+
+    The log is only re-read when its inode, size or mtime changes, and then only the bytes appended since the
+    previous read are parsed. If the file has been replaced the cache starts again from its end. If it has been
+    truncated or rewritten in place, which shows as it shrinking, its mtime going backwards or the bytes already read
+    changing, it is read again from the start, as it may have grown past the cursor since.
+
+    ...
+    Attributes
+    ----------
+    path : str
+        The location of the log file being followed
+    inode : int
+        The inode of the log file when it was last read
+    cursor : int
+        Byte offset of the start of the last, unterminated line of the log
+    mtime_ns : int
+        The modification time of the log file when it was last read
+    line_offset : int
+        Byte offset of the newest status line, or None if there is no status line
+
+    Methods
+    -------
+    latest(self)
+        Returns the newest status line, its byte offset and the date parsed from it
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._reset(None)
+
+    def _reset(self, inode):
+        self._key = None
+        self.inode = inode
+        self.mtime_ns = None
+        self.cursor = 0
+        self._anchor = b""
+        self._partial = b""
+        self._line = None
+        self.line_offset = None
+        self._date = None
+        self._result = (None, None, None)
+
+    def latest(self):
+        """
+        Finds the newest line of the log containing TASK or fatal, reading as little of the file as possible
+        :return:
+        line: str. The newest status line, or None if the log does not contain one
+        offset: int. The byte offset of that line in the log
+        date: datetime. The date at the start of that line, or None if it could not be parsed
+        :raise:
+        OSError
+            Raised when the log file cannot be opened
+        """
+        stat = os.stat(self.path)
+        key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            if key != self._key:
+                with open(self.path, "rb") as fh:
+                    if stat.st_ino != self.inode:
+                        self._reset(stat.st_ino)
+                        self._seed(fh, stat.st_size)
+                    elif (
+                        stat.st_size < self.cursor
+                        or stat.st_mtime_ns < self.mtime_ns
+                        or not self._append_only(fh)
+                    ):
+                        # Truncated and written again, so nothing read before can be trusted
+                        self._reset(stat.st_ino)
+                        fh.seek(0)
+                        self._consume(fh.read(stat.st_size))
+                    else:
+                        fh.seek(self.cursor)
+                        self._consume(fh.read(stat.st_size - self.cursor))
+                self._key = key
+                self.mtime_ns = stat.st_mtime_ns
+                self._result = self._current()
+            return self._result
+
+    def _append_only(self, fh):
+        # The bytes just before the cursor and the remembered status line must be unchanged
+        if self._line is not None:
+            fh.seek(self.line_offset)
+            if fh.read(len(self._line)) != self._line:
+                return False
+        fh.seek(self.cursor - len(self._anchor))
+        return fh.read(len(self._anchor)) == self._anchor
+
+    def _seed(self, fh, size):
+        window = TAIL_WINDOW_BYTES
+        while True:
+            start = max(0, size - window)
+            fh.seek(start)
+            data = fh.read(size - start)
+            # The first fragment is the end of an earlier line unless we are at the start of the file
+            skip = 0 if start == 0 else data.find(b"\n") + 1
+            if start == 0 or skip > 0:
+                self.cursor = start + skip
+                self._anchor = b""
+                self._consume(data[skip:])
+                if self._line is not None or start == 0:
+                    return
+            window *= 2
+
+    def _consume(self, data):
+        # Every line but the last is complete. The last one is kept aside until its newline arrives.
+        lines = data.split(b"\n")
+        self._partial = lines.pop()
+        offset = self.cursor
+        for line in lines:
+            line += b"\n"
+            if _is_status_line(line):
+                self._set_line(line, offset)
+            offset += len(line)
+        self._anchor = (self._anchor + data[: offset - self.cursor])[-ANCHOR_BYTES:]
+        self.cursor = offset
+
+    def _set_line(self, line, offset):
+        if line != self._line or offset != self.line_offset:
+            self._line = line
+            self.line_offset = offset
+            self._date = parse_datetime(line[0:18].decode(errors="replace"))
+
+    def _current(self):
+        if _is_status_line(self._partial):
+            partial_date = parse_datetime(self._partial[0:18].decode(errors="replace"))
+            return self._partial.decode(errors="replace"), self.cursor, partial_date
+        if self._line is None:
+            return None, None, None
+        return self._line.decode(errors="replace"), self.line_offset, self._date
+
+
+# One cache per log file, shared by every request handled by this process
+_tail_caches = {}
+_tail_caches_lock = threading.Lock()
+
+
+def get_log_tail(path=MAIN_LOG_TXT):
+    """
+    Gets the shared LogTailCache for a log file, creating it the first time it is asked for
+    :param path: str. Location of the log file
+    :return: LogTailCache for that file
+    """
+    with _tail_caches_lock:
+        if path not in _tail_caches:
+            _tail_caches[path] = LogTailCache(path)
+        return _tail_caches[path]
+
+
+def status_from_line(line, date):
+    """
+    Turns the newest status line of the ansible log into the dictionary served by the status views
+    :param line: str. Line of the log containing TASK or fatal, or None
+    :param date: datetime. Date parsed from the start of the line
+    :return: dictionary containing the status, the date of the status or an error
+    """
+    response = {}
+    if line is None:
+        response["error"] = "Invalid ansible log. Check entire log for details"
+        return response
+
+    # If we see a fatal, let's show that to the user
+    if "TASK" not in line:
+        response["error"] = line
+        response[
+            "status"
+        ] = "Ansible has crashed! Most likely keys have not been configured correctly. See log for details"
+        return response
+
+    response["date"] = date
+    # Include the section within the brackets as the current status
+    response["status"] = line[line.find("[") + 1 : line.find("]")]
+
+    # This item is last on servers which are freshly migrated! Account for this
+    if "Copying self to server" in line and date is not None:
+        # Could be an actual status item! If it is old it's just the stuff left over
+        if datetime.datetime.now() - date > datetime.timedelta(minutes=2):
+            response["date"] = datetime.datetime.now()
+            response["status"] = "Not CloudSurfing"
+    return response
+
+
+def current_status(path=MAIN_LOG_TXT):
+    """
+    Gets the current cloudsurf status from the shared cache of the ansible log
+    :param path: str. Location of the ansible log
+    :return: dictionary containing the status, the date of the status or an error
+    :raise:
+    OSError
+        Raised when the log file cannot be opened
+    """
+    line, offset, date = get_log_tail(path).latest()
+    return status_from_line(line, date)
+
+
+def status_events(path=MAIN_LOG_TXT, last_event_id=None):
+    """
+    Generates Server-Sent Events for the cloudsurf status. An event is only sent when a new TASK or fatal line appears
+    in the log, otherwise a keepalive comment is sent every STREAM_KEEPALIVE_SECONDS.
+    :param path: str. Location of the ansible log
+    :param last_event_id: str. The Last-Event-ID sent by a reconnecting browser. The current status is not sent again
+    if it has not changed since this event.
+    :return: generator of strings in the text/event-stream format
+    """
+    cache = get_log_tail(path)
+    yield "retry: {}\n\n".format(STREAM_RETRY_MILLISECONDS)
+
+    last_status = None
+    started = last_sent = time.monotonic()
+    while time.monotonic() - started < STREAM_MAX_SECONDS:
+        try:
+            line, offset, date = cache.latest()
+        except OSError:
+            # The log doesn't exist yet. Wait for ansible to create it
+            line = None
+        if line is not None:
+            event_id = "{}-{}".format(cache.inode, offset)
+            status = status_from_line(line, date)
+            # The status of an unchanged line can still change, see "Copying self to server"
+            if event_id != last_event_id or (
+                last_status is not None and status.get("status") != last_status
+            ):
+                last_event_id = event_id
+                last_status = status.get("status")
+                last_sent = time.monotonic()
+                yield "id: {}\nevent: status\ndata: {}\n\n".format(
+                    event_id, json.dumps(status, cls=DjangoJSONEncoder)
+                )
+        if time.monotonic() - last_sent >= STREAM_KEEPALIVE_SECONDS:
+            last_sent = time.monotonic()
+            yield ": keepalive\n\n"
+        time.sleep(STREAM_POLL_SECONDS)
+
+
+class _Stream:
+    # Iterates over a status stream, giving its slot back once the server closes the response. The slot has to be
+    # given back by close rather than a finally block in the generator, which wouldn't run if the stream never started
+    def __init__(self, events):
+        self._events = events
+        self._closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._events)
+
+    def close(self):
+        global _open_streams
+        self._events.close()
+        with _streams_lock:
+            if not self._closed:
+                self._closed = True
+                _open_streams -= 1
+
+
+_open_streams = 0
+_streams_lock = threading.Lock()
+
+
+def open_status_stream(path=MAIN_LOG_TXT, last_event_id=None):
+    """
+    Starts a status stream if fewer than settings.STREAM_MAX_CONNECTIONS are open in this process, as every open stream
+    holds a gunicorn thread. The stream must be closed when the browser goes away, which Django does with the response.
+    :param path: str. Location of the ansible log
+    :param last_event_id: str. The Last-Event-ID sent by a reconnecting browser
+    :return: iterator of strings in the text/event-stream format, see status_events, or None if too many are open
+    """
+    global _open_streams
+    with _streams_lock:
+        if _open_streams >= settings.STREAM_MAX_CONNECTIONS:
+            return None
+        _open_streams += 1
+    return _Stream(status_events(path, last_event_id))
+
+
+def read_tail(path, lines=LOG_TAIL_LINES):
+    """
+    Reads the last lines of a log by walking backwards from the end of the file in blocks
+    :param path: str. Location of the log file
+    :param lines: int. Number of lines to return, capped at LOG_MAX_TAIL_LINES
+    :return:
+    contents: str. The last lines of the log
+    start: int. Byte offset of the first returned line
+    size: int. Size of the log in bytes
+    :raise:
+    OSError
+        Raised when the log file cannot be opened
+    """
+    lines = max(1, min(lines, LOG_MAX_TAIL_LINES))
+    with open(path, "rb") as fh:
+        size = os.fstat(fh.fileno()).st_size
+        start = size
+        data = b""
+        # One extra newline is needed to know where the first returned line begins
+        while start > 0 and data.count(b"\n", 0, len(data) - 1) < lines:
+            step = min(TAIL_WINDOW_BYTES, start)
+            start -= step
+            fh.seek(start)
+            data = fh.read(step) + data
+            if len(data) > LOG_MAX_PAGE_BYTES:
+                break
+    # Drop everything before the first line we want
+    newlines = data.count(b"\n", 0, len(data) - 1)
+    skip = 0
+    for _ in range(max(0, newlines - lines + 1)):
+        skip = data.index(b"\n", skip) + 1
+    if newlines < lines and start > 0:
+        # Ran into LOG_MAX_PAGE_BYTES, so the first fragment is an incomplete line
+        skip = data.find(b"\n") + 1
+    return data[skip:].decode(errors="replace"), start + skip, size
+
+
+def read_page(path, offset, length=LOG_PAGE_BYTES):
+    """
+    Reads a page of whole lines from a log, starting at the first line at or after a byte offset
+    :param path: str. Location of the log file
+    :param offset: int. Byte offset to start reading from
+    :param length: int. Approximate size of the page in bytes, capped at LOG_MAX_PAGE_BYTES
+    :return:
+    contents: str. The lines of the page
+    start: int. Byte offset of the first line of the page
+    end: int. Byte offset just after the last line of the page
+    size: int. Size of the log in bytes
+    :raise:
+    OSError
+        Raised when the log file cannot be opened
+    """
+    length = max(1, min(length, LOG_MAX_PAGE_BYTES))
+    with open(path, "rb") as fh:
+        size = os.fstat(fh.fileno()).st_size
+        start = max(0, min(offset, size))
+        if start > 0:
+            # Move to the beginning of the next line so the page doesn't start half way through one
+            fh.seek(start - 1)
+            if fh.read(1) != b"\n":
+                fh.readline(LOG_MAX_PAGE_BYTES)
+            start = fh.tell()
+        fh.seek(start)
+        data = fh.read(length)
+        if data and not data.endswith(b"\n"):
+            data += fh.readline(LOG_MAX_PAGE_BYTES)
+    return data.decode(errors="replace"), start, start + len(data), size
+
+
+def iter_log(fh, compress=False):
+    """
+    Streams an open log file in chunks of LOG_CHUNK_BYTES, closing it once the end is reached
+    :param fh: file object. The log, opened in binary mode
+    :param compress: bool. True to gzip the stream
+    :return: generator of bytes
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    with fh:
+        for chunk in iter(lambda: fh.read(LOG_CHUNK_BYTES), b""):
+            if compress:
+                chunk = compressor.compress(chunk)
+            if chunk:
+                yield chunk
+    if compress:
+        yield compressor.flush()
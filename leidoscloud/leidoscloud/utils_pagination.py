@@ -0,0 +1,72 @@
+from django.db.models import Q
+
+
+def keyset_page(queryset, field, size, before=None, after=None):
+    """
+    Gets one page of a table ordered newest first by a timestamp, using the last row seen instead of an offset so every
+    page costs the same however much history there is. Rows with the same timestamp are ordered by their id.
+    :param queryset: QuerySet of the rows to page through
+    :param field: str. Name of the timestamp field to order by
+    :param size: int. Maximum number of rows on the page
+    :param before: int. Id of a row, to get the rows older than it
+    :param after: int. Id of a row, to get the rows newer than it. Ignored if before is given
+    :return: dictionary containing
+    rows: list of the rows on the page, newest first
+    older: int. The before cursor of the next older page, or None if this is the oldest page
+    newer: int. The after cursor of the next newer page, or None if this is the newest page
+    """
+    newest_first = ("-" + field, "-id")
+    cursor = before if before is not None else after
+    pivot = None
+    if cursor is not None:
+        pivot = queryset.filter(pk=cursor).values_list(field, flat=True).first()
+
+    if pivot is None:
+        # No cursor, or the row it points at is gone, so start again from the newest row
+        rows = list(queryset.order_by(*newest_first)[: size + 1])
+        more = len(rows) > size
+        rows = rows[:size]
+        return {"rows": rows, "older": rows[-1].id if more else None, "newer": None}
+
+    if before is not None:
+        rows = list(
+            queryset.filter(
+                Q(**{field + "__lt": pivot}) | Q(**{field: pivot, "pk__lt": cursor})
+            ).order_by(*newest_first)[: size + 1]
+        )
+        more = len(rows) > size
+        rows = rows[:size]
+        return {
+            "rows": rows,
+            "older": rows[-1].id if more else None,
+            "newer": rows[0].id if rows else None,
+        }
+
+    # Walk forwards from the cursor and flip the page so it is still newest first
+    rows = list(
+        queryset.filter(
+            Q(**{field + "__gt": pivot}) | Q(**{field: pivot, "pk__gt": cursor})
+        ).order_by(field, "id")[: size + 1]
+    )
+    more = len(rows) > size
+    rows = rows[:size][::-1]
+    return {
+        "rows": rows,
+        "older": rows[-1].id if rows else None,
+        "newer": rows[0].id if more else None,
+    }
+
+
+def cursor_parameter(request, name):
+    """
+    Reads a page cursor from the query string of a request
+    :param request: HTTP request object, or None when rendering outside of a request
+    :param name: str. Name of the query parameter
+    :return: int. The row id in the parameter, or None if it is missing or not a number
+    """
+    if request is None:
+        return None
+    try:
+        return int(request.GET[name])
+    except (KeyError, ValueError):
+        return None
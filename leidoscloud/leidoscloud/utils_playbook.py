@@ -1,10 +1,13 @@
 import os
-import subprocess
 import sys
 
+from . import utils_jobs
 from .models import *
 from .settings import BASE_DIR
-from .utils_host import get_current_cloud_host
+from .utils_host import get_current_cloud_host, get_moving_transition
+from .utils_events import start_run
+from .utils_lease import acquire_lease, hold_lease, release_lease, renew_lease
+from .utils_vars import remove_when_done, write_playbook_vars
 
 # Detect if Django is being unit tested
 TESTING = sys.argv[1:2] == ["test"]
@@ -20,20 +23,30 @@ class AttemptedToCloudSurfToCurrentHostException(Exception):
 
 
 def move_self(target, user=None):
+    # Only one process may get past this point at a time. Checking for a transition in progress and creating a new
+    # one happen while holding the lease, so two requests or a request and the cron can't both start a CloudSurf.
+    lease = acquire_lease()
+    if lease is None:
+        raise CloudSurfAlreadyInProgressException()
+    job = None
+    try:
+        job = _start_move(target, user, lease)
+    finally:
+        # The lease is held for as long as the playbook runs, or given back straight away if it wasn't started
+        if job is None:
+            release_lease(lease)
+        else:
+            hold_lease(lease, job)
+
+
+def _start_move(target, user, lease):
     # verify that there is not a current cloud surf in progress before starting
     # another. This would be shown in the transition table if there is a entry
     # without an end time.
 
-    # Get the most recent transition and if it has not finished then
-    try:
-        latest_transition = Transition.objects.latest("start_time")
-    except Transition.DoesNotExist:
-        latest_transition = None
-
-    # Return (and fail to run) if there is already an instance with an end time
-    if latest_transition is not None:
-        if not latest_transition.end_time:
-            raise CloudSurfAlreadyInProgressException()
+    # Return (and fail to run) if the most recent transition has not finished
+    if get_moving_transition() is not None:
+        raise CloudSurfAlreadyInProgressException()
 
     # Ensure target is valid
     if not isinstance(target, API):
@@ -49,10 +62,11 @@ def move_self(target, user=None):
             start_provider=current, end_provider=target, user=user
         )
         new_move.save()
+        renew_lease(lease, new_move)
 
         # Don't run the playbook while testing!
         if TESTING:
-            return
+            return None
 
         # Bit of a hack: if get_current_cloud_host doesn't return a cloud host, ansible-playbook's path will be
         # different!
@@ -74,11 +88,22 @@ def move_self(target, user=None):
             "-e",
             "pip=" + pip_path,
             "-e",
+            # The release bundle is built by the same Python running Django
+            "python=" + sys.executable,
+            "-e",
             "target_host=" + target.name,
             "-e",
             "current_host=" + current.name,
         ]
-        # variable needed, otherwise it won't work, even if it's not used.
-        process = subprocess.Popen(command)
+        # The keys the playbooks need are read now, in one go, rather than by the playbooks themselves
+        vars_path = write_playbook_vars()
+        command += ["-e", "@" + vars_path]
+        # The ansible callback writes the progress of each task to the run's event log
+        run, run_env = start_run(new_move, PlaybookRun.DEPLOY)
+        env = os.environ.copy()
+        env.update(run_env)
+
+        # Started by the job runner, which records how the playbook exits
+        return remove_when_done(utils_jobs.submit(run, command, env), vars_path)
     except Exception as e:
         print(e)
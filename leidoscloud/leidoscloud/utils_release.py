@@ -0,0 +1,259 @@
+import fnmatch
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import sysconfig
+import tarfile
+import tempfile
+
+from django.conf import settings
+
+from .settings import BASE_DIR
+
+# The top of the repository, which the playbooks copy to /home/<user>/storm/ on a new host
+ROOT_DIR = os.path.dirname(BASE_DIR)
+# The only paths under ROOT_DIR a host needs to run
+RELEASE_PATHS = ["ansible.cfg", "ansible-scripts", "leidoscloud", "wheelhouse"]
+# Names of files and directories left out of a release wherever they are. Keys, logs and the database belong to the
+# host they were made on, and the database is copied separately, see snapshot_database
+RELEASE_EXCLUDE = [
+    ".*",
+    "__pycache__",
+    "*.pyc",
+    "*.retry",
+    "*.log",
+    "*.pem",
+    "*.pem.pub",
+    "*.sqlite3",
+    "*.sqlite3-*",
+    "delete_log.txt",
+    "events",
+    "htmlcov",
+]
+# Pinned requirements of the host and of the playbooks run on it, relative to ROOT_DIR. The wheelhouse has a wheel for
+# every one of them, so a new host can install them all without the package index
+REQUIREMENTS = [
+    "leidoscloud/requirements.txt",
+    "ansible-scripts/requirements/host.txt",
+    "ansible-scripts/requirements/controller.txt",
+    "ansible-scripts/requirements/aws.txt",
+    "ansible-scripts/requirements/azure.txt",
+    "ansible-scripts/requirements/google.txt",
+]
+# Written into the wheelhouse once every wheel has been built
+WHEELHOUSE_MANIFEST = "wheelhouse.json"
+
+
+def _excluded(name):
+    return any(fnmatch.fnmatch(name, pattern) for pattern in RELEASE_EXCLUDE)
+
+
+def release_files(root=ROOT_DIR):
+    """
+    Lists the files which make up a release, leaving out anything matching RELEASE_EXCLUDE
+    :param root: str. Top of the repository
+    :return: sorted list of paths relative to root, using / as the separator
+    """
+    files = []
+    for path in RELEASE_PATHS:
+        top = os.path.join(root, path)
+        if os.path.isfile(top):
+            files.append(path)
+            continue
+        for directory, subdirectories, names in os.walk(top):
+            subdirectories[:] = [d for d in subdirectories if not _excluded(d)]
+            relative = os.path.relpath(directory, root).replace(os.sep, "/")
+            files += [relative + "/" + name for name in names if not _excluded(name)]
+    return sorted(files)
+
+
+def source_hash(files, root=ROOT_DIR):
+    """
+    Hashes the paths, permissions and contents of the files in a release, so it only changes when the release would
+    :param files: list of paths relative to root, see release_files
+    :param root: str. Top of the repository
+    :return: str. Hex SHA-256 digest
+    """
+    digest = hashlib.sha256()
+    for path in files:
+        full_path = os.path.join(root, path)
+        executable = os.stat(full_path).st_mode & 0o111
+        digest.update(
+            "{}\0{:o}\0".format(path, 0o755 if executable else 0o644).encode()
+        )
+        with open(full_path, "rb") as f:
+            digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()
+
+
+def _write_bundle(destination, files, root):
+    # Owners and times are fixed so the same files always make the same bundle
+    with open(destination, "wb") as raw:
+        with gzip.GzipFile(filename="", fileobj=raw, mode="wb", mtime=0) as compressed:
+            with tarfile.open(fileobj=compressed, mode="w") as tar:
+                for path in files:
+                    full_path = os.path.join(root, path)
+                    info = tar.gettarinfo(full_path, arcname=path)
+                    info.uid = info.gid = 0
+                    info.uname = info.gname = ""
+                    info.mtime = 0
+                    info.mode = 0o755 if info.mode & 0o111 else 0o644
+                    with open(full_path, "rb") as f:
+                        tar.addfile(info, f)
+
+
+def build_release(output_dir=None, root=ROOT_DIR):
+    """
+    Packs the runtime files of the repository into a compressed tarball named after the hash of its contents. The
+    bundle already built for the same files is reused, and all but the newest RELEASE_KEEP bundles are removed.
+    :param output_dir: str. Where bundles are kept. Defaults to settings.RELEASE_DIR
+    :param root: str. Top of the repository
+    :return:
+    path: str. Location of the bundle
+    digest: str. Hex SHA-256 digest of the files in the bundle
+    built: bool. False if an existing bundle was reused
+    """
+    if output_dir is None:
+        output_dir = settings.RELEASE_DIR
+    files = release_files(root)
+    digest = source_hash(files, root)
+    path = os.path.join(output_dir, "leidoscloud-" + digest + ".tar.gz")
+    if os.path.exists(path):
+        os.utime(path)
+        return path, digest, False
+
+    os.makedirs(output_dir, exist_ok=True)
+    # Written under a temporary name first so a bundle which exists is always complete
+    handle, partial = tempfile.mkstemp(dir=output_dir, suffix=".partial")
+    os.close(handle)
+    try:
+        _write_bundle(partial, files, root)
+        os.chmod(partial, 0o644)
+        os.replace(partial, path)
+    except BaseException:
+        os.remove(partial)
+        raise
+    _prune(output_dir)
+    return path, digest, True
+
+
+def _prune(output_dir):
+    bundles = sorted(
+        (
+            os.path.join(output_dir, name)
+            for name in os.listdir(output_dir)
+            if fnmatch.fnmatch(name, "leidoscloud-*.tar.gz")
+        ),
+        key=os.path.getmtime,
+        reverse=True,
+    )
+    for old in bundles[settings.RELEASE_KEEP :]:
+        os.remove(old)
+
+
+def wheelhouse_key(root=ROOT_DIR):
+    """
+    Hashes the requirement files along with the Python version and platform wheels are built for, so the wheelhouse is
+    rebuilt when either changes
+    :param root: str. Top of the repository
+    :return: str. Hex SHA-256 digest
+    """
+    digest = hashlib.sha256()
+    digest.update(
+        "{}\0{}.{}\0{}\0".format(
+            sys.implementation.name,
+            sys.version_info.major,
+            sys.version_info.minor,
+            sysconfig.get_platform(),
+        ).encode()
+    )
+    for path in REQUIREMENTS:
+        with open(os.path.join(root, path), "rb") as f:
+            digest.update(path.encode() + b"\0" + f.read() + b"\0")
+    return digest.hexdigest()
+
+
+def _wheelhouse_manifest(wheelhouse):
+    try:
+        with open(os.path.join(wheelhouse, WHEELHOUSE_MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def build_wheelhouse(output_dir=None, root=ROOT_DIR):
+    """
+    Builds a wheel of every package in REQUIREMENTS and their dependencies with pip, for installing on a new host with
+    pip's --no-index option. Nothing is built while the requirements are unchanged, and wheels from the previous
+    wheelhouse are reused rather than downloaded again when they are.
+    :param output_dir: str. Where the wheelhouse is kept. Defaults to settings.WHEELHOUSE_DIR
+    :param root: str. Top of the repository
+    :return:
+    path: str. Location of the wheelhouse
+    key: str. The wheelhouse_key it was built for
+    built: bool. False if the existing wheelhouse was up to date
+    :raise:
+    subprocess.CalledProcessError
+        Raised when pip fails to build a wheel. The previous wheelhouse is left as it was
+    """
+    if output_dir is None:
+        output_dir = settings.WHEELHOUSE_DIR
+    key = wheelhouse_key(root)
+    if _wheelhouse_manifest(output_dir).get("key") == key:
+        return output_dir, key, False
+
+    # Built next to the wheelhouse and swapped in, so a wheelhouse with a manifest always has every wheel
+    partial = output_dir + ".partial"
+    shutil.rmtree(partial, ignore_errors=True)
+    command = [sys.executable, "-m", "pip", "wheel", "--wheel-dir", partial]
+    if os.path.isdir(output_dir):
+        command += ["--find-links", output_dir]
+    for path in REQUIREMENTS:
+        command += ["--requirement", os.path.join(root, path)]
+    try:
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+        with open(os.path.join(partial, WHEELHOUSE_MANIFEST), "w") as f:
+            json.dump(
+                {
+                    "key": key,
+                    "python": "{}.{}".format(*sys.version_info[:2]),
+                    "platform": sysconfig.get_platform(),
+                },
+                f,
+            )
+    except BaseException:
+        shutil.rmtree(partial, ignore_errors=True)
+        raise
+
+    old = output_dir + ".old"
+    shutil.rmtree(old, ignore_errors=True)
+    if os.path.isdir(output_dir):
+        os.rename(output_dir, old)
+    os.rename(partial, output_dir)
+    shutil.rmtree(old, ignore_errors=True)
+    return output_dir, key, True
+
+
+def snapshot_database(destination, source=None):
+    """
+    Copies the SQLite database using its backup API, which gives a consistent copy even while it is being written to
+    :param destination: str. Where the copy is written. Replaced if it exists
+    :param source: str. Location of the database. Defaults to the default database in settings
+    :return: str. destination
+    """
+    if source is None:
+        source = settings.DATABASES["default"]["NAME"]
+    partial = destination + ".partial"
+    if os.path.exists(partial):
+        os.remove(partial)
+    with sqlite3.connect(source) as original, sqlite3.connect(partial) as copy:
+        original.backup(copy)
+    original.close()
+    copy.close()
+    os.replace(partial, destination)
+    return destination
@@ -0,0 +1,76 @@
+from .utils_stock_api import get_stock_window
+
+
+def lttb(points, threshold):
+    """
+    Downsamples a series with Largest-Triangle-Three-Buckets, which keeps the points that shape the line the most so
+    peaks and dips survive. The first and last points are always kept.
+    :param points: list of (x, y) tuples ordered by x
+    :param threshold: int. Maximum number of points to return
+    :return: list of (x, y) tuples, at most threshold long
+    """
+    count = len(points)
+    if threshold >= count:
+        return list(points)
+    if threshold < 3:
+        return [points[0], points[-1]][:threshold]
+
+    sampled = [points[0]]
+    # Every point except the first and last is split into threshold - 2 buckets
+    bucket_size = (count - 2) / (threshold - 2)
+    previous = points[0]
+    for bucket in range(threshold - 2):
+        start = int(bucket * bucket_size) + 1
+        end = int((bucket + 1) * bucket_size) + 1
+
+        # The next point is still to be chosen, so the average of the next bucket stands in for it
+        next_start = end
+        next_end = min(int((bucket + 2) * bucket_size) + 1, count)
+        next_points = points[next_start:next_end]
+        average_x = sum(x for x, y in next_points) / len(next_points)
+        average_y = sum(y for x, y in next_points) / len(next_points)
+
+        # Keep the point making the largest triangle with the previously kept point and the next average
+        best_area = -1
+        best = None
+        for x, y in points[start:end]:
+            area = abs(
+                (previous[0] - average_x) * (y - previous[1])
+                - (previous[0] - x) * (average_y - previous[1])
+            )
+            if area > best_area:
+                best_area = area
+                best = (x, y)
+        sampled.append(best)
+        previous = best
+
+    sampled.append(points[-1])
+    return sampled
+
+
+def stock_series(start, end, threshold):
+    """
+    Gets the stock market change of every provider in a time range, downsampled for charting
+    :param start: datetime. Readings after this time are included
+    :param end: datetime. Readings up to and including this time are included
+    :param threshold: int. Maximum number of points per provider
+    :return: dictionary of provider name to a dictionary containing
+    long_name: str. The name to show for the provider
+    count: int. The number of readings in the range before downsampling
+    points: list of [milliseconds since the epoch, change] pairs ordered by time
+    """
+    readings = get_stock_window(start, end).values_list(
+        "provider__name", "provider__long_name", "time", "change"
+    )
+    series = {}
+    for name, long_name, time, change in readings.iterator():
+        if name not in series:
+            series[name] = {"long_name": long_name, "points": []}
+        series[name]["points"].append((time.timestamp() * 1000, change))
+
+    for provider in series.values():
+        provider["count"] = len(provider["points"])
+        provider["points"] = [
+            [int(x), y] for x, y in lttb(provider["points"], threshold)
+        ]
+    return series
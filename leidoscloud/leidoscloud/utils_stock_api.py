@@ -1,7 +1,37 @@
+import concurrent.futures
+import datetime
+import threading
+import time
+
 import requests
+from django.conf import settings
+from django.db.models import Avg, F, OuterRef, Subquery
+from django.utils import timezone
 
 from .models import *
 
+ALPHA_VANTAGE_URL = "https://www.alphavantage.co/query"
+
+# Each quote must arrive within QUOTE_TIMEOUT_SECONDS, and all of them within QUOTE_DEADLINE_SECONDS
+QUOTE_TIMEOUT_SECONDS = 5
+QUOTE_DEADLINE_SECONDS = 8
+QUOTE_WORKERS = 8
+
+# Shared by every call in the process, created the first time they are needed
+_session = None
+_executor = None
+_pool_lock = threading.Lock()
+
+# Name of the RateLimitBucket shared by every call to Alpha Vantage
+QUOTE_BUCKET = "AlphaVantage"
+
+
+class RateLimitedError(ConnectionError):
+    # retry_at is when the rate limit next allows a call, if it is known
+    def __init__(self, message, retry_at=None):
+        super().__init__(message)
+        self.retry_at = retry_at
+
 
 def get_provider_api():
     """
@@ -34,23 +64,152 @@ def get_api_key(alpha):
     return key
 
 
-def get_cloud_target(providers_api, key):
+def get_session():
+    """
+    Gets the HTTP session shared by every quote request, so connections to Alpha Vantage are kept alive and reused
+    :return: requests.Session
+    """
+    global _session
+    with _pool_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=QUOTE_WORKERS
+            )
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+            _session.headers["Accept"] = "application/json"
+        return _session
+
+
+def _get_executor():
+    global _executor
+    with _pool_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=QUOTE_WORKERS, thread_name_prefix="quotes"
+            )
+        return _executor
+
+
+def fetch_quote(symbol, key, timeout=QUOTE_TIMEOUT_SECONDS):
+    """
+    Gets the percentage change of a share price today from Alpha Vantage
+    :param symbol: str. Stock ticker symbol
+    :param key: Alpha Vantage API key
+    :param timeout: float. Seconds to wait for Alpha Vantage
+    :return: float. The % change of the price
+    :raise:
+    RuntimeError
+        Raised when Alpha Vantage returns an error message
+    RateLimitedError
+        Raised when Alpha Vantage refuses the call because of its rate limit
+    ConnectionError
+        Raised when the response does not contain a quote
+    """
+    response = (
+        get_session()
+        .get(
+            ALPHA_VANTAGE_URL,
+            params={"function": "GLOBAL_QUOTE", "symbol": symbol, "apikey": key},
+            timeout=timeout,
+        )
+        .json()
+    )
+    # Pass API errors to user instead of getting a key error
+    if "Error Message" in response:
+        raise RuntimeError(response["Error Message"])
+    # Alpha Vantage answers with a note instead of a quote when too many calls are made
+    if "Note" in response or "Information" in response:
+        raise RateLimitedError(response.get("Note") or response.get("Information"))
+    if "Global Quote" not in response:
+        raise ConnectionError("Unable to retrieve stock price from Alpha Vantage")
+    return float(response["Global Quote"]["10. change percent"][:-1])
+
+
+def acquire_tokens(name, wanted, capacity, refill_seconds):
+    """
+    Takes up to the wanted number of tokens from a token bucket stored in the database, so that every process
+    shares the same limit.
+    It never waits for the bucket to refill. A caller granted fewer tokens than it wanted falls back on what it has,
+    as get_cloud_target does with stale quotes, or leaves the rest until next_token_time, as the cron does. So the
+    calls are spread over the cron's runs rather than holding up the one that asked for them.
+    :param name: str. Name of the bucket
+    :param wanted: int. Number of tokens wanted
+    :param capacity: int. Maximum number of tokens the bucket holds
+    :param refill_seconds: float. Seconds it takes for one token to be added back
+    :return: int. Number of tokens granted, between 0 and wanted
+    """
+    while True:
+        now = timezone.now()
+        bucket = RateLimitBucket.objects.get_or_create(
+            name=name, defaults={"tokens": capacity, "updated_at": now}
+        )[0]
+        elapsed = max(0.0, (now - bucket.updated_at).total_seconds())
+        tokens = min(capacity, bucket.tokens + elapsed / refill_seconds)
+        granted = max(0, min(wanted, int(tokens)))
+        # Only take the tokens if no other process has changed the bucket since we read it, otherwise try again.
+        # The version is compared rather than the tokens and time, as floats and datetimes may not come back from
+        # every database exactly as they were written
+        if RateLimitBucket.objects.filter(pk=bucket.pk, version=bucket.version).update(
+            tokens=tokens - granted, updated_at=now, version=F("version") + 1
+        ):
+            return granted
+
+
+def next_token_time(name, refill_seconds):
+    """
+    Works out when a token bucket will next have a token to give
+    :param name: str. Name of the bucket
+    :param refill_seconds: float. Seconds it takes for one token to be added back
+    :return: datetime. Now if the bucket has a token already or doesn't exist yet
+    """
+    now = timezone.now()
+    bucket = RateLimitBucket.objects.filter(name=name).first()
+    if bucket is None:
+        return now
+    elapsed = max(0.0, (now - bucket.updated_at).total_seconds())
+    tokens = bucket.tokens + elapsed / refill_seconds
+    if tokens >= 1:
+        return now
+    return now + datetime.timedelta(seconds=(1 - tokens) * refill_seconds)
+
+
+def drain_tokens(name):
+    """
+    Empties a token bucket, used when the API tells us the limit has been reached anyway
+    :param name: str. Name of the bucket
+    :return: None
+    """
+    RateLimitBucket.objects.filter(name=name).update(
+        tokens=0, updated_at=timezone.now(), version=F("version") + 1
+    )
+
+
+def get_cloud_target(providers_api, key, partial=False):
     """
-    Gets the share prices for the providers from Alpha Vantage
+    Gets the share prices for the providers, from the shared QuoteCache if they are fresh or otherwise from Alpha
+    Vantage. All quotes are requested at the same time, must arrive within QUOTE_DEADLINE_SECONDS and may only be
+    requested when the rate limit allows, without waiting for it. Stale quotes are used when a new one can't be
+    retrieved, including when another process has just taken the tokens, see acquire_tokens.
     :param providers_api: provider objects
     :param key: Alpha Vantage API key
+    :param partial: By default every quote must be retrieved, because moving based on some of the providers could
+    move us to the wrong one. If True, the quotes which were retrieved are returned as long as there is at least one.
     :return:
     stock_dict: dictionary
         Contains the  %change of prices of each provider
     symbols: contains the symbols of the providers.
+    :raise:
+    ValueError
+        Raised when a provider does not have a ticker symbol
+    RuntimeError, ConnectionError, RateLimitedError or requests.RequestException
+        The first error of a quote which could not be retrieved and has no stale value. A RateLimitedError has the
+        time the rate limit next allows a call as its retry_at
     """
-    headers = {
-        "Accept": "application/json",
-    }
     symbols = {}
     for i in providers_api:
         symbols[i.name] = i
-    stock_dict = {}
     for i in symbols.keys():
         if symbols[i].ticker_symbol is None:
             # ticker symbol does not exist! Can't check for this provider
@@ -59,21 +218,86 @@ def get_cloud_target(providers_api, key):
                 + symbols[i].long_name
                 + " is missing!"
             )
-        response = requests.get(
-            "https://www.alphavantage.co/query?function=GLOBAL_QUOTE&symbol={}&apikey={}".format(
-                symbols[i].ticker_symbol, key
-            ),
-            headers=headers,
-            timeout=5,
-        ).json()
-        # Pass API errors to user instead of getting a key error
-        if "Error Message" in response:
-            raise RuntimeError(response["Error Message"])
-        if "Global Quote" not in response:
-            raise ConnectionError("Unable to retrieve stock price from Alpha Vantage")
-
-        stock_dict[i] = float(response["Global Quote"]["10. change percent"][:-1])
-    return stock_dict, symbols
+
+    now = timezone.now()
+    ttl = datetime.timedelta(seconds=settings.QUOTE_TTL_SECONDS)
+    stale_ttl = ttl + datetime.timedelta(seconds=settings.QUOTE_STALE_SECONDS)
+    cached = QuoteCache.objects.filter(
+        symbol__in=[provider.ticker_symbol for provider in symbols.values()]
+    ).in_bulk(field_name="symbol")
+
+    # Fresh quotes come from the cache. Stale ones are fetched again if the rate limit allows and used if that fails.
+    stock_dict = {}
+    stale_dict = {}
+    to_fetch = []
+    for i, provider in symbols.items():
+        quote = cached.get(provider.ticker_symbol)
+        if quote is not None and now - quote.fetched_at < ttl:
+            stock_dict[i] = quote.change
+            continue
+        if quote is not None and now - quote.fetched_at < stale_ttl:
+            stale_dict[i] = quote.change
+        to_fetch.append(i)
+    # Spend the tokens on the quotes we have nothing to fall back on first
+    to_fetch.sort(key=lambda i: i in stale_dict)
+    granted = acquire_tokens(
+        QUOTE_BUCKET,
+        len(to_fetch),
+        settings.QUOTE_RATE_CAPACITY,
+        settings.QUOTE_RATE_REFILL_SECONDS,
+    )
+
+    deadline = time.monotonic() + QUOTE_DEADLINE_SECONDS
+    futures = {
+        i: _get_executor().submit(
+            fetch_quote, symbols[i].ticker_symbol, key, QUOTE_TIMEOUT_SECONDS,
+        )
+        for i in to_fetch[:granted]
+    }
+    concurrent.futures.wait(
+        futures.values(), timeout=max(0, deadline - time.monotonic())
+    )
+
+    errors = []
+    for i in to_fetch:
+        future = futures.get(i)
+        if future is None:
+            error = RateLimitedError(
+                "Alpha Vantage rate limit reached before the stock price of "
+                + symbols[i].long_name
+                + " could be retrieved",
+                next_token_time(QUOTE_BUCKET, settings.QUOTE_RATE_REFILL_SECONDS),
+            )
+        elif not future.done():
+            future.cancel()
+            error = ConnectionError(
+                "Timed out retrieving the stock price of "
+                + symbols[i].long_name
+                + " from Alpha Vantage"
+            )
+        elif future.exception() is not None:
+            error = future.exception()
+            if isinstance(error, RateLimitedError):
+                drain_tokens(QUOTE_BUCKET)
+                error.retry_at = next_token_time(
+                    QUOTE_BUCKET, settings.QUOTE_RATE_REFILL_SECONDS
+                )
+        else:
+            stock_dict[i] = future.result()
+            QuoteCache.objects.update_or_create(
+                symbol=symbols[i].ticker_symbol,
+                defaults={"change": stock_dict[i], "fetched_at": timezone.now()},
+            )
+            continue
+        if i in stale_dict:
+            stock_dict[i] = stale_dict[i]
+        else:
+            errors.append(error)
+
+    if errors and not (partial and stock_dict):
+        raise errors[0]
+    # Keep the order of the providers
+    return {i: stock_dict[i] for i in symbols if i in stock_dict}, symbols
 
 
 def process_api_json(stock_dict, symbols):
@@ -87,41 +311,72 @@ def process_api_json(stock_dict, symbols):
     return symbols[stock_min]
 
 
-def save_stock_data(stock_dict):
+def save_stock_data(stock_dict, time=None):
     """
-    Takes the stock dictionary and saves to DB the %
-    :param stock_dict:
-    :return:
+    Takes the stock dictionary and saves to DB the % of every provider in it, all with the same reading time
+    :param stock_dict: dictionary of provider name to % change
+    :param time: datetime of the reading. Defaults to now
+    :return: list of the saved StockData objects
     """
-    data = StockData.objects.create(
-        google=stock_dict["google"], azure=stock_dict["azure"], aws=stock_dict["aws"]
+    time = time or timezone.now()
+    providers = API.objects.filter(name__in=stock_dict.keys(), is_provider=True)
+    return StockData.objects.bulk_create(
+        [
+            StockData(time=time, provider=provider, change=stock_dict[provider.name])
+            for provider in providers
+        ]
+    )
+
+
+def get_stock_window(start, end=None, providers=None):
+    """
+    Gets the stock market readings in a time range, using the (provider, time) index
+    :param start: datetime. Readings after this time are included
+    :param end: datetime. Readings up to and including this time are included. Defaults to no limit
+    :param providers: list of API objects to restrict the readings to. Defaults to every provider
+    :return: QuerySet of StockData ordered by time
+    """
+    readings = StockData.objects.filter(time__gt=start)
+    if end is not None:
+        readings = readings.filter(time__lte=end)
+    if providers is not None:
+        readings = readings.filter(provider__in=providers)
+    return readings.order_by("time", "provider_id")
+
+
+def get_latest_stock_data():
+    """
+    Gets the latest stock market reading of every provider in a single query
+    :return: QuerySet of StockData, one per provider that has a reading, with the provider selected
+    """
+    latest = StockData.objects.filter(provider=OuterRef("pk")).order_by("-time")
+    latest_ids = API.objects.filter(is_provider=True).annotate(
+        latest_id=Subquery(latest.values("id")[:1])
+    )
+    return StockData.objects.filter(
+        id__in=latest_ids.values("latest_id")
+    ).select_related("provider")
+
+
+def save_best_prediction(window=None):
+    """
+    This saves the best prediction at the time of the latest stock market reading to the database.
+    The average % change of every provider over the window before that reading is calculated by the database in a
+    single query, and the provider with the lowest average is considered best and is saved.
+    :param window: timedelta. How far back to average over. Defaults to PREDICTION_WINDOW_HOURS
+    :return: the saved Prediction object, or None if there is no stock market data
+    """
+    if window is None:
+        window = datetime.timedelta(hours=settings.PREDICTION_WINDOW_HOURS)
+    latest = StockData.objects.order_by("-time").values_list("time", flat=True).first()
+    if latest is None:
+        return None
+
+    best = (
+        get_stock_window(latest - window, latest)
+        .values("provider")
+        .annotate(average=Avg("change"))
+        .order_by("average", "provider")
+        .first()
     )
-    data.save()
-
-
-def save_best_prediction():
-    """
-    Since this is a bonus prototype feature, the implementation is a bit shoddy.
-    This saves the best prediction at that specific time to the database by taking the last 72 records (24hrs).
-    Then it calculates the average price over that time and the lowest average is considered best and is saved.
-    :return:None
-    """
-    objects = StockData.objects.order_by("-time")[:72]
-    google_average = 0.0
-    aws_average = 0.0
-    azure_average = 0.0
-    for i in objects:
-        google_average += i.google
-        aws_average += i.aws
-        azure_average += i.azure
-    google_average = google_average / len(objects)
-    aws_average = aws_average / len(objects)
-    azure_average = azure_average / len(objects)
-    if google_average < aws_average and google_average < azure_average:
-        target = API.objects.get(name="google")
-    elif aws_average < google_average and aws_average < azure_average:
-        target = API.objects.get(name="aws")
-    else:
-        target = API.objects.get(name="azure")
-    data = Prediction.objects.create(time=objects[0].time, provider=target)
-    data.save()
+    return Prediction.objects.create(time=latest, provider_id=best["provider"])
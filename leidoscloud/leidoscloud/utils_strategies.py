@@ -0,0 +1,390 @@
+import abc
+import json
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import OuterRef, Subquery
+
+from .models import API, Prediction, StockData, StrategyState
+
+
+# Exponential averages are replayed this many readings at a time, so the powers of their decay stay within a float
+EXPONENTIAL_BLOCK = 32
+
+
+def _decaying_sums(values, decay, initial):
+    """
+    Works out y[t] = decay * y[t - 1] + values[t] for every row at once, in blocks of EXPONENTIAL_BLOCK rows
+    :param values: NumPy array with a row per reading
+    :param decay: float between 0 and 1
+    :param initial: NumPy array. y[-1], the value before the first row
+    :return: NumPy array of the same shape as values
+    """
+    if decay == 0:
+        return np.array(values, dtype=float)
+    sums = np.empty(values.shape)
+    # Within a block, y[start + j] = decay^(j + 1) * (y[start - 1] + sum of values[start + i] / decay^(i + 1))
+    powers = (decay ** np.arange(1, EXPONENTIAL_BLOCK + 1))[:, None]
+    for start in range(0, len(values), EXPONENTIAL_BLOCK):
+        block = values[start : start + EXPONENTIAL_BLOCK]
+        scale = powers[: len(block)]
+        sums[start : start + len(block)] = scale * (
+            initial + np.cumsum(block / scale, axis=0)
+        )
+        initial = sums[start + len(block) - 1]
+    return sums
+
+
+def _exponential_means(changes, alpha):
+    # The mean kept by ExponentialAverage after each row, which starts from the first reading as it is
+    if not len(changes):
+        return np.empty(changes.shape)
+    rest = _decaying_sums(alpha * changes[1:], 1 - alpha, changes[0])
+    return np.vstack([changes[:1], rest])
+
+
+class Strategy(abc.ABC):
+    """
+    A way of scoring every provider from their stock market readings, where the provider with the lowest score is the
+    best one to move to. Strategies keep a small state of NumPy arrays with one column per provider, which is updated
+    one reading at a time so a cron run only has to look at the readings saved since the previous run.
+
+    ...
+    Attributes
+    ----------
+    name : str
+        The name the strategy's predictions are saved under
+
+    Methods
+    -------
+    start(self, providers)
+        Returns the state before any readings have been seen
+    update(self, state, changes)
+        Returns the state after a reading of every provider
+    scores(self, state)
+        Returns the score of every provider
+    replay(self, changes)
+        Returns the scores of every provider after each row of a matrix of readings
+    """
+
+    name = None
+
+    @abc.abstractmethod
+    def start(self, providers):
+        pass
+
+    @abc.abstractmethod
+    def update(self, state, changes):
+        pass
+
+    @abc.abstractmethod
+    def scores(self, state):
+        pass
+
+    def replay(self, changes):
+        # Strategies override this to compute every reading at once, which the backtests need to be quick
+        state = self.start(changes.shape[1])
+        scores = np.empty(changes.shape)
+        for i, reading in enumerate(changes):
+            state = self.update(state, reading)
+            scores[i] = self.scores(state)
+        return scores
+
+
+class MovingAverage(Strategy):
+    """
+    Scores providers by their mean change over the last readings, like save_best_prediction but by reading count
+    """
+
+    name = "sma"
+
+    def __init__(self, window=72):
+        self.window = window
+
+    def start(self, providers):
+        return {"readings": np.empty((0, providers))}
+
+    def update(self, state, changes):
+        readings = np.vstack([state["readings"], changes])[-self.window :]
+        return {"readings": readings}
+
+    def scores(self, state):
+        return state["readings"].mean(axis=0)
+
+    def replay(self, changes):
+        totals = np.vstack([np.zeros(changes.shape[1]), np.cumsum(changes, axis=0)])
+        ends = np.arange(1, len(changes) + 1)
+        starts = np.maximum(ends - self.window, 0)
+        return (totals[ends] - totals[starts]) / (ends - starts)[:, None]
+
+
+class ExponentialAverage(Strategy):
+    """
+    Scores providers by an exponentially weighted mean change, so recent readings count for more
+    """
+
+    name = "ewma"
+
+    def __init__(self, span=18):
+        self.alpha = 2 / (span + 1)
+
+    def start(self, providers):
+        return {"mean": np.zeros(providers), "seen": np.zeros(1)}
+
+    def update(self, state, changes):
+        # The first reading is taken as it is rather than being pulled towards zero
+        alpha = self.alpha if state["seen"][0] else 1.0
+        mean = state["mean"] + alpha * (changes - state["mean"])
+        return {"mean": mean, "seen": state["seen"] + 1}
+
+    def scores(self, state):
+        return state["mean"]
+
+    def replay(self, changes):
+        return _exponential_means(changes, self.alpha)
+
+
+class Momentum(Strategy):
+    """
+    Scores providers by how much faster their share price is falling recently than over a longer period
+    """
+
+    name = "momentum"
+
+    def __init__(self, fast_span=3, slow_span=18):
+        self.fast = ExponentialAverage(fast_span)
+        self.slow = ExponentialAverage(slow_span)
+
+    def start(self, providers):
+        fast, slow = self.fast.start(providers), self.slow.start(providers)
+        return {"fast": fast["mean"], "slow": slow["mean"], "seen": fast["seen"]}
+
+    def update(self, state, changes):
+        fast = self.fast.update({"mean": state["fast"], "seen": state["seen"]}, changes)
+        slow = self.slow.update({"mean": state["slow"], "seen": state["seen"]}, changes)
+        return {"fast": fast["mean"], "slow": slow["mean"], "seen": fast["seen"]}
+
+    def scores(self, state):
+        return state["fast"] - state["slow"]
+
+    def replay(self, changes):
+        return self.fast.replay(changes) - self.slow.replay(changes)
+
+
+class VolatilityAdjusted(Strategy):
+    """
+    Scores providers by their exponentially weighted mean change divided by its standard deviation, so a steady loss
+    scores better than a loss which comes and goes
+    """
+
+    name = "volatility"
+
+    # Stops providers whose change never moves from getting an infinite score
+    EPSILON = 1e-6
+
+    def __init__(self, span=18):
+        self.alpha = 2 / (span + 1)
+
+    def start(self, providers):
+        return {
+            "mean": np.zeros(providers),
+            "variance": np.zeros(providers),
+            "seen": np.zeros(1),
+        }
+
+    def update(self, state, changes):
+        if not state["seen"][0]:
+            return {
+                "mean": np.array(changes, dtype=float),
+                "variance": np.zeros(len(changes)),
+                "seen": state["seen"] + 1,
+            }
+        difference = changes - state["mean"]
+        increment = self.alpha * difference
+        return {
+            "mean": state["mean"] + increment,
+            "variance": (1 - self.alpha) * (state["variance"] + difference * increment),
+            "seen": state["seen"] + 1,
+        }
+
+    def scores(self, state):
+        return state["mean"] / np.sqrt(state["variance"] + self.EPSILON)
+
+    def replay(self, changes):
+        means = _exponential_means(changes, self.alpha)
+        if not len(changes):
+            return means
+        # The variance starts at 0 and takes in the difference of each later reading from the mean before it
+        differences = changes[1:] - means[:-1]
+        decay = 1 - self.alpha
+        variances = np.vstack(
+            [
+                np.zeros((1, changes.shape[1])),
+                _decaying_sums(
+                    decay * self.alpha * differences ** 2,
+                    decay,
+                    np.zeros(changes.shape[1]),
+                ),
+            ]
+        )
+        return means / np.sqrt(variances + self.EPSILON)
+
+
+# Every strategy that can be named in settings.PREDICTION_STRATEGIES
+STRATEGIES = {
+    strategy.name: strategy
+    for strategy in (MovingAverage, ExponentialAverage, Momentum, VolatilityAdjusted)
+}
+
+
+def readings_matrix(readings, providers, previous=None):
+    """
+    Turns stock market readings into a matrix with a row per reading time and a column per provider. A provider
+    missing from a reading keeps the change of its previous reading, or 0 if it has none.
+    :param readings: iterable of (time, provider id, change) ordered by time
+    :param providers: list of provider ids, in the order of the columns
+    :param previous: list of the change of each provider's last reading before these, or None where it has none
+    :return:
+    times: list of the datetime of each row
+    changes: NumPy array of shape (len(times), len(providers))
+    """
+    column = {provider: i for i, provider in enumerate(providers)}
+    readings = [r for r in readings if r[1] in column]
+    if not readings:
+        return [], np.empty((0, len(providers)))
+    times, rows = np.unique([r[0] for r in readings], return_inverse=True)
+    columns = [column[r[1]] for r in readings]
+    # The first row holds the readings from before, so providers missing from the first readings carry them on
+    changes = np.full((len(times) + 1, len(providers)), np.nan)
+    if previous is not None:
+        changes[0] = [np.nan if change is None else change for change in previous]
+    changes[rows + 1, columns] = [r[2] for r in readings]
+
+    # Forward fill each column from the last row which had a reading
+    filled = np.where(np.isnan(changes), 0, np.arange(len(times) + 1)[:, None])
+    np.maximum.accumulate(filled, axis=0, out=filled)
+    changes = changes[filled, np.arange(len(providers))]
+    return list(times), np.nan_to_num(changes[1:])
+
+
+def _previous_changes(providers, **before):
+    # The change of each provider's last reading matching a time lookup such as time__lt, in one query
+    last = (
+        StockData.objects.filter(provider=OuterRef("pk"), **before)
+        .order_by("-time")
+        .values("change")[:1]
+    )
+    found = dict(
+        API.objects.filter(id__in=providers)
+        .annotate(change=Subquery(last))
+        .values_list("id", "change")
+    )
+    return [found.get(provider) for provider in providers]
+
+
+def _load_states(names, providers):
+    # The saved state of each strategy, skipping those saved for a different set of providers
+    saved = StrategyState.objects.filter(
+        strategy__in=names, providers=",".join(map(str, providers))
+    )
+    return {
+        row.strategy: (
+            row,
+            {name: np.array(value) for name, value in json.loads(row.state).items()},
+        )
+        for row in saved
+    }
+
+
+def _save_state(row, strategy, providers, time, state):
+    # Saves over the loaded row, or creates one for a strategy running for the first time
+    if row is None:
+        row = StrategyState(strategy=strategy.name)
+    row.time = time
+    row.providers = ",".join(map(str, providers))
+    row.state = json.dumps({name: value.tolist() for name, value in state.items()})
+    if row.pk is None:
+        # A state saved for other providers is replaced
+        StrategyState.objects.filter(strategy=strategy.name).delete()
+    row.save()
+
+
+def run_strategies(names=None):
+    """
+    Brings every strategy up to date with the stock market readings saved since it last ran, and saves the provider
+    each of them scores best as a Prediction tagged with the strategy's name. Strategies without a saved state start
+    from the last PREDICTION_HISTORY readings.
+    :param names: list of strategy names to run. Defaults to settings.PREDICTION_STRATEGIES
+    :return: dictionary of strategy name to the Prediction saved, for the strategies that had new readings
+    """
+    if names is None:
+        names = settings.PREDICTION_STRATEGIES
+    strategies = [STRATEGIES[name]() for name in names]
+    providers = list(
+        API.objects.filter(is_provider=True).order_by("id").values_list("id", flat=True)
+    )
+    if not providers:
+        return {}
+
+    loaded = _load_states(names, providers)
+    # Only the readings newer than the oldest state are needed. Strategies without one need the recent history
+    history_start = None
+    if any(strategy.name not in loaded for strategy in strategies):
+        history = (
+            StockData.objects.order_by("-time")
+            .values_list("time", flat=True)
+            .distinct()[settings.PREDICTION_HISTORY - 1 : settings.PREDICTION_HISTORY]
+        )
+        history_start = history.first()
+        start = history_start
+        if start is not None:
+            # A strategy whose state is older than the history still needs every reading since its state
+            start = min([start] + [row.time for row, state in loaded.values()])
+        readings = StockData.objects.all()
+        if start is not None:
+            readings = readings.filter(time__gte=start)
+            previous = _previous_changes(providers, time__lt=start)
+        else:
+            previous = None
+    else:
+        start = min(row.time for row, state in loaded.values())
+        readings = StockData.objects.filter(time__gt=start)
+        # Providers missing from the first new readings keep their change from before, as they would in a replay
+        previous = _previous_changes(providers, time__lte=start)
+    times, changes = readings_matrix(
+        readings.order_by("time").values_list("time", "provider_id", "change"),
+        providers,
+        previous,
+    )
+    if not times:
+        return {}
+
+    predictions = {}
+    with transaction.atomic():
+        for strategy in strategies:
+            row, state = loaded.get(strategy.name, (None, None))
+            if row is None:
+                state = strategy.start(len(providers))
+            if row is None:
+                new = [
+                    i
+                    for i, time in enumerate(times)
+                    if history_start is None or time >= history_start
+                ]
+            else:
+                new = [i for i, time in enumerate(times) if time > row.time]
+            if not new:
+                continue
+            for reading in changes[new]:
+                state = strategy.update(state, reading)
+            scores = strategy.scores(state)
+            best = int(np.argmin(scores))
+            _save_state(row, strategy, providers, times[-1], state)
+            predictions[strategy.name] = Prediction.objects.create(
+                time=times[-1],
+                provider_id=providers[best],
+                strategy=strategy.name,
+                score=float(scores[best]),
+            )
+    return predictions
@@ -0,0 +1,58 @@
+import json
+import os
+import tempfile
+
+from django.db import transaction
+
+from .models import API, Key
+
+
+def playbook_vars():
+    """
+    Reads every variable the playbooks need from the database in a single read transaction, so they don't have to
+    query the database themselves while gunicorn is writing to it
+    :return: dictionary containing
+    provider_keys: dictionary of the name of every API to a dictionary of its key names to values
+    """
+    with transaction.atomic():
+        names = dict(API.objects.values_list("id", "name"))
+        keys = {name: {} for name in names.values()}
+        for provider_id, name, value in Key.objects.values_list(
+            "provider_id", "name", "value"
+        ):
+            keys[names[provider_id]][name] = value
+    return {"provider_keys": keys}
+
+
+def write_playbook_vars(path=None):
+    """
+    Writes the variables from playbook_vars to a JSON file for ansible-playbook to load with -e @<path>. Only the
+    current user can read the file, as it holds every key.
+    :param path: str. Where to write the file. Defaults to a new temporary file
+    :return: str. The path written to
+    """
+    if path is None:
+        handle, path = tempfile.mkstemp(prefix="leidoscloud-vars-", suffix=".json")
+    else:
+        handle = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(handle, "w") as f:
+        json.dump(playbook_vars(), f)
+    return path
+
+
+def remove_when_done(job, path):
+    """
+    Removes a vars file once the playbook using it has finished
+    :param job: Future of the playbook, see utils_jobs.submit
+    :param path: str. Location of the vars file
+    :return: job
+    """
+
+    def remove(finished):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    job.add_done_callback(remove)
+    return job
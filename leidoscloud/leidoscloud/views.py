@@ -1,19 +1,57 @@
-import datetime
+import hashlib
 import os
+from datetime import timedelta
 
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-from django.http import JsonResponse
+from django.http import (
+    Http404,
+    HttpResponse,
+    JsonResponse,
+    StreamingHttpResponse,
+)
 from django.shortcuts import redirect
 from django.shortcuts import render
 from django.utils import timezone
+from django.utils.cache import patch_cache_control, patch_vary_headers
 from django.utils.dateparse import parse_datetime
 from django.utils.timesince import timesince
 from django.views.decorators.cache import never_cache
+from django.views.decorators.http import condition
 from leidoscloud.models import Transition, API, StockData, Prediction
 
+from . import utils_cache
+from . import utils_events
 from . import utils_host
+from . import utils_log
 from . import utils_playbook
+from . import utils_series
+from .utils_stock_api import get_stock_window
+
+
+def _heading():
+    # What the index heading shows, apart from the running time which changes every minute
+    heading = {
+        "current_provider": utils_host.get_current_cloud_host().long_name,
+        "end_time": None,
+        "end_provider": None,
+    }
+    # get the latest transition object
+    latest_transition = (
+        Transition.objects.select_related("end_provider")
+        .order_by("-start_time")
+        .first()
+    )
+    if latest_transition is not None:
+        # if the latest transition is still in progress
+        if not latest_transition.end_time:
+            # Assumes we are moving!
+            # add the provider being transitioned to into the context dictionary
+            heading["end_provider"] = latest_transition.end_provider.long_name
+        else:
+            heading["end_time"] = latest_transition.end_time
+    return heading
 
 
 @login_required
@@ -26,40 +64,32 @@ def index(request):
     :return: return the rendered index page using the html template and the context dictionary for the page
     """
 
+    # The heading is only looked up again after a transition or provider changes
+    heading = utils_cache.cached(
+        [utils_cache.TRANSITIONS, utils_cache.PROVIDERS], "index_heading", _heading
+    )
     # fill the context dictionary with the name of the current hostname
     context_dict = {
-        "current_provider": utils_host.get_current_cloud_host().long_name,
+        "current_provider": heading["current_provider"],
         "running_time": None,
-        "end_provider": None,
+        "end_provider": heading["end_provider"],
     }
-
-    # Get time since latest start time
-    try:
-        # get the latest transition object
-        latest_transition = Transition.objects.latest("start_time")
-        # if the latest transition is still in progress
-        if not latest_transition.end_time:
-            # Assumes we are moving!
-            # add the provider being transitioned to into the context dictionary
-            context_dict["end_provider"] = latest_transition.end_provider.long_name
-        # otherwise if no transition is taking place
-        else:
-            # set the running time to the length of time since the transition to the current host finished
-            context_dict["running_time"] = timesince(
-                latest_transition.end_time, timezone.now()
-            )
-    # if no transitions have been made
-    except Transition.DoesNotExist:
+    if heading["end_time"] is not None:
+        # set the running time to the length of time since the transition to the current host finished
+        context_dict["running_time"] = timesince(heading["end_time"], timezone.now())
+    elif heading["end_provider"] is None:
         # This is the initial run of the application, display some blank info
         context_dict["running_time"] = "eternity and/or never"
 
     # Check all keys are present
-    if not utils_host.are_population_script_keys_present():
+    missing_keys = utils_host.get_missing_keys()
+    if missing_keys:
         messages.add_message(
             request,
             messages.ERROR,
             "You don't have all necessary keys in your database. The program will not work! Please enter all needed "
-            "keys in the admin page.",
+            "keys in the admin page. Missing: "
+            + ", ".join(api + " " + key for api, key in missing_keys),
         )
     return render(request, "index.html", context_dict)
 
@@ -75,8 +105,12 @@ def cloudsurf(request):
     :return: return the rendered cloudsurf page using the html template and the context dictionary for the page
     """
 
-    # get the list of available cloud providers
-    api_list = API.objects.filter(is_provider=True)
+    # get the list of available cloud providers, which only changes when an API is saved or deleted
+    api_list = utils_cache.cached(
+        [utils_cache.PROVIDERS],
+        "cloud_providers",
+        lambda: list(API.objects.filter(is_provider=True)),
+    )
     # add the list of available cloud providers to the context dictionary
     context_dict = {"apis": api_list}
     return render(request, "cloudsurf.html", context_dict)
@@ -145,63 +179,53 @@ def cloudsurfing_status(request):
     :return: JSON response object
     """
 
-    response = {}
-    with open(utils_host.MAIN_LOG_TXT, "rb") as fh:
-        # From
-        # https://stackoverflow.com/questions/3346430/what-is-the-most-efficient-way-to-get-first-and-last-line-of-a-text-file
-        # Get last line of file
-        try:
-            fh.seek(-2500, os.SEEK_END)
-        except:
-            # Looks like the file is too small. Load the entire thing!
-            fh.seek(os.SEEK_END, 0)
-        lines = fh.readlines()
-        last = lines[-1].decode()
-
-        # If this line doesn't have a TASK, keep moving up until we do
-        i = 2
-        while "TASK" not in last:
-            # If we see a fatal, let's show that to the user
-            if "fatal" in last:
-                response["error"] = last
-                response[
-                    "status"
-                ] = "Ansible has crashed! Most likely keys have not been configured correctly. See log for details"
-                return JsonResponse(response)
-            try:
-                last = lines[-i].decode()
-            except IndexError:
-                response["error"] = "Invalid ansible log. Check entire log for details"
-                return JsonResponse(response)
-            i += 1
-
-        last_date = parse_datetime(last[0:18])
-        response["date"] = last_date
-        since_last_date = datetime.datetime.now() - last_date
-
-        # Include the section within the brackets as the current status
-        response["status"] = last[last.find("[") + 1 : last.find("]")]
-
-        # This item is last on servers which are freshly migrated! Account for this
-        if "Copying self to server" in last:
-            # Could be an actual status item!
-            if since_last_date > datetime.timedelta(minutes=2):
-                # It's not a real logitem. Just the stuff left over!
-                response["date"] = datetime.datetime.now()
-                response["status"] = "Not CloudSurfing"
-    # otherwise check if the line contains TASK and if so return it otherwise return one above
+    # The log is shared between every tab polling this view, so only the newly appended lines are parsed
+    response = utils_log.current_status(utils_host.MAIN_LOG_TXT)
+
+    # While moving, add the progress recorded by the ansible callback. It is cached until a run or task changes
+    progress = utils_events.moving_progress()
+    if progress is not None:
+        response["progress"] = progress
     return JsonResponse(response)
 
 
+@login_required
+@never_cache
+def cloudsurfing_status_stream(request):
+    """
+    Pushes the current status of the cloudsurf to the browser as Server-Sent Events whenever the main log produces a
+    new TASK or fatal line
+
+    :param request: HTTP request object
+    :return: streaming response in the text/event-stream format, or status 503 when settings.STREAM_MAX_CONNECTIONS
+    streams are open already
+    """
+
+    events = utils_log.open_status_stream(
+        utils_host.MAIN_LOG_TXT, request.META.get("HTTP_LAST_EVENT_ID")
+    )
+    if events is None:
+        # EventSource gives up on a 503, and the page polls cloudsurfing_status instead
+        return HttpResponse("Too many status streams are open", status=503)
+    response = StreamingHttpResponse(events, content_type="text/event-stream")
+    # Stop proxies from holding back events until the response is finished
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
 @login_required
 @never_cache
 def full_log(request):
     """
     This view will be called when the user enters the URL for the full log page for either the deletion or execution log
 
+    By default the last lines of the log are shown. The query string can ask for the last "tail" lines, a page of
+    "length" bytes starting at the byte "offset", or a "download" of the raw log which is gzipped if the browser
+    accepts it. Only a page of the log is ever held in memory.
+
     :param request: HTTP request object
-    :return: return the rendered full log of either the main ansible log or the deletion log using the html template
-    and the context dictionary for the page
+    :return: return the rendered page of either the main ansible log or the deletion log using the html template
+    and the context dictionary for the page, or a streaming response when downloading
     """
 
     # Either open the LOG_TXT or the ansible log depending on the request path
@@ -210,20 +234,61 @@ def full_log(request):
         if "delete" in request.path
         else utils_host.MAIN_LOG_TXT
     )
-    try:
-        f = open(file_to_open, "r")
-        log = f.read()
-        f.close()
-    except IOError as err:
-        log = "Unavailable. Failed to open with " + str(err)
+
+    if "download" in request.GET:
+        try:
+            log_file = open(file_to_open, "rb")
+        except IOError:
+            raise Http404("Log unavailable")
+        compress = "gzip" in request.META.get("HTTP_ACCEPT_ENCODING", "")
+        response = StreamingHttpResponse(
+            utils_log.iter_log(log_file, compress), content_type="text/plain"
+        )
+        if compress:
+            response["Content-Encoding"] = "gzip"
+        patch_vary_headers(response, ("Accept-Encoding",))
+        response["Content-Disposition"] = 'attachment; filename="{}"'.format(
+            os.path.basename(file_to_open)
+        )
+        return response
 
     context_dict = {
         "name": "Deletion" if "delete" in request.path else "Execution",
-        "contents": log,
     }
+    try:
+        if "offset" in request.GET:
+            # An empty page would link back to itself as the neighbouring ones
+            length = _int_parameter(
+                request, "length", utils_log.LOG_PAGE_BYTES, minimum=1
+            )
+            log, start, end, size = utils_log.read_page(
+                file_to_open, _int_parameter(request, "offset", 0), length
+            )
+        else:
+            length = utils_log.LOG_PAGE_BYTES
+            log, start, size = utils_log.read_tail(
+                file_to_open, _int_parameter(request, "tail", utils_log.LOG_TAIL_LINES)
+            )
+            end = size
+        # Offsets of the neighbouring pages, or None at either end of the log
+        context_dict["previous_offset"] = max(0, start - length) if start > 0 else None
+        context_dict["next_offset"] = end if end < size else None
+        context_dict["length"] = length
+    except IOError as err:
+        log = "Unavailable. Failed to open with " + str(err)
+
+    context_dict["contents"] = log
     return render(request, "log.html", context_dict)
 
 
+def _int_parameter(request, name, default, minimum=0):
+    # Ignore missing or malformed numbers in the query string, and raise those below the minimum to it
+    try:
+        return max(minimum, int(request.GET.get(name, default)))
+    except ValueError:
+        return default
+
+
 @login_required
 def prediction(request):
     """
@@ -236,3 +301,112 @@ def prediction(request):
 
     context_dict = {}
     return render(request, "prediction.html", context_dict)
+
+
+@login_required
+def migration_timings(request):
+    """
+    This view will be called when the timings page URL is entered, which shows how long each step of a CloudSurf
+    usually takes when moving to each provider, so the slowest steps can be found.
+
+    :param request: HTTP request object
+    :return: return the rendered timings page using the html template and the context dictionary for the page
+    """
+
+    # The events of the last CloudSurf were read in by apps.ready when Django started on this host. The timings are
+    # built from every finished task, so they are only worked out again once another task finishes
+    timings = utils_cache.cached(
+        [utils_cache.TIMINGS, utils_cache.TRANSITIONS, utils_cache.PROVIDERS],
+        "migration_timings",
+        utils_events.phase_timings,
+    )
+    context_dict = {"timings": timings}
+    return render(request, "timings.html", context_dict)
+
+
+def _series_range(request):
+    # The range asked for in the query string, ending now and covering SERIES_DAYS by default
+    dates = {}
+    for name in ("start", "end"):
+        value = request.GET.get(name)
+        if value is None:
+            continue
+        date = parse_datetime(value)
+        if date is None:
+            raise ValueError(name + " is not a valid date")
+        dates[name] = date if timezone.is_aware(date) else timezone.make_aware(date)
+    end = dates.get("end", timezone.now())
+    start = dates.get("start", end - timedelta(days=settings.SERIES_DAYS))
+    if start >= end:
+        raise ValueError("start must be before end")
+    # Every reading in the range is loaded before it is downsampled
+    if end - start > timedelta(days=settings.SERIES_MAX_DAYS):
+        raise ValueError(
+            "The range can't be longer than {} days".format(settings.SERIES_MAX_DAYS)
+        )
+    return start, end
+
+
+def _series_points(request):
+    return max(
+        3,
+        min(
+            _int_parameter(request, "points", settings.SERIES_POINTS),
+            settings.SERIES_MAX_POINTS,
+        ),
+    )
+
+
+def _series_etag(request):
+    # The range, the number of points and the newest reading in the range, so a browser can revalidate without the
+    # series being built again. The default range moves with the time, so readings falling out of it change the tag
+    try:
+        start, end = _series_range(request)
+    except ValueError:
+        return None
+    newest = (
+        get_stock_window(start, end)
+        .order_by("-time")
+        .values_list("time", flat=True)
+        .first()
+    )
+    return hashlib.sha256(
+        "{}|{}|{}|{}".format(
+            start.isoformat(),
+            end.isoformat(),
+            _series_points(request),
+            newest.isoformat() if newest else "",
+        ).encode()
+    ).hexdigest()
+
+
+@login_required
+@condition(etag_func=_series_etag)
+def stock_series(request):
+    """
+    Serves the stock market change of every provider over a time range for the chart on the predictions page. Each
+    series is downsampled to at most "points" points so months of readings stay small.
+
+    The query string can set the "start" and "end" of the range as ISO 8601 dates and the number of "points". Ranges
+    longer than SERIES_MAX_DAYS are refused.
+
+    :param request: HTTP request object
+    :return: JSON response containing the range and the series of each provider, or an error with status 400
+    """
+    try:
+        start, end = _series_range(request)
+    except ValueError as err:
+        return JsonResponse({"error": str(err)}, status=400)
+    points = _series_points(request)
+
+    response = JsonResponse(
+        {
+            "start": start,
+            "end": end,
+            "points": points,
+            "series": utils_series.stock_series(start, end, points),
+        }
+    )
+    # The series is only shown to logged in users, so shared caches must not keep it
+    patch_cache_control(response, private=True, max_age=settings.SERIES_CACHE_SECONDS)
+    return response